@@ -1,201 +1,744 @@
-
 """
 FAOSTAT Food Prices - Data Preparation for Visualization
 Autor: Abdallah Tegguer
+
+El pipeline se divide en etapas (carga, validación, filtrado, reshape,
+limpieza, clasificación, métricas y exportación) con entradas y salidas
+explícitas. Se puede importar y ejecutar solo lo necesario:
+
+    import analizar
+    resultados = analizar.run_pipeline(['04_Regional_Aggregates'])
 """
 
 import pandas as pd
 import numpy as np
+import argparse
+import base64
+import cProfile
+import functools
+import gzip
+import hashlib
+import heapq
+import io
+import json
 import os
+import platform
+import shutil
+import sys
+import threading
+import time
+import tracemalloc
+import unicodedata
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from datetime import datetime
+from multiprocessing import shared_memory
+from urllib.parse import quote
+
+try:
+    import resource  # pico de RSS; no existe en Windows
+except ImportError:
+    resource = None
+
+try:
+    import duckdb  # opcional: solo para --backend duckdb
+except ImportError:
+    duckdb = None
+
+try:
+    import pyarrow as pa  # opcional: formatos parquet y feather
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+try:
+    import zstandard  # opcional: formato csv.zst
+except ImportError:
+    zstandard = None
 
 # =============================================================================
 # CONFIGURACIÓN
 # =============================================================================
 
 OUTPUT_FOLDER = 'output'
-if not os.path.exists(OUTPUT_FOLDER):
-    os.makedirs(OUTPUT_FOLDER)
 
-# =============================================================================
-# PASO 1: CARGAR DATOS
-# =============================================================================
+MAIN_DATA_FILE = 'Prices_E_All_Data.csv'
 
-print("=" * 60)
-print("PASO 1: CARGANDO DATOS")
-print("=" * 60)
+# Archivos auxiliares que determinan la clasificación región/categoría
+CLASSIFICATION_FILES = ('Prices_E_AreaCodes.csv', 'Prices_E_ItemCodes.csv')
 
-# Dataset principal
-df_main = pd.read_csv('Prices_E_All_Data.csv', encoding='latin-1')
-print(f"Dataset principal cargado: {len(df_main):,} filas, {len(df_main.columns)} columnas")
+# Artefactos de salida (OUTPUT_FOLDER/<nombre>.csv) y claves de grupo de
+# cada tabla de métricas
+LONG_ARTIFACT = '01_FAOSTAT_Prices_Clean_Long'
+METRIC_ARTIFACT_KEYS = {
+    '02_Country_Metrics': ['Area', 'Region'],
+    '03_Product_Metrics': ['Item', 'Product_Category'],
+    '04_Regional_Aggregates': ['Region', 'Year', 'Product_Category'],
+    '05_Country_Category_Metrics': ['Area', 'Region', 'Product_Category'],
+}
 
-# Datasets auxiliares
-df_area_codes = pd.read_csv('Prices_E_AreaCodes.csv', encoding='latin-1')
-df_item_codes = pd.read_csv('Prices_E_ItemCodes.csv', encoding='latin-1')
-df_elements = pd.read_csv('Prices_E_Elements.csv', encoding='latin-1')
-df_flags = pd.read_csv('Prices_E_Flags.csv', encoding='latin-1')
+# Tabla del pipeline que se exporta como cada artefacto
+ARTIFACT_TABLES = {
+    LONG_ARTIFACT: 'df_yoy',
+    '02_Country_Metrics': 'country_metrics',
+    '03_Product_Metrics': 'product_metrics',
+    '04_Regional_Aggregates': 'regional_aggregates',
+    '05_Country_Category_Metrics': 'country_category_metrics',
+}
 
-print(f"AreaCodes cargado: {len(df_area_codes)} registros")
-print(f"ItemCodes cargado: {len(df_item_codes)} registros")
-print(f"Elements cargado: {len(df_elements)} registros")
-print(f"Flags cargado: {len(df_flags)} registros")
+# Tensor Área × Producto × Año (carpeta OUTPUT_FOLDER/<nombre>/, no CSV),
+# cubo de agregados combinables, datos del dashboard, matrices de tendencia,
+# precios anómalos y lista completa de artefactos que genera una ejecución completa
+TENSOR_ARTIFACT = '06_Price_Tensor'
+TENSOR_DTYPE = 'float32'
+CUBE_ARTIFACT = '07_Rollup_Cube'
+DASHBOARD_ARTIFACT = '08_Dashboard'
+TRENDS_ARTIFACT = '09_Trend_Windows'
+ANOMALIES_ARTIFACT = '10_Price_Anomalies'
+FOLDER_ARTIFACTS = (TENSOR_ARTIFACT, DASHBOARD_ARTIFACT, TRENDS_ARTIFACT)
+OUTPUT_ARTIFACTS = list(ARTIFACT_TABLES) + [TENSOR_ARTIFACT, CUBE_ARTIFACT, DASHBOARD_ARTIFACT, TRENDS_ARTIFACT,
+                                            ANOMALIES_ARTIFACT]
 
-# =============================================================================
-# PASO 2: VALIDACIÓN ESTRUCTURAL
-# =============================================================================
+# Tendencias: % de cambio entre el primer precio de un año y el de otro.
+# Cada ventana (inicio, fin) de TREND_WINDOWS es una columna
+# Trend_<inicio>_<fin> de 02, 03 y 05 (python analizar.py --trend 2000-2020
+# añade otras; la primera es la del dashboard). 09_Trend_Windows/ guarda
+# además la tendencia de todos los pares de años y la tendencia y la
+# volatilidad móviles de ROLLING_WINDOWS años (--rolling N).
+TREND_WINDOWS = [(2010, 2023)]
+ROLLING_WINDOWS = [5]
+TRENDS_DTYPE = 'float32'
+
+# Percentiles de precio de 02-05 (columna: cuantil), al final de cada tabla,
+# calculados con sketches con un error relativo máximo de
+# QUANTILE_RELATIVE_ACCURACY
+QUANTILES = {'P10_Price': 0.10, 'P25_Price': 0.25, 'Median_Price': 0.50, 'P75_Price': 0.75, 'P90_Price': 0.90}
+QUANTILE_RELATIVE_ACCURACY = 0.01
+
+# Precios anómalos (10_Price_Anomalies): en cada serie (Area, Item), z
+# robusta = 0.6745 * (precio - mediana) / MAD de la ventana centrada de
+# ANOMALY_WINDOW observaciones (recortada en los extremos de la serie). Se
+# marcan los |z| > ANOMALY_THRESHOLD (criterio de Iglewicz y Hoaglin) con al
+# menos ANOMALY_MIN_OBSERVATIONS precios en la ventana. La MAD no baja de
+# ANOMALY_MIN_MAD_SHARE × |mediana|, para que en series casi constantes no
+# se marquen variaciones pequeñas. Con EXCLUDE_ANOMALIES (--exclude-anomalies)
+# los puntos marcados no entran en las métricas 6.4-6.7 (02-05).
+ANOMALY_WINDOW = 7
+ANOMALY_THRESHOLD = 3.5
+ANOMALY_MIN_OBSERVATIONS = 5
+ANOMALY_MIN_MAD_SHARE = 0.05
+ANOMALY_Z_SCALE = 0.6745
+ANOMALY_CHUNK_ROWS = 65_536
+EXCLUDE_ANOMALIES = False
+
+# Datos de 'visualizacion final.html' (solo PPI): países por archivo de
+# series (la página carga solo los bloques de los países que muestra) y
+# copia .gz precomprimida de cada archivo para servirlos por HTTP
+DASHBOARD_CHUNK_SIZE = 16
+DASHBOARD_GZIP = True
 
-print("\n" + "=" * 60)
-print("PASO 2: VALIDACIÓN ESTRUCTURAL")
-print("=" * 60)
+# Producer Price Index (5539) para comparabilidad internacional
+ELEMENT_CODE_PPI = 5539
+
+# Elementos que se procesan por defecto (python analizar.py --elements ...
+# acepta varios códigos o 'all'). Se leen y transforman una sola vez; las
+# salidas del PPI van a OUTPUT_FOLDER y las de los demás elementos a
+# OUTPUT_FOLDER/element_<código>/.
+DEFAULT_ELEMENT_CODES = [ELEMENT_CODE_PPI]
+ALL_ELEMENTS = 'all'
+
+# Filas por bloque en la lectura por streaming del dataset principal
+CHUNK_SIZE = 200_000
+
+# Caché columnar (arrays NumPy memory-mapped) del dataset principal ya
+# parseado y filtrado. Se invalida sola si cambia el archivo de origen.
+USE_CACHE = True
+CACHE_FOLDER = 'cache'
+CACHE_FORMAT_VERSION = 4
 
-# Limpiar nombres de columnas en auxiliares (quitar espacios)
-df_area_codes.columns = df_area_codes.columns.str.strip()
-df_item_codes.columns = df_item_codes.columns.str.strip()
-df_elements.columns = df_elements.columns.str.strip()
-df_flags.columns = df_flags.columns.str.strip()
+# Tipo de los valores de precio. 'float32' reduce a la mitad la memoria de
+# la columna Price (a costa de ~7 dígitos significativos); por defecto se
+# mantiene 'float64' para que las métricas no cambien.
+PRICE_DTYPE = 'float64'
 
-# Validación con AreaCodes
-area_codes_in_main = set(df_main['Area Code'].unique())
-area_codes_in_aux = set(df_area_codes['Area Code'].unique())
-area_match = area_codes_in_main.issubset(area_codes_in_aux)
-print(f"Validación Area Codes: {'OK' if area_match else 'MISMATCH'}")
-print(f"  - Códigos en main: {len(area_codes_in_main)}")
-print(f"  - Códigos en auxiliar: {len(area_codes_in_aux)}")
+# Estado del modo incremental (python analizar.py --incremental): solo se
+# recalculan las series (Area Code, Item Code) que cambiaron desde la última
+# ejecución y los grupos de métricas que las contienen; 01-05 se parchean en
+# lugar de regenerarse.
+INCREMENTAL_FOLDER = os.path.join(CACHE_FOLDER, 'incremental')
+INCREMENTAL_STATE_VERSION = 1
 
-# Validación con ItemCodes
-item_codes_in_main = set(df_main['Item Code'].unique())
-item_codes_in_aux = set(df_item_codes['Item Code'].unique())
-item_match = item_codes_in_main.issubset(item_codes_in_aux)
-print(f"Validación Item Codes: {'OK' if item_match else 'MISMATCH'}")
-print(f"  - Códigos en main: {len(item_codes_in_main)}")
-print(f"  - Códigos en auxiliar: {len(item_codes_in_aux)}")
+# Informe JSON de cada ejecución (tiempos, memoria y filas por etapa) y
+# volcados de cProfile (python analizar.py --profile <etapa>)
+REPORT_FOLDER = 'reports'
+RUN_REPORT_FILE = os.path.join(REPORT_FOLDER, 'run_report.json')
 
-# Validación con Elements
-element_codes_in_main = set(df_main['Element Code'].unique())
-element_codes_in_aux = set(df_elements['Element Code'].unique())
-element_match = element_codes_in_main.issubset(element_codes_in_aux)
-print(f"Validación Element Codes: {'OK' if element_match else 'MISMATCH'}")
-print(f"  - Códigos en main: {len(element_codes_in_main)}")
-print(f"  - Códigos en auxiliar: {len(element_codes_in_aux)}")
+# Planificador de etapas (python analizar.py --stage-threads N): con N > 1
+# las etapas cuyas entradas ya están calculadas se ejecutan a la vez en N
+# hilos (carga de auxiliares junto a la principal, 6.4-6.7 entre sí,
+# exportaciones solapadas con las métricas); con 1, en el orden de
+# PIPELINE_STAGES. Al final se imprime la ruta crítica de la ejecución.
+STAGE_THREADS = 1
 
-# Merge de validación con AreaCodes para obtener M49 Code
-df_area_codes_clean = df_area_codes[['Area Code', 'M49 Code']].copy()
-df_area_codes_clean.columns = ['Area Code', 'M49_Code_Validated']
-df_validated = df_main.merge(df_area_codes_clean, on='Area Code', how='left')
+# Informe de calidad del PASO 2 (integridad referencial, filas por elemento
+# y distribución Flag x Year x Element)
+QUALITY_REPORT_FILE = os.path.join(REPORT_FOLDER, 'quality_report.json')
 
-validation_success = df_validated['M49_Code_Validated'].notna().sum()
-print(f"Merge de validación con AreaCodes: {validation_success:,} / {len(df_validated):,} registros validados")
+# Backend de ejecución (python analizar.py --backend duckdb). 'duckdb' es
+# opcional (pip install duckdb): ejecuta carga, filtro, unpivot y
+# clasificación como consultas fuera de memoria, con un límite de memoria y
+# volcado a disco, para descargas FAOSTAT que no caben en pandas. Las
+# salidas son idénticas a las del backend pandas.
+BACKENDS = ('pandas', 'duckdb')
+DUCKDB_MEMORY_LIMIT = '4GB'
+DUCKDB_TEMP_FOLDER = os.path.join(CACHE_FOLDER, 'duckdb')
+# Filas por bloque al pasar de DuckDB a los kernels NumPy de YoY y métricas
+DUCKDB_BATCH_ROWS = 1_000_000
 
-# No conservamos la columna extra, solo era para validación
-del df_validated
+# Formatos de exportación de los artefactos 01-05, por artefacto
+# (python analizar.py --format [ARTEFACTO=]FORMATO[,FORMATO...]):
+#   csv       el de siempre; el único que admite el modo incremental
+#   csv.gz    CSV comprimido por streaming (gzip, nivel EXPORT_GZIP_LEVEL)
+#   csv.zst   CSV comprimido con zstd (pip install zstandard)
+#   parquet   columnar con diccionarios (pip install pyarrow); el 01 se
+#             parte por Region en subcarpetas Region=<valor>/
+#   feather   Arrow IPC comprimido (pip install pyarrow), carga sin parseo
+# Las escrituras de cada etapa (formatos y elementos) se reparten entre
+# EXPORT_THREADS hilos.
+EXPORT_FORMATS = ('csv', 'csv.gz', 'csv.zst', 'parquet', 'feather')
+DEFAULT_EXPORT_FORMATS = ['csv']
+EXPORT_THREADS = 4
+EXPORT_CSV_CHUNK_ROWS = 200_000
+EXPORT_GZIP_LEVEL = 6
+EXPORT_ZSTD_LEVEL = 3
+PARQUET_ROW_GROUP_ROWS = 1_000_000
+PARQUET_PARTITION_COLUMNS = {LONG_ARTIFACT: 'Region'}
+FEATHER_COMPRESSION = 'zstd'
 
-# Mostrar elementos disponibles
-print("\nElementos disponibles en el dataset:")
-for _, row in df_elements.iterrows():
-    code = row['Element Code']
-    name = row['Element']
-    count = len(df_main[df_main['Element Code'] == code])
-    print(f"  - {code}: {name} ({count:,} registros)")
+# Etiqueta de los valores observados sin flag en la distribución de flags
+NO_FLAG = '(sin flag)'
 
-# Mostrar flags disponibles
-print("\nFlags de calidad disponibles:")
-for _, row in df_flags.iterrows():
-    print(f"  - {row['Flag']}: {row['Description']}")
+# Columnas identificadoras que se leen del dataset principal y se repiten en
+# cada fila del formato long (el resto de columnas no-año, como Unit o Months,
+# no se usan; los códigos se conservan para la clasificación del PASO 6 y el
+# reparto por elemento, pero no se exportan)
+ID_COLUMNS = ['Area Code', 'Area', 'Item Code', 'Item', 'Element Code', 'Element']
+
+# Columnas del dataset long exportado (01_FAOSTAT_Prices_Clean_Long.csv)
+LONG_OUTPUT_COLUMNS = ['Area', 'Item', 'Element', 'Year', 'Price', 'Region', 'Product_Category', 'YoY_Change']
+
+ID_DTYPES = {
+    'Area Code': 'int32',
+    'Area': 'str',
+    'Item Code': 'int32',
+    'Item': 'str',
+    'Element Code': 'int32',
+    'Element': 'str',
+}
 
 # =============================================================================
-# PASO 3: FILTRADO
+# LECTURA Y CACHÉ DEL DATASET PRINCIPAL
 # =============================================================================
 
-print("\n" + "=" * 60)
-print("PASO 3: FILTRADO POR ELEMENTO COMPARABLE")
-print("=" * 60)
+def is_year_value_column(col):
+    # Y1991 ... Y2024 (sin sufijo F de flag)
+    return col.startswith('Y') and col[1:].isdigit()
+
+
+def is_year_flag_column(col):
+    # Y1991F ... Y2024F
+    return col.startswith('Y') and col.endswith('F') and col[1:-1].isdigit()
+
+
+def new_quality_stats(flag_cols):
+    return {
+        'rows_total': 0,
+        'year_flag_cols': list(flag_cols),
+        'area_code_counts': pd.Series(dtype='int64'),
+        'item_code_counts': pd.Series(dtype='int64'),
+        'element_code_counts': pd.Series(dtype='int64'),
+        'flag_counts': pd.Series(dtype='int64', index=pd.MultiIndex.from_arrays(
+            [[], [], []], names=['Element Code', 'Year', 'Flag'])),
+    }
+
+
+def profile_chunk(stats, chunk):
+    """
+    Acumula en stats el perfil de calidad de un bloque del dataset completo
+    (antes del filtro de elemento): filas por código de área, producto y
+    elemento, y conteo de celdas por (Element Code, Year, Flag). Los valores
+    observados sin flag cuentan como NO_FLAG. Se puede llamar con bloques
+    sucesivos de cualquier origen (lectura por bloques, streaming).
+    """
+    stats['rows_total'] += len(chunk)
+    for key, col in (('area_code_counts', 'Area Code'), ('item_code_counts', 'Item Code'),
+                     ('element_code_counts', 'Element Code')):
+        stats[key] = stats[key].add(chunk[col].value_counts(), fill_value=0)
+
+    elements, element_codes = pd.factorize(chunk['Element Code'])
+    parts = []
+    for flag_col in stats['year_flag_cols']:
+        flags = chunk[flag_col]
+        if not isinstance(flags.dtype, pd.CategoricalDtype):
+            flags = flags.astype('category')
+        labels = np.array(list(flags.cat.categories) + [NO_FLAG], dtype=object)
+        codes = flags.cat.codes.to_numpy().astype('int64')
+        value_col = flag_col[:-1]
+        if value_col in chunk.columns:
+            codes[(codes < 0) & chunk[value_col].notna().to_numpy()] = len(labels) - 1
+
+        counted = codes >= 0
+        counts = np.bincount(elements[counted] * len(labels) + codes[counted],
+                             minlength=len(element_codes) * len(labels))
+        present = np.flatnonzero(counts)
+        parts.append(pd.DataFrame({
+            'Element Code': np.asarray(element_codes)[present // len(labels)],
+            'Year': int(flag_col[1:-1]),
+            'Flag': labels[present % len(labels)],
+            'count': counts[present],
+        }))
+    if parts:
+        chunk_counts = pd.concat(parts).set_index(['Element Code', 'Year', 'Flag'])['count']
+        stats['flag_counts'] = stats['flag_counts'].add(chunk_counts, fill_value=0)
+
+
+def finish_quality_stats(stats):
+    # add() con fill_value deja los conteos en float
+    for key in ('area_code_counts', 'item_code_counts', 'element_code_counts', 'flag_counts'):
+        stats[key] = stats[key].astype('int64')
+    return stats
+
+
+def load_main_dataset(path, element_codes, chunksize=CHUNK_SIZE, value_dtype=PRICE_DTYPE):
+    """
+    Lee el dataset principal por bloques aplicando el filtro de elemento
+    durante la lectura (element_codes = ALL_ELEMENTS para no filtrar). Solo
+    se parsean las columnas ID, las de valores por año y las de flags
+    (Y####F, como categóricas); las flags se usan para el perfil de calidad
+    de cada bloque y se conservan, todas con las mismas categorías, para
+    la columna Flag del formato long.
+
+    Devuelve (df_filtrado, stats) donde stats es el perfil de calidad del
+    archivo completo (antes del filtro) para el PASO 2. Las columnas de
+    texto (Area, Item, Element) se devuelven como categóricas.
+    """
+    header = pd.read_csv(path, encoding='latin-1', nrows=0).columns
+    year_cols = [col for col in header if is_year_value_column(col)]
+    flag_cols = [col for col in header if is_year_flag_column(col)]
+    dtypes = dict(ID_DTYPES)
+    dtypes.update({col: value_dtype for col in year_cols})
+    dtypes.update({col: 'category' for col in flag_cols})
+
+    stats = new_quality_stats(flag_cols)
+
+    chunks = []
+    reader = pd.read_csv(
+        path,
+        encoding='latin-1',
+        usecols=ID_COLUMNS + year_cols + flag_cols,
+        dtype=dtypes,
+        chunksize=chunksize,
+        # Cada bloque se parsea de una vez: con low_memory el parser lo
+        # trocea y una columna de flags vacía en un trozo no se puede unir
+        # como categórica con el resto
+        low_memory=False,
+    )
+    for chunk in reader:
+        profile_chunk(stats, chunk)
+
+        if element_codes != ALL_ELEMENTS:
+            chunk = chunk[chunk['Element Code'].isin(element_codes)]
+        chunk = chunk[ID_COLUMNS + year_cols + flag_cols]
+        if len(chunk) > 0:
+            chunks.append(chunk)
+
+    # Categorías de flags comunes a todos los bloques y columnas (concatenar
+    # categóricas con categorías distintas daría columnas de texto)
+    flag_categories = sorted({str(flag) for chunk in chunks for col in flag_cols
+                              for flag in chunk[col].cat.categories})
+    for chunk in chunks:
+        for col in flag_cols:
+            chunk[col] = chunk[col].cat.set_categories(flag_categories)
+
+    if chunks:
+        df = pd.concat(chunks, ignore_index=True)
+    else:
+        df = pd.DataFrame({col: pd.Series(dtype=dtypes[col]) for col in ID_COLUMNS + year_cols + flag_cols})
+    df = df[ID_COLUMNS + year_cols + flag_cols]
+    for col, dtype in ID_DTYPES.items():
+        if dtype == 'str':
+            df[col] = df[col].astype('category')
+
+    return df, finish_quality_stats(stats)
+
+
+def file_fingerprint(path, with_hash=True):
+    # Tamaño, mtime y (opcionalmente) hash del contenido del archivo
+    st = os.stat(path)
+    fingerprint = {'size': st.st_size, 'mtime_ns': st.st_mtime_ns}
+    if with_hash:
+        digest = hashlib.blake2b(digest_size=16)
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(8 * 1024 * 1024), b''):
+                digest.update(block)
+        fingerprint['hash'] = digest.hexdigest()
+    return fingerprint
+
+
+def normalize_element_codes(element_codes):
+    # ALL_ELEMENTS o lista ordenada de códigos enteros sin duplicados
+    if element_codes == ALL_ELEMENTS:
+        return ALL_ELEMENTS
+    return sorted({int(code) for code in element_codes})
+
+
+def _cache_dir_for(cache_folder, element_codes):
+    element_codes = normalize_element_codes(element_codes)
+    codes = element_codes if element_codes == ALL_ELEMENTS else '-'.join(str(code) for code in element_codes)
+    return os.path.join(cache_folder, f'main_{codes}')
+
+
+def _read_cache_manifest(cache_dir):
+    manifest_path = os.path.join(cache_dir, 'manifest.json')
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def _update_cache_manifest(cache_dir, manifest):
+    # Reescribe el manifest de una caché existente (archivo temporal + rename)
+    manifest_path = os.path.join(cache_dir, 'manifest.json')
+    with open(manifest_path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(manifest, f)
+    os.replace(manifest_path + '.tmp', manifest_path)
+
+
+def _cache_is_valid(manifest, path, element_codes, value_dtype):
+    """
+    Compara el manifest con el archivo de origen: si el tamaño cambia la
+    caché no vale; si coinciden tamaño y mtime vale sin leer el archivo. Solo
+    si cambia el mtime se verifica el hash del contenido, de modo que un
+    archivo reescrito pero idéntico sigue siendo válido (el nuevo mtime se
+    anota en manifest['source'] para no volver a calcular el hash).
+    """
+    if manifest is None:
+        return False
+    if manifest.get('version') != CACHE_FORMAT_VERSION:
+        return False
+    if manifest.get('element_codes') != normalize_element_codes(element_codes):
+        return False
+    if manifest.get('value_dtype') != value_dtype:
+        return False
+    source = manifest['source']
+    current = file_fingerprint(path, with_hash=False)
+    if current['size'] != source['size']:
+        return False
+    if current['mtime_ns'] == source['mtime_ns']:
+        return True
+    if file_fingerprint(path)['hash'] != source['hash']:
+        return False
+    source['mtime_ns'] = current['mtime_ns']
+    return True
+
+
+def _write_cache(cache_dir, df, stats, fingerprint, element_codes, value_dtype):
+    # Se escribe en un directorio temporal y se renombra al final, para que
+    # una ejecución interrumpida nunca deje una caché a medias
+    tmp_dir = cache_dir + '.tmp'
+    if os.path.exists(tmp_dir):
+        shutil.rmtree(tmp_dir)
+    os.makedirs(tmp_dir)
+
+    columns = []
+    for i, col in enumerate(df.columns):
+        filename = f'col_{i:03d}.npy'
+        series = df[col]
+        if pd.api.types.is_numeric_dtype(series):
+            np.save(os.path.join(tmp_dir, filename), series.to_numpy())
+            columns.append({'name': col, 'file': filename, 'kind': 'numeric'})
+        else:
+            # Columnas de texto: códigos enteros + diccionario (categorías ordenadas)
+            categorical = series.astype('category')
+            np.save(os.path.join(tmp_dir, filename), categorical.cat.codes.to_numpy().astype('int32'))
+            columns.append({'name': col, 'file': filename, 'kind': 'categorical',
+                            'categories': [str(v) for v in categorical.cat.categories]})
+
+    manifest = {
+        'version': CACHE_FORMAT_VERSION,
+        'source': fingerprint,
+        'element_codes': normalize_element_codes(element_codes),
+        'value_dtype': value_dtype,
+        'rows': len(df),
+        'columns': columns,
+        'stats': {
+            'rows_total': int(stats['rows_total']),
+            'year_flag_cols': stats['year_flag_cols'],
+            'area_code_counts': {str(k): int(v) for k, v in stats['area_code_counts'].items()},
+            'item_code_counts': {str(k): int(v) for k, v in stats['item_code_counts'].items()},
+            'element_code_counts': {str(k): int(v) for k, v in stats['element_code_counts'].items()},
+            'flag_counts': [[int(e), int(y), str(f), int(c)] for (e, y, f), c in stats['flag_counts'].items()],
+        },
+    }
+    with open(os.path.join(tmp_dir, 'manifest.json'), 'w', encoding='utf-8') as f:
+        json.dump(manifest, f)
+
+    if os.path.exists(cache_dir):
+        shutil.rmtree(cache_dir)
+    os.replace(tmp_dir, cache_dir)
+
+
+def _read_cache(cache_dir, manifest):
+    data = {}
+    for column in manifest['columns']:
+        values = np.load(os.path.join(cache_dir, column['file']), mmap_mode='r')
+        if column['kind'] == 'numeric':
+            data[column['name']] = values
+        else:
+            data[column['name']] = pd.Categorical.from_codes(np.asarray(values), column['categories'])
+    df = pd.DataFrame(data)
+
+    cached = manifest['stats']
+    stats = new_quality_stats(cached['year_flag_cols'])
+    stats['rows_total'] = cached['rows_total']
+    for key in ('area_code_counts', 'item_code_counts', 'element_code_counts'):
+        stats[key] = pd.Series({int(k): v for k, v in cached[key].items()}, dtype='int64')
+    if cached['flag_counts']:
+        flag_counts = pd.DataFrame(cached['flag_counts'], columns=['Element Code', 'Year', 'Flag', 'count'])
+        stats['flag_counts'] = flag_counts.set_index(['Element Code', 'Year', 'Flag'])['count']
+    return df, stats
 
-# Filtrar solo Producer Price Index (5539) para comparabilidad internacional
-ELEMENT_CODE_PPI = 5539
-df_filtered = df_main[df_main['Element Code'] == ELEMENT_CODE_PPI].copy()
 
-print(f"Filtrado por Element Code {ELEMENT_CODE_PPI} (Producer Price Index)")
-print(f"  - Registros antes: {len(df_main):,}")
-print(f"  - Registros después: {len(df_filtered):,}")
-print(f"  - Países únicos: {df_filtered['Area'].nunique()}")
-print(f"  - Productos únicos: {df_filtered['Item'].nunique()}")
+def load_main_dataset_cached(path, element_codes, cache_folder=CACHE_FOLDER, value_dtype=PRICE_DTYPE):
+    """
+    Capa de caché delante de load_main_dataset(). Devuelve (df, stats, hit)
+    donde hit indica si se ha evitado el parseo del CSV.
+    """
+    cache_dir = _cache_dir_for(cache_folder, element_codes)
+    manifest = _read_cache_manifest(cache_dir)
+    mtime_ns = None if manifest is None else manifest['source']['mtime_ns']
+    if _cache_is_valid(manifest, path, element_codes, value_dtype):
+        if manifest['source']['mtime_ns'] != mtime_ns:
+            _update_cache_manifest(cache_dir, manifest)
+        df, stats = _read_cache(cache_dir, manifest)
+        return df, stats, True
+
+    fingerprint = file_fingerprint(path)
+    df, stats = load_main_dataset(path, element_codes, value_dtype=value_dtype)
+    _write_cache(cache_dir, df, stats, fingerprint, element_codes, value_dtype)
+    return df, stats, False
+
 
 # =============================================================================
-# PASO 4: RESHAPE A FORMATO LONG
+# CALIDAD DE DATOS
 # =============================================================================
 
-print("\n" + "=" * 60)
-print("PASO 4: TRANSFORMACIÓN A FORMATO LONG")
-print("=" * 60)
+def code_integrity(code_counts, aux_codes):
+    # Integridad referencial de una columna de códigos frente a su auxiliar
+    aux_codes = {int(code) for code in aux_codes}
+    missing = sorted(int(code) for code in code_counts.index if int(code) not in aux_codes)
+    return {
+        'ok': not missing,
+        'codes_in_main': len(code_counts),
+        'codes_in_auxiliary': len(aux_codes),
+        'missing_codes': missing,
+        'rows_with_missing_codes': int(code_counts[code_counts.index.isin(missing)].sum()),
+    }
+
+
+def build_quality_report(stats, aux_tables):
+    """
+    Informe de calidad a partir del perfil acumulado por profile_chunk() y
+    los auxiliares: integridad de códigos de área, producto, elemento y
+    flag, filas por elemento, filas con M49 y distribución Flag x Year x
+    Element (conteos y cuota dentro de cada elemento y año).
+    """
+    df_area_codes = aux_tables['areas']
+    flags = aux_tables['flags']
+    flag_descriptions = dict(zip(flags['Flag'].astype(str), flags['Description']))
+    element_names = dict(zip(aux_tables['elements']['Element Code'].astype(int), aux_tables['elements']['Element']))
 
-# Identificar columnas de años (valores) y columnas de flags
-year_value_cols = [col for col in df_filtered.columns if col.startswith('Y') and col[1:].isdigit() and not col.endswith('F')]
-year_flag_cols = [col for col in df_filtered.columns if col.startswith('Y') and col.endswith('F')]
+    flag_counts = stats['flag_counts']
+    flags_in_main = sorted(set(flag_counts.index.get_level_values('Flag')) - {NO_FLAG})
+    unknown_flags = [flag for flag in flags_in_main if flag not in flag_descriptions]
 
-print(f"Columnas de valores identificadas: {len(year_value_cols)} (Y1991 a Y2024)")
-print(f"Columnas de flags identificadas: {len(year_flag_cols)} (no se usan en cálculos)")
+    # Filas cuyo Area Code tiene M49 en el auxiliar (sin materializar un merge)
+    area_code_counts = stats['area_code_counts']
+    m49_available = set(df_area_codes.loc[df_area_codes['M49 Code'].notna(), 'Area Code'])
 
-# Seleccionar solo columnas necesarias para el reshape
-id_columns = ['Area Code', 'Area', 'Item Code', 'Item', 'Element Code', 'Element']
-df_for_melt = df_filtered[id_columns + year_value_cols].copy()
+    distribution = flag_counts.rename('count').reset_index()
+    cell_totals = distribution.groupby(['Element Code', 'Year'])['count'].transform('sum')
+    distribution['share'] = (distribution['count'] / cell_totals).round(4)
+    distribution = distribution.sort_values(['Element Code', 'Year', 'Flag'])
 
-# Pivotear a formato long
-df_long = df_for_melt.melt(
-    id_vars=id_columns,
-    value_vars=year_value_cols,
-    var_name='Year',
-    value_name='Price'
-)
+    flag_totals = flag_counts.groupby(level='Flag').sum()
+    return {
+        'rows_total': int(stats['rows_total']),
+        'integrity': {
+            'area_codes': code_integrity(area_code_counts, df_area_codes['Area Code']),
+            'item_codes': code_integrity(stats['item_code_counts'], aux_tables['items']['Item Code']),
+            'element_codes': code_integrity(stats['element_code_counts'], aux_tables['elements']['Element Code']),
+            'flags': {'ok': not unknown_flags, 'flags_in_main': flags_in_main,
+                      'flags_in_auxiliary': sorted(flag_descriptions), 'unknown_flags': unknown_flags},
+        },
+        'm49_rows': int(area_code_counts[area_code_counts.index.isin(m49_available)].sum()),
+        'rows_per_element': [
+            {'element_code': int(code), 'element': element_names.get(int(code)),
+             'rows': int(stats['element_code_counts'].get(code, 0))}
+            for code in sorted(set(element_names) | set(int(c) for c in stats['element_code_counts'].index))
+        ],
+        'flag_totals': [
+            {'flag': flag, 'description': flag_descriptions.get(flag), 'cells': int(count),
+             'share': round(count / flag_totals.sum(), 4)}
+            for flag, count in flag_totals.sort_values(ascending=False).items()
+        ],
+        'flag_distribution': [
+            {'element_code': int(row['Element Code']), 'year': int(row['Year']), 'flag': row['Flag'],
+             'cells': int(row['count']), 'share': float(row['share'])}
+            for _, row in distribution.iterrows()
+        ],
+    }
 
-# Limpiar columna Year
-df_long['Year'] = df_long['Year'].str.replace('Y', '').astype(int)
 
-# Simplificar estructura final
-df_long = df_long[['Area', 'Item', 'Element', 'Year', 'Price']].copy()
+def write_quality_report(path, report):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
 
-print(f"Transformación completada:")
-print(f"  - Registros en formato long: {len(df_long):,}")
-print(f"  - Estructura: {list(df_long.columns)}")
 
 # =============================================================================
-# PASO 5: LIMPIEZA DE DATOS
+# RESHAPE A FORMATO LONG
 # =============================================================================
 
-print("\n" + "=" * 60)
-print("PASO 5: LIMPIEZA DE DATOS")
-print("=" * 60)
+def reshape_to_long(df_wide, year_cols, id_columns=ID_COLUMNS):
+    """
+    Wide -> long directamente desde el bloque 2-D de valores Y####.
 
-# Contar valores faltantes antes
-missing_before = df_long['Price'].isna().sum()
-total_before = len(df_long)
+    Solo se materializan las celdas observadas (máscara de no nulos): el año
+    sale del índice de columna y las columnas ID se repiten por posición
+    (las categóricas, por código). Flag es la de la columna Y####F de cada
+    celda (NaN sin flag o sin esa columna). El orden de filas es el de
+    melt() seguido de dropna(): año a año y, dentro de cada año, fila a fila.
 
-print(f"Valores faltantes antes de limpieza: {missing_before:,} / {total_before:,} ({missing_before/total_before*100:.1f}%)")
+    Devuelve (df_long, total_celdas).
+    """
+    # (años x filas): para un bloque float homogéneo es la disposición
+    # interna de pandas, así que no se copia
+    values = df_wide[year_cols].to_numpy().T
+    observed = ~np.isnan(values)
+    year_idx, row_idx = np.nonzero(observed)
+    year_numbers = np.array([int(col[1:]) for col in year_cols], dtype='int16')
 
-# Eliminar filas con Price nulo (NO interpolamos)
-df_clean = df_long.dropna(subset=['Price']).copy()
+    data = {}
+    for col in id_columns:
+        series = df_wide[col]
+        if isinstance(series.dtype, pd.CategoricalDtype):
+            data[col] = pd.Categorical.from_codes(
+                series.cat.codes.to_numpy()[row_idx], series.cat.categories)
+        else:
+            data[col] = series.to_numpy()[row_idx]
+    data['Year'] = year_numbers[year_idx]
+    data['Price'] = values[observed]
 
-# Verificar después
-missing_after = df_clean['Price'].isna().sum()
-total_after = len(df_clean)
+    # Flags de las celdas observadas, año a año (year_idx va ordenado)
+    flag_cols = [col + 'F' for col in year_cols if col + 'F' in df_wide.columns]
+    flag_categories = sorted({str(flag) for col in flag_cols for flag in df_wide[col].astype('category').cat.categories})
+    flag_codes = np.full(len(row_idx), -1, dtype='int16')
+    bounds = np.searchsorted(year_idx, np.arange(len(year_cols) + 1))
+    for i, col in enumerate(year_cols):
+        if col + 'F' in df_wide.columns:
+            codes = df_wide[col + 'F'].astype('category').cat.set_categories(flag_categories).cat.codes.to_numpy()
+            flag_codes[bounds[i]:bounds[i + 1]] = codes[row_idx[bounds[i]:bounds[i + 1]]]
+    data['Flag'] = pd.Categorical.from_codes(flag_codes, flag_categories)
 
-print(f"Registros después de eliminar nulos: {total_after:,}")
-print(f"Registros eliminados: {total_before - total_after:,}")
+    return pd.DataFrame(data), values.size
 
-# Verificar rango de años con datos
-year_coverage = df_clean.groupby('Year').size()
-print(f"Cobertura temporal: {df_clean['Year'].min()} - {df_clean['Year'].max()}")
-print(f"Años con datos: {len(year_coverage)}")
 
 # =============================================================================
-# PASO 6: CÁLCULO DE MÉTRICAS
+# CLASIFICACIÓN POR REGIÓN Y CATEGORÍA DE PRODUCTO
 # =============================================================================
 
-print("\n" + "=" * 60)
-print("PASO 6: CÁLCULO DE MÉTRICAS")
-print("=" * 60)
+def fix_encoding(name):
+    # Repara texto UTF-8 leído como latin-1 ('TÃ¼rkiye' -> 'Türkiye')
+    name = str(name)
+    try:
+        return name.encode('latin-1').decode('utf-8')
+    except (UnicodeEncodeError, UnicodeDecodeError):
+        return name
+
+
+def normalize_name(name):
+    """
+    Normaliza un nombre FAOSTAT para compararlo con los mappings: repara la
+    codificación, unifica ';' y ',' (las ediciones recientes usan
+    'Meat of sheep; fresh or chilled'), espacios y mayúsculas.
+    """
+    name = unicodedata.normalize('NFC', fix_encoding(name)).replace(';', ',')
+    return ' '.join(name.split()).casefold()
+
+
+def build_name_index(mapping):
+    # Invierte {grupo: [nombres]} en {nombre normalizado: grupo}. Si un
+    # nombre aparece en varios grupos gana el primero (como en el bucle original)
+    index = {}
+    for group, names in mapping.items():
+        for name in names:
+            index.setdefault(normalize_name(name), group)
+    return index
+
+
+def build_code_index(df_codes, code_col, name_col, name_index):
+    # {código FAO: grupo} a partir del archivo auxiliar de códigos
+    return {
+        int(code): name_index.get(normalize_name(name))
+        for code, name in zip(df_codes[code_col], df_codes[name_col])
+    }
+
+
+def classify_by_code(codes, names, code_index, name_index, default='Other'):
+    """
+    Clasifica cada código distinto una sola vez y propaga el resultado a
+    todas las filas mediante los índices de factorize. Se usa el código
+    estable del archivo auxiliar; si el código no está en el auxiliar (o su
+    nombre no está en el mapping) se intenta con el nombre del dataset.
+
+    Devuelve (Categorical con la etiqueta de cada fila, DataFrame de
+    códigos sin clasificar).
+    """
+    inverse, uniques = pd.factorize(codes)
+    first_rows = np.unique(inverse, return_index=True)[1]
+    unique_names = np.asarray(names)[first_rows]
+
+    labels = []
+    unmapped = []
+    for code, name in zip(uniques, unique_names):
+        group = code_index.get(int(code))
+        if group is None:
+            group = name_index.get(normalize_name(name))
+        if group is None:
+            group = default
+            unmapped.append((int(code), name, int(code) in code_index))
+        labels.append(group)
+
+    categories = sorted(set(labels))
+    label_codes = np.array([categories.index(label) for label in labels], dtype='int8')
+    row_labels = pd.Categorical.from_codes(label_codes[inverse], categories)
+    unmapped = pd.DataFrame(unmapped, columns=['Code', 'Name', 'In_Auxiliary'])
+    return row_labels, unmapped
+
 
-# --- 6.1: Asignación de regiones geográficas ---
-print("\n6.1 Asignando regiones geográficas...")
+def print_unmapped(unmapped, label, limit=10):
+    if len(unmapped) == 0:
+        print(f"  Todos los códigos de {label} están clasificados")
+        return
+    print(f"  Códigos de {label} sin clasificar (-> 'Other'): {len(unmapped)}")
+    for _, row in unmapped.head(limit).iterrows():
+        origin = '' if row['In_Auxiliary'] else ' [no está en el auxiliar]'
+        print(f"    - {row['Code']}: {fix_encoding(row['Name'])}{origin}")
+    if len(unmapped) > limit:
+        print(f"    ... y {len(unmapped) - limit} más")
 
+
+# Regiones geográficas (6.1)
 REGION_MAPPING = {
     'Africa': [
         'Algeria', 'Angola', 'Benin', 'Botswana', 'Burkina Faso', 'Burundi',
@@ -248,22 +791,7 @@ REGION_MAPPING = {
     ]
 }
 
-def assign_region(area):
-    for region, countries in REGION_MAPPING.items():
-        if area in countries:
-            return region
-    return 'Other'
-
-df_clean['Region'] = df_clean['Area'].apply(assign_region)
-
-region_distribution = df_clean.groupby('Region')['Area'].nunique()
-print("Distribución por región:")
-for region, count in region_distribution.items():
-    print(f"  - {region}: {count} países")
-
-# --- 6.2: Categorización de productos ---
-print("\n6.2 Categorizando productos...")
-
+# Categorías de producto (6.2)
 PRODUCT_CATEGORIES = {
     'Cereals': [
         'Wheat', 'Rice', 'Maize (corn)', 'Barley', 'Sorghum', 'Millet',
@@ -408,189 +936,3245 @@ PRODUCT_CATEGORIES = {
     ]
 }
 
-def assign_category(item):
-    for category, items in PRODUCT_CATEGORIES.items():
-        if item in items:
-            return category
-    return 'Other'
 
-df_clean['Product_Category'] = df_clean['Item'].apply(assign_category)
+# =============================================================================
+# MODO INCREMENTAL: DETECCIÓN DE SERIES MODIFICADAS
+# =============================================================================
+
+def series_key(area_codes, item_codes):
+    # Clave entera única por serie (Area Code, Item Code)
+    return (np.asarray(area_codes, dtype='int64') << 32) | np.asarray(item_codes, dtype='int64')
+
+
+def config_fingerprint(trend_windows=TREND_WINDOWS, exclude_anomalies=EXCLUDE_ANOMALIES):
+    # Todo lo que, además de los datos, cambia el contenido de 01-05
+    payload = json.dumps({
+        'version': INCREMENTAL_STATE_VERSION,
+        'element': ELEMENT_CODE_PPI,
+        'price_dtype': PRICE_DTYPE,
+        'long_columns': LONG_OUTPUT_COLUMNS,
+        'trend_windows': [list(window) for window in trend_windows],
+        'quantiles': [QUANTILES, QUANTILE_RELATIVE_ACCURACY],
+        'metric_columns': [metric_columns(trend_windows), REGIONAL_COLUMNS],
+        'anomalies': [ANOMALY_WINDOW, ANOMALY_THRESHOLD, ANOMALY_MIN_OBSERVATIONS, ANOMALY_MIN_MAD_SHARE,
+                      ANOMALY_Z_SCALE] if exclude_anomalies else None,
+        'regions': REGION_MAPPING,
+        'categories': PRODUCT_CATEGORIES,
+        'classification_files': [file_fingerprint(f)['hash'] for f in CLASSIFICATION_FILES],
+    }, sort_keys=True, ensure_ascii=False)
+    return hashlib.blake2b(payload.encode('utf-8'), digest_size=16).hexdigest()
+
+
+def build_series_table(df):
+    """
+    Una fila por serie (Area Code, Item Code), en el mismo orden en que
+    aparecen en 01_FAOSTAT_Prices_Clean_Long.csv (Area, Item), con su número
+    de filas y un fingerprint del contenido (XOR de los hashes de sus filas,
+    independiente del orden). Devuelve (tabla, nombres_unicos): si dos series
+    comparten nombre de Area e Item sus filas se intercalan en el 01 y el
+    modo incremental no es aplicable.
+    """
+    series_ids = df.groupby(['Area Code', 'Item Code'], sort=True).ngroup().to_numpy()
+    row_hash = pd.util.hash_pandas_object(
+        df[['Area', 'Item', 'Element', 'Year', 'Price']], index=False).to_numpy()
+
+    n_series = int(series_ids.max()) + 1 if len(series_ids) else 0
+    fingerprints = np.zeros(n_series, dtype='uint64')
+    np.bitwise_xor.at(fingerprints, series_ids, row_hash)
+    first = np.unique(series_ids, return_index=True)[1]
+
+    table = pd.DataFrame({
+        'area_code': df['Area Code'].to_numpy()[first],
+        'item_code': df['Item Code'].to_numpy()[first],
+        'area_pos': df['Area'].cat.codes.to_numpy()[first],
+        'item_pos': df['Item'].cat.codes.to_numpy()[first],
+        'fingerprint': fingerprints,
+        'rows': np.bincount(series_ids, minlength=n_series),
+    })
+    order = np.lexsort((table['item_code'], table['area_code'], table['item_pos'], table['area_pos']))
+    table = table.iloc[order].reset_index(drop=True)
+    table['key'] = series_key(table['area_code'], table['item_code'])
+    names_unique = not table.duplicated(['area_pos', 'item_pos']).any()
+    return table, names_unique
+
+
+def _outputs_fingerprint():
+    fingerprints = {}
+    for name in [LONG_ARTIFACT] + list(METRIC_ARTIFACT_KEYS):
+        path = os.path.join(OUTPUT_FOLDER, name + '.csv')
+        if not os.path.exists(path):
+            return None
+        fingerprints[name] = file_fingerprint(path, with_hash=False)
+    return fingerprints
+
+
+def load_incremental_state():
+    manifest_path = os.path.join(INCREMENTAL_FOLDER, 'manifest.json')
+    series_path = os.path.join(INCREMENTAL_FOLDER, 'series.npz')
+    if not (os.path.exists(manifest_path) and os.path.exists(series_path)):
+        return None
+    with open(manifest_path, encoding='utf-8') as f:
+        manifest = json.load(f)
+    with np.load(series_path) as arrays:
+        series = pd.DataFrame({name: arrays[name] for name in arrays.files})
+    return manifest, series
+
+
+def save_incremental_state(table, starts, lengths, trend_windows=TREND_WINDOWS, exclude_anomalies=EXCLUDE_ANOMALIES):
+    os.makedirs(INCREMENTAL_FOLDER, exist_ok=True)
+    np.savez(
+        os.path.join(INCREMENTAL_FOLDER, 'series.npz'),
+        key=table['key'].to_numpy(),
+        fingerprint=table['fingerprint'].to_numpy(),
+        start=np.asarray(starts, dtype='int64'),
+        length=np.asarray(lengths, dtype='int64'),
+    )
+    manifest = {
+        'version': INCREMENTAL_STATE_VERSION,
+        'config': config_fingerprint(trend_windows, exclude_anomalies),
+        'outputs': _outputs_fingerprint(),
+    }
+    with open(os.path.join(INCREMENTAL_FOLDER, 'manifest.json'), 'w', encoding='utf-8') as f:
+        json.dump(manifest, f)
+
+
+def long_file_offsets(path, table):
+    # Offsets en bytes de cada serie dentro del 01 recién escrito (una línea
+    # por fila, series contiguas en el orden de la tabla)
+    data = np.memmap(path, dtype='uint8', mode='r')
+    line_ends = np.flatnonzero(data == ord('\n')) + 1
+    if len(line_ends) != int(table['rows'].sum()) + 1:
+        return None
+    ends = line_ends[1:][np.cumsum(table['rows'].to_numpy()) - 1]
+    starts = np.r_[line_ends[0], ends[:-1]]
+    return starts, ends - starts
+
+
+def _read_long_slices(path, starts, lengths, columns):
+    # Parsea solo los fragmentos del 01 anterior que corresponden a series concretas
+    with open(path, 'rb') as f:
+        header = f.readline()
+        parts = [header]
+        for start, length in zip(starts, lengths):
+            f.seek(int(start))
+            parts.append(f.read(int(length)))
+    return pd.read_csv(io.BytesIO(b''.join(parts)), usecols=columns,
+                       dtype={col: str for col in columns if col != 'Year'},
+                       keep_default_na=False)
+
+
+def rows_in_keys(df, keys, key_frame):
+    """
+    Máscara de las filas de df cuya combinación de claves está en key_frame.
+    Las claves categóricas se comparan por código (sin convertir df a texto)
+    y se combinan en un único entero en base mixta.
+    """
+    combined = np.zeros(len(df), dtype='int64')
+    targets = np.zeros(len(key_frame), dtype='int64')
+    valid = np.ones(len(key_frame), dtype=bool)
+    for key in keys:
+        column = df[key]
+        if isinstance(column.dtype, pd.CategoricalDtype):
+            values = column.cat.codes.to_numpy().astype('int64')
+            wanted = column.cat.categories.get_indexer(key_frame[key].astype(str))
+            base = len(column.cat.categories) + 1
+        else:
+            values = column.to_numpy().astype('int64')
+            wanted = key_frame[key].to_numpy().astype('int64')
+            base = int(max(values.max(initial=0), wanted.max(initial=0))) + 1
+        valid &= wanted >= 0
+        combined = combined * base + values
+        targets = targets * base + wanted
+    return np.isin(combined, targets[valid])
+
+
+def plan_incremental_update(df, table, names_unique, trend_windows=TREND_WINDOWS,
+                            exclude_anomalies=EXCLUDE_ANOMALIES):
+    """
+    Compara las series actuales con el manifest de la ejecución anterior.
+    Devuelve None si hay que recalcular todo (sin estado previo, cambió la
+    configuración o los mappings, o las salidas se modificaron fuera del
+    pipeline); si no, un dict con las series cambiadas, los grupos afectados
+    de cada artefacto y la máscara de filas necesarias para recalcularlos.
+    """
+    state = load_incremental_state()
+    if state is None:
+        print("  Sin estado de una ejecución anterior: se recalcula todo")
+        return None
+    manifest, old = state
+    if (manifest.get('version') != INCREMENTAL_STATE_VERSION
+            or manifest.get('config') != config_fingerprint(trend_windows, exclude_anomalies)):
+        print("  Cambió la configuración o los mappings: se recalcula todo")
+        return None
+    if manifest.get('outputs') != _outputs_fingerprint():
+        print("  Las salidas no coinciden con las de la última ejecución: se recalcula todo")
+        return None
+    if not names_unique:
+        print("  Hay series con el mismo nombre de Area e Item: se recalcula todo")
+        return None
+
+    merged = table[['key', 'fingerprint']].merge(
+        old[['key', 'fingerprint', 'start', 'length']], on='key', how='outer',
+        suffixes=('', '_old'), indicator=True)
+    changed = merged[(merged['_merge'] != 'both') | (merged['fingerprint'] != merged['fingerprint_old'])]
+    changed_keys = changed.loc[changed['_merge'] != 'right_only', 'key'].to_numpy()
+    stale = changed[changed['_merge'] != 'left_only']
+
+    # Filas anteriores (solo las de series cambiadas o eliminadas) y nuevas
+    key_columns = ['Area', 'Item', 'Region', 'Product_Category', 'Year']
+    old_rows = _read_long_slices(os.path.join(OUTPUT_FOLDER, LONG_ARTIFACT + '.csv'),
+                                 stale['start'], stale['length'], key_columns)
+    changed_mask = np.isin(series_key(df['Area Code'], df['Item Code']), changed_keys)
+    new_rows = df.loc[changed_mask, key_columns]
+    affected_rows = pd.concat([
+        old_rows,
+        pd.DataFrame({col: new_rows[col].astype(str) if col != 'Year' else new_rows[col]
+                      for col in key_columns}),
+    ], ignore_index=True)
+    affected_rows['Year'] = affected_rows['Year'].astype('int64')
+
+    affected = {}
+    row_mask = changed_mask.copy()
+    for name, keys in METRIC_ARTIFACT_KEYS.items():
+        affected[name] = affected_rows[keys].drop_duplicates().reset_index(drop=True)
+        row_mask |= rows_in_keys(df, keys, affected[name])
+
+    return {
+        'changed_keys': changed_keys,
+        'n_changed': int((changed['_merge'] == 'both').sum()),
+        'n_added': int((changed['_merge'] == 'left_only').sum()),
+        'n_removed': int((changed['_merge'] == 'right_only').sum()),
+        'old_series': old,
+        'affected': affected,
+        'row_mask': row_mask,
+    }
+
+
+def patch_metric_output(path, result, keys, affected):
+    """
+    Sustituye en un CSV de métricas existente las filas de los grupos
+    afectados por las recalculadas, manteniendo el orden por claves.
+    """
+    value_columns = [col for col in result.columns if col not in keys]
+    old = pd.read_csv(path, keep_default_na=False, float_precision='round_trip',
+                      na_values={col: [''] for col in value_columns},
+                      dtype={key: str for key in keys if key != 'Year'})
+
+    def key_index(frame):
+        return pd.MultiIndex.from_arrays([
+            frame[key].astype('int64') if key == 'Year' else frame[key].astype(str)
+            for key in keys
+        ])
+
+    affected_index = key_index(affected)
+    fresh = result[key_index(result).isin(affected_index)].copy()
+    for key in keys:
+        fresh[key] = fresh[key].astype('int64') if key == 'Year' else fresh[key].astype(str)
+    kept = old[~key_index(old).isin(affected_index)]
+
+    patched = pd.concat([kept, fresh], ignore_index=True).sort_values(keys, kind='stable')
+    patched.to_csv(path, index=False)
+    return len(patched), len(fresh)
+
+
+def patch_long_output(path, table, plan, df_changed):
+    """
+    Reescribe el 01 copiando byte a byte los fragmentos de las series sin
+    cambios desde el archivo anterior e intercalando, en su posición, el CSV
+    de las series cambiadas. Devuelve los offsets nuevos de cada serie.
+    """
+    changed_text = df_changed[LONG_OUTPUT_COLUMNS].to_csv(header=False, index=False).encode('utf-8')
+    changed_ends = np.flatnonzero(np.frombuffer(changed_text, dtype='uint8') == ord('\n')) + 1
+
+    is_changed = np.isin(table['key'].to_numpy(), plan['changed_keys'])
+    changed_ends = changed_ends[np.cumsum(table.loc[is_changed, 'rows'].to_numpy()) - 1]
+    changed_starts = np.r_[0, changed_ends[:-1]]
+
+    old = plan['old_series'].set_index('key')
+    old_starts = old['start'].reindex(table['key']).to_numpy()
+    old_lengths = old['length'].reindex(table['key']).to_numpy()
+
+    new_starts = np.zeros(len(table), dtype='int64')
+    new_lengths = np.zeros(len(table), dtype='int64')
+    tmp_path = path + '.tmp'
+    with open(path, 'rb') as src, open(tmp_path, 'wb') as dst:
+        header = src.readline()
+        dst.write(header)
+        position = len(header)
+        pending = None  # tramo contiguo del archivo anterior aún sin copiar
+        changed_pos = 0
+        for i, changed in enumerate(is_changed):
+            if changed:
+                if pending:
+                    src.seek(pending[0])
+                    dst.write(src.read(pending[1] - pending[0]))
+                    pending = None
+                start, end = changed_starts[changed_pos], changed_ends[changed_pos]
+                changed_pos += 1
+                dst.write(changed_text[start:end])
+                length = int(end - start)
+            else:
+                start, length = int(old_starts[i]), int(old_lengths[i])
+                if pending and pending[1] == start:
+                    pending[1] = start + length
+                else:
+                    if pending:
+                        src.seek(pending[0])
+                        dst.write(src.read(pending[1] - pending[0]))
+                    pending = [start, start + length]
+            new_starts[i] = position
+            new_lengths[i] = length
+            position += length
+        if pending:
+            src.seek(pending[0])
+            dst.write(src.read(pending[1] - pending[0]))
+    os.replace(tmp_path, path)
+    return new_starts, new_lengths
+
+
+# =============================================================================
+# SKETCHES DE CUANTILES
+# =============================================================================
+# Percentiles por grupo con un sketch de cubetas logarítmicas (estilo
+# DDSketch): cada precio cae en la cubeta ceil(log_gamma(|precio|)) y el
+# sketch de un grupo son los conteos de sus cubetas no vacías. El valor de
+# un cuantil tiene un error relativo <= QUANTILE_RELATIVE_ACCURACY, la
+# memoria depende del rango de precios y no del número de filas, y el
+# resultado no depende del orden de las filas. Los shards de --workers y los
+# lotes de DuckDB contienen grupos completos, así que cada sketch se
+# construye de una vez.
+
+_SKETCH_GAMMA = (1 + QUANTILE_RELATIVE_ACCURACY) / (1 - QUANTILE_RELATIVE_ACCURACY)
+# Cubetas como enteros ordenables: positivas > 0 (precio 0) > negativas
+_SKETCH_KEY_OFFSET = 1 << 20
+_SKETCH_KEY_SPAN = 1 << 22
+
+
+def sketch_keys(prices):
+    # Cubeta de cada precio
+    prices = np.asarray(prices, dtype='float64')
+    keys = np.zeros(len(prices), dtype='int64')
+    nonzero = prices != 0
+    buckets = np.ceil(np.log(np.abs(prices[nonzero])) / np.log(_SKETCH_GAMMA)).astype('int64') + _SKETCH_KEY_OFFSET
+    keys[nonzero] = np.where(prices[nonzero] > 0, buckets, -buckets)
+    return keys
+
+
+def sketch_values(keys):
+    # Valor representativo de cada cubeta (a igual distancia relativa de
+    # sus dos extremos)
+    magnitude = 2 * _SKETCH_GAMMA ** (np.abs(keys) - _SKETCH_KEY_OFFSET) / (_SKETCH_GAMMA + 1)
+    return np.where(keys == 0, 0.0, np.sign(keys) * magnitude)
+
+
+def _sketch_from_counts(counts):
+    # counts: Series de conteos indexada por grupo * _SKETCH_KEY_SPAN + cubeta
+    counts = counts.sort_index()
+    packed = counts.index.to_numpy().astype('int64')
+    return {
+        'group': packed // _SKETCH_KEY_SPAN,
+        'key': packed % _SKETCH_KEY_SPAN - _SKETCH_KEY_SPAN // 2,
+        'count': counts.to_numpy().astype('int64'),
+    }
+
+
+def quantile_sketch(group_ids, prices):
+    """
+    Sketches de todos los grupos a partir de arrays (id de grupo y precio de
+    cada fila, en cualquier orden): dict con group, key y count, una entrada
+    por cubeta no vacía, ordenado por (group, key). Las filas se cuentan con
+    una tabla hash; solo se ordenan las cubetas.
+    """
+    packed = np.asarray(group_ids, dtype='int64') * _SKETCH_KEY_SPAN + sketch_keys(prices) + _SKETCH_KEY_SPAN // 2
+    return _sketch_from_counts(pd.Series(packed).value_counts(sort=False))
+
+
+def sketch_quantiles(sketch, quantiles=QUANTILES):
+    """
+    Cuantiles de cada grupo de un sketch: dict con 'group' (ids presentes,
+    ascendentes) y una entrada por columna de quantiles. El cuantil q es el
+    valor de la cubeta que contiene la fila de rango q * (n - 1) del grupo.
+    """
+    groups, starts = np.unique(sketch['group'], return_index=True)
+    result = {'group': groups}
+    if len(groups) == 0:
+        return dict(result, **{col: np.array([], dtype='float64') for col in quantiles})
+    counts = sketch['count']
+    cumulative = np.cumsum(counts)
+    before = cumulative[starts] - counts[starts]
+    totals = np.add.reduceat(counts, starts)
+    values = sketch_values(sketch['key'])
+    for col, q in quantiles.items():
+        rank = before + np.floor(q * (totals - 1)).astype('int64')
+        result[col] = values[np.searchsorted(cumulative, rank, side='right')]
+    return result
+
+
+# =============================================================================
+# MOTOR DE MÉTRICAS POR GRUPO (6.3-6.7)
+# =============================================================================
+
+def trend_column(start, end):
+    return f'Trend_{start}_{end}'
+
+
+def trend_columns(trend_windows=TREND_WINDOWS):
+    return [trend_column(start, end) for start, end in trend_windows]
+
+
+def metric_columns(trend_windows=TREND_WINDOWS):
+    # Columnas de calculate_group_metrics(): una de tendencia por ventana y
+    # los percentiles al final (las anteriores conservan su posición)
+    return (['Avg_Price', 'Min_Price', 'Max_Price', 'Volatility'] + trend_columns(trend_windows)
+            + ['Data_Points', 'Year_Min', 'Year_Max'] + list(QUANTILES))
+
+
+def first_price_matrix(group_ids, years, prices, n_groups):
+    """
+    Matriz grupo × año con el primer precio de cada (grupo, año), NaN si no
+    hay, a partir de filas ordenadas por (grupo, Year). Devuelve (matriz,
+    primer_año): la columna de un año es year - primer_año.
+    """
+    if len(years) == 0:
+        return np.full((n_groups, 0), np.nan), 0
+    year_min = int(years.min())
+    first = np.ones(len(years), dtype=bool)
+    first[1:] = (group_ids[1:] != group_ids[:-1]) | (years[1:] != years[:-1])
+    matrix = np.full((n_groups, int(years.max()) - year_min + 1), np.nan)
+    matrix[group_ids[first], years[first].astype('int64') - year_min] = prices[first]
+    return matrix, year_min
+
+
+def window_trend(first_prices, year_min, start, end):
+    # % de cambio entre el primer precio de start y el de end, por fila de
+    # first_prices (NaN si falta alguno o el de start no es > 0)
+    n_groups, n_years = first_prices.shape
+
+    def column(year):
+        position = year - year_min
+        return first_prices[:, position] if 0 <= position < n_years else np.full(n_groups, np.nan)
+
+    price_start, price_end = column(start), column(end)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(price_start > 0, ((price_end - price_start) / price_start) * 100, np.nan)
+
+
+def segment_metrics(group_ids, years, prices, trend_windows=TREND_WINDOWS):
+    """
+    Métricas por grupo (Avg/Min/Max, percentiles, volatilidad, tendencias,
+    cobertura) a partir de arrays: id de grupo, año y precio de cada fila.
+
+    Ordena una sola vez por (grupo, Year) con un sort estable y calcula todo
+    con reducciones por segmento de NumPy (reduceat), sin callbacks de Python
+    por grupo. Dentro de un mismo año se conserva el orden de entrada.
+    Devuelve un dict con 'group' (ids presentes, ascendentes) y una entrada
+    por columna de metric_columns(trend_windows).
+    """
+    prices = np.asarray(prices, dtype='float64')
+    order = np.lexsort((years, group_ids))
+    group_ids = group_ids[order]
+    years = years[order]
+    prices = prices[order]
+
+    if len(group_ids) == 0:
+        empty = np.array([], dtype='float64')
+        return dict({'group': np.array([], dtype='int64')},
+                    **{col: empty for col in metric_columns(trend_windows)})
+
+    starts = np.flatnonzero(np.r_[True, group_ids[1:] != group_ids[:-1]])
+    ends = np.r_[starts[1:], len(group_ids)]
+    counts = ends - starts
+    n_segments = len(starts)
+    segment_of_row = np.repeat(np.arange(n_segments), counts)
+
+    # Estadísticos básicos
+    avg_price = np.add.reduceat(prices, starts) / counts
+    min_price = np.minimum.reduceat(prices, starts)
+    max_price = np.maximum.reduceat(prices, starts)
+    quantiles = sketch_quantiles(quantile_sketch(segment_of_row, prices))
+
+    # Volatilidad: desviación estándar de los cambios % consecutivos dentro
+    # del grupo (solo si el precio anterior es > 0)
+    prev, curr = prices[:-1], prices[1:]
+    valid = (group_ids[1:] == group_ids[:-1]) & (prev > 0)
+    pct = ((curr[valid] - prev[valid]) / prev[valid]) * 100
+    pct_segments = segment_of_row[1:][valid]
+    pct_counts = np.bincount(pct_segments, minlength=n_segments)
 
-category_distribution = df_clean['Product_Category'].value_counts()
-print("Distribución por categoría de producto:")
-for category, count in category_distribution.head(15).items():
-    print(f"  - {category}: {count:,} registros")
+    volatility = np.full(n_segments, np.nan)
+    eligible = (counts >= 5) & (pct_counts >= 3)
+    if eligible.any():
+        keep = eligible[pct_segments]
+        pct = pct[keep]
+        pct_segments = pct_segments[keep]
+        pct_starts = np.flatnonzero(np.r_[True, pct_segments[1:] != pct_segments[:-1]])
+        seg_index = pct_segments[pct_starts]
+        seg_counts = pct_counts[seg_index]
+        seg_mean = np.add.reduceat(pct, pct_starts) / seg_counts
+        dev = pct - np.repeat(seg_mean, seg_counts)
+        volatility[seg_index] = np.sqrt(np.add.reduceat(dev * dev, pct_starts) / seg_counts)
 
-# --- 6.3: Variación interanual (Year-over-Year) ---
-print("\n6.3 Calculando variación interanual...")
+    # Tendencias: el primer precio de cada (grupo, año) en una matriz grupo ×
+    # año y, por ventana, una búsqueda por índice de año
+    first_prices, year_min = first_price_matrix(segment_of_row, years, prices, n_segments)
+    trends = {trend_column(start, end): window_trend(first_prices, year_min, start, end)
+              for start, end in trend_windows}
+
+    return {
+        'group': group_ids[starts].astype('int64'),
+        'Avg_Price': avg_price,
+        'Min_Price': min_price,
+        'Max_Price': max_price,
+        'Volatility': volatility,
+        **trends,
+        'Data_Points': counts.astype('float64'),
+        'Year_Min': years[starts].astype('float64'),
+        'Year_Max': years[ends - 1].astype('float64'),
+        **{col: quantiles[col] for col in QUANTILES},
+    }
 
-df_clean = df_clean.sort_values(['Area', 'Item', 'Year'])
 
-df_clean['Price_Lag'] = df_clean.groupby(['Area', 'Item'])['Price'].shift(1)
-df_clean['YoY_Change'] = ((df_clean['Price'] - df_clean['Price_Lag']) / df_clean['Price_Lag']) * 100
-df_clean['YoY_Change'] = df_clean['YoY_Change'].replace([np.inf, -np.inf], np.nan)
+def _segment_task(arrays, trend_windows):
+    return segment_metrics(arrays['group'], arrays['year'], arrays['price'], trend_windows)
 
-df_clean = df_clean.drop(columns=['Price_Lag'])
 
-yoy_valid = df_clean['YoY_Change'].notna().sum()
-print(f"Variaciones YoY calculadas: {yoy_valid:,} registros con valor válido")
+def _merge_group_results(df, keys, group_ids, parts, columns):
+    # Une los resultados parciales (grupos disjuntos) en orden de grupo y
+    # añade las columnas clave desde la primera fila de cada grupo
+    groups = np.concatenate([part['group'] for part in parts])
+    order = np.argsort(groups, kind='stable')
+    first_rows = np.unique(group_ids, return_index=True)[1]
+    result = df[keys].iloc[first_rows[groups[order]]].reset_index(drop=True)
+    for col in columns:
+        result[col] = np.concatenate([part[col] for part in parts])[order]
+    return result
 
-# --- 6.4: Métricas a nivel de país ---
-print("\n6.4 Calculando métricas a nivel de país...")
 
-def calculate_country_metrics(group):
-    prices = group.sort_values('Year')['Price'].values
-    years = group.sort_values('Year')['Year'].values
-    
-    # Volatilidad
-    if len(prices) >= 5:
-        pct_changes = []
-        for i in range(1, len(prices)):
-            if prices[i-1] > 0:
-                pct_changes.append(((prices[i] - prices[i-1]) / prices[i-1]) * 100)
-        volatility = np.std(pct_changes) if len(pct_changes) >= 3 else np.nan
+def calculate_group_metrics(df, keys, trend_windows=TREND_WINDOWS, pool=None, workers=1, shard_by=None):
+    """
+    Métricas de metric_columns(trend_windows) para cualquier combinación de
+    columnas clave.
+    Con pool, las filas se reparten en workers shards por la columna shard_by
+    (que debe determinar el grupo: Area para país, Item para producto) y cada
+    shard se calcula en un worker; el resultado es idéntico al secuencial.
+    """
+    group_ids = df.groupby(keys, sort=True, observed=True).ngroup().to_numpy()
+    years = df['Year'].to_numpy()
+    prices = df['Price'].to_numpy(dtype='float64')
+
+    if pool is None or len(df) == 0:
+        parts = [segment_metrics(group_ids, years, prices, trend_windows)]
     else:
-        volatility = np.nan
-    
-    # Tendencia 2010-2023
-    price_2010 = group[group['Year'] == 2010]['Price'].values
-    price_2023 = group[group['Year'] == 2023]['Price'].values
-    if len(price_2010) > 0 and len(price_2023) > 0 and price_2010[0] > 0:
-        trend = ((price_2023[0] - price_2010[0]) / price_2010[0]) * 100
+        parts, _ = run_sharded(
+            pool, _segment_task, {'group': group_ids, 'year': years, 'price': prices},
+            df[shard_by].cat.codes.to_numpy(), workers, task_args=(trend_windows,))
+    return _merge_group_results(df, keys, group_ids, parts, metric_columns(trend_windows))
+
+REGIONAL_STATS = {'Avg_Price': 'mean', 'Std_Price': 'std', 'Min_Price': 'min', 'Max_Price': 'max'}
+REGIONAL_COLUMNS = list(REGIONAL_STATS) + ['Count'] + list(QUANTILES)
+
+
+def regional_stats(group_ids, prices):
+    # mean/std/min/max/count por celda con los kernels de groupby de pandas
+    # (mismo orden de filas dentro de cada celda que el cálculo secuencial)
+    # y percentiles con sketches
+    stats = pd.Series(prices).groupby(group_ids, sort=True).agg(['mean', 'std', 'min', 'max', 'count'])
+    result = {'group': stats.index.to_numpy().astype('int64')}
+    for col, stat in REGIONAL_STATS.items():
+        result[col] = stats[stat].to_numpy()
+    quantiles = sketch_quantiles(quantile_sketch(group_ids, prices))
+    result['Count'] = stats['count'].to_numpy()
+    result.update({col: quantiles[col] for col in QUANTILES})
+    return result
+
+
+def _regional_task(arrays):
+    return regional_stats(arrays['group'], arrays['price'])
+
+
+def calculate_regional_aggregates(df, pool=None, workers=1):
+    keys = ['Element Code', 'Region', 'Year', 'Product_Category']
+    group_ids = df.groupby(keys, sort=True, observed=True).ngroup().to_numpy()
+    prices = df['Price'].to_numpy()
+
+    if pool is None or len(df) == 0:
+        parts = [regional_stats(group_ids, prices)]
     else:
-        trend = np.nan
-    
-    return pd.Series({
-        'Avg_Price': np.mean(prices),
-        'Min_Price': np.min(prices),
-        'Max_Price': np.max(prices),
-        'Volatility': volatility,
-        'Trend_2010_2023': trend,
-        'Data_Points': len(prices),
-        'Year_Min': int(np.min(years)),
-        'Year_Max': int(np.max(years))
-    })
+        # Cada celda pertenece a un único par (Region, Product_Category)
+        # (dentro de un par puede haber varios elementos)
+        shard_codes = (df['Region'].cat.codes.to_numpy().astype('int64') * len(df['Product_Category'].cat.categories)
+                       + df['Product_Category'].cat.codes.to_numpy())
+        parts, _ = run_sharded(pool, _regional_task, {'group': group_ids, 'price': prices},
+                               shard_codes, workers)
+    return _merge_group_results(df, keys, group_ids, parts, REGIONAL_COLUMNS)
 
-country_metrics = df_clean.groupby(['Area', 'Region']).apply(
-    calculate_country_metrics, include_groups=False
-).reset_index()
 
-# Redondear valores
-for col in ['Avg_Price', 'Min_Price', 'Max_Price', 'Volatility', 'Trend_2010_2023']:
-    country_metrics[col] = country_metrics[col].round(2)
+def round_metrics(df, trend_windows=()):
+    # Precios de las tablas 02-05 a 2 decimales (se omiten las columnas que
+    # df no tiene: Std_Price solo está en 04, Volatility y tendencias no)
+    columns = ['Avg_Price', 'Std_Price', 'Min_Price', 'Max_Price', 'Volatility'] + list(QUANTILES)
+    for col in columns + trend_columns(trend_windows):
+        if col in df.columns:
+            df[col] = df[col].round(2)
+    return df
 
-print(f"Métricas calculadas para {len(country_metrics)} países")
 
-# --- 6.5: Métricas a nivel de producto ---
-print("\n6.5 Calculando métricas a nivel de producto...")
+def yoy_change(series_ids, prices):
+    # Variación % respecto al año anterior de la misma serie (entrada ya
+    # ordenada por serie y año); NaN en el primer año y si el anterior es 0
+    lag = np.empty_like(prices)
+    lag[:1] = np.nan
+    lag[1:] = np.where(series_ids[1:] == series_ids[:-1], prices[:-1], np.nan)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        change = ((prices - lag) / lag) * 100
+    change[np.isinf(change)] = np.nan
+    return change
 
-product_metrics = df_clean.groupby(['Item', 'Product_Category']).apply(
-    calculate_country_metrics, include_groups=False
-).reset_index()
 
-for col in ['Avg_Price', 'Min_Price', 'Max_Price', 'Volatility', 'Trend_2010_2023']:
-    product_metrics[col] = product_metrics[col].round(2)
+# --- Ejecución paralela del PASO 6 (--workers N) ---
 
-print(f"Métricas calculadas para {len(product_metrics)} productos")
+def _to_shared(arrays):
+    # Copia cada array a un bloque de memoria compartida; los workers solo
+    # reciben (nombre del bloque, dtype, shape)
+    spec, blocks = {}, []
+    for name, values in arrays.items():
+        values = np.ascontiguousarray(values)
+        block = shared_memory.SharedMemory(create=True, size=max(values.nbytes, 1))
+        np.ndarray(values.shape, dtype=values.dtype, buffer=block.buf)[:] = values
+        spec[name] = (block.name, values.dtype.str, values.shape)
+        blocks.append(block)
+    return spec, blocks
 
-# --- 6.6: Agregados regionales ---
-print("\n6.6 Calculando agregados regionales...")
 
-regional_aggregates = df_clean.groupby(['Region', 'Year', 'Product_Category']).agg({
-    'Price': ['mean', 'std', 'min', 'max', 'count']
-}).reset_index()
+def _attach_shared(spec):
+    blocks, arrays = [], {}
+    for name, (block_name, dtype, shape) in spec.items():
+        block = shared_memory.SharedMemory(name=block_name)
+        blocks.append(block)
+        arrays[name] = np.ndarray(shape, dtype=dtype, buffer=block.buf)
+    return arrays, blocks
+
+
+def _run_on_shard(task, spec, start, end, task_args):
+    # Punto de entrada de los workers: task recibe vistas (sin copia) del
+    # tramo [start, end) de cada array compartido
+    arrays, blocks = _attach_shared(spec)
+    try:
+        result = task({name: values[start:end] for name, values in arrays.items()}, *task_args)
+    finally:
+        del arrays
+        for block in blocks:
+            block.close()
+    return result
 
-regional_aggregates.columns = [
-    'Region', 'Year', 'Product_Category',
-    'Avg_Price', 'Std_Price', 'Min_Price', 'Max_Price', 'Count'
-]
 
-for col in ['Avg_Price', 'Std_Price', 'Min_Price', 'Max_Price']:
-    regional_aggregates[col] = regional_aggregates[col].round(2)
+def _yoy_task(arrays):
+    arrays['yoy'][:] = yoy_change(arrays['series'], arrays['price'])
 
-print(f"Agregados regionales: {len(regional_aggregates):,} registros")
 
-# --- 6.7: Métricas por país y categoría de producto ---
-print("\n6.7 Calculando métricas por país y categoría...")
+def balanced_shards(shard_codes, n_shards):
+    """
+    Asigna cada código (Area, Item...) a un shard equilibrando el número de
+    filas (mayor primero, empates por código) y devuelve el shard de cada
+    fila. Determinista: no depende del orden de ejecución de los workers.
+    """
+    counts = np.bincount(shard_codes)
+    loads = np.zeros(n_shards, dtype='int64')
+    shard_of_code = np.zeros(len(counts), dtype='int64')
+    for code in np.lexsort((np.arange(len(counts)), -counts)):
+        target = int(np.argmin(loads))
+        shard_of_code[code] = target
+        loads[target] += counts[code]
+    return shard_of_code[shard_codes]
 
-country_category_metrics = df_clean.groupby(['Area', 'Region', 'Product_Category']).apply(
-    calculate_country_metrics, include_groups=False
-).reset_index()
 
-for col in ['Avg_Price', 'Min_Price', 'Max_Price', 'Volatility', 'Trend_2010_2023']:
-    country_category_metrics[col] = country_category_metrics[col].round(2)
+def run_sharded(pool, task, arrays, shard_codes, n_shards, outputs=(), task_args=()):
+    """
+    Reparte las filas en shards por shard_codes (las filas de cada shard
+    conservan su orden relativo), publica los arrays en memoria compartida y
+    ejecuta task sobre cada shard en el pool. Devuelve los resultados en
+    orden de shard y los arrays de salida (outputs) en el orden original.
+    """
+    shard_of_row = balanced_shards(shard_codes, n_shards)
+    perm = np.argsort(shard_of_row, kind='stable')
+    bounds = np.searchsorted(shard_of_row[perm], np.arange(n_shards + 1))
+
+    shared = {name: values[perm] for name, values in arrays.items()}
+    shared.update({name: np.full(len(perm), np.nan) for name in outputs})
+    spec, blocks = _to_shared(shared)
+    del shared
+    try:
+        futures = [
+            pool.submit(_run_on_shard, task, spec, int(bounds[i]), int(bounds[i + 1]), task_args)
+            for i in range(n_shards) if bounds[i + 1] > bounds[i]
+        ]
+        results = [future.result() for future in futures]
+        collected = {}
+        for name in outputs:
+            view = np.ndarray(spec[name][2], dtype=spec[name][1], buffer=blocks[list(spec).index(name)].buf)
+            collected[name] = np.empty(len(perm))
+            collected[name][perm] = view
+            del view
+    finally:
+        for block in blocks:
+            block.close()
+            block.unlink()
+    return results, collected
 
-print(f"Métricas país-categoría: {len(country_category_metrics):,} combinaciones")
 
 # =============================================================================
-# PASO 7: EXPORTAR ARCHIVOS CSV
+# TENSOR ÁREA × PRODUCTO × AÑO
 # =============================================================================
+# OUTPUT_FOLDER/06_Price_Tensor/ (por elemento, como 01-05):
+#   prices.npy  float32 (áreas × productos × años), NaN = sin dato; se abre
+#               con np.load(mmap_mode='r') sin leerlo entero
+#   areas.csv   posición -> Area Code, Area, Region (ordenado por nombre)
+#   items.csv   posición -> Item Code, Item, Product_Category
+#   meta.json   forma, años y celdas observadas
+
+def write_price_tensor(folder, areas, items, years, cells):
+    """
+    Escribe el tensor en folder directamente sobre un memmap (no se crea en
+    memoria). areas/items son los índices de cada eje; cells, un iterable de
+    DataFrames con Area Code, Item Code, Year y Price y una fila por celda.
+    Devuelve el número de celdas observadas.
+    """
+    os.makedirs(folder, exist_ok=True)
+    area_pos = pd.Index(areas['Area Code'])
+    item_pos = pd.Index(items['Item Code'])
+    year_min = int(years[0]) if len(years) else 0
+
+    prices = np.lib.format.open_memmap(os.path.join(folder, 'prices.npy'), mode='w+', dtype=TENSOR_DTYPE,
+                                       shape=(len(areas), len(items), len(years)))
+    prices[:] = np.nan
+    observed = 0
+    for part in cells:
+        prices[area_pos.get_indexer(part['Area Code']), item_pos.get_indexer(part['Item Code']),
+               part['Year'].to_numpy().astype('int64') - year_min] = part['Price'].to_numpy()
+        observed += len(part)
+    prices.flush()
+    del prices
+
+    areas.to_csv(os.path.join(folder, 'areas.csv'), index=False)
+    items.to_csv(os.path.join(folder, 'items.csv'), index=False)
+    with open(os.path.join(folder, 'meta.json'), 'w', encoding='utf-8') as f:
+        json.dump({
+            'shape': [len(areas), len(items), len(years)],
+            'dtype': TENSOR_DTYPE,
+            'axes': ['Area', 'Item', 'Year'],
+            'year_min': year_min if len(years) else None,
+            'year_max': int(years[-1]) if len(years) else None,
+            'observed_cells': observed,
+        }, f, indent=2)
+    return observed
+
+
+def load_price_tensor(folder=os.path.join(OUTPUT_FOLDER, TENSOR_ARTIFACT)):
+    """
+    Abre un tensor escrito por write_price_tensor() sin cargarlo: 'prices'
+    es un memmap de solo lectura. Devuelve un dict con prices, areas, items,
+    years (array de años del tercer eje), meta y los índices area_index /
+    item_index ({código o nombre: posición}) para búsquedas O(1).
+    """
+    areas = pd.read_csv(os.path.join(folder, 'areas.csv'))
+    items = pd.read_csv(os.path.join(folder, 'items.csv'))
+    with open(os.path.join(folder, 'meta.json'), encoding='utf-8') as f:
+        meta = json.load(f)
+    years = (np.arange(meta['year_min'], meta['year_max'] + 1) if meta['year_min'] is not None
+             else np.array([], dtype='int64'))
+    return {
+        'prices': np.load(os.path.join(folder, 'prices.npy'), mmap_mode='r'),
+        'areas': areas,
+        'items': items,
+        'years': years,
+        'meta': meta,
+        'area_index': {**dict(zip(areas['Area'], areas.index)), **dict(zip(areas['Area Code'], areas.index))},
+        'item_index': {**dict(zip(items['Item'], items.index)), **dict(zip(items['Item Code'], items.index))},
+    }
+
+
+def _tensor_positions(index, keys):
+    # Posiciones de un eje para un código/nombre o una lista de ellos
+    if keys is None:
+        return slice(None)
+    if isinstance(keys, (str, int, np.integer)):
+        keys = [keys]
+    missing = [key for key in keys if key not in index]
+    if missing:
+        raise KeyError(f"No están en el tensor: {missing}")
+    return [index[key] for key in keys]
 
-print("\n" + "=" * 60)
-print("PASO 7: EXPORTANDO ARCHIVOS CSV")
-print("=" * 60)
 
-# 1. Dataset limpio en formato long
-output_1 = os.path.join(OUTPUT_FOLDER, '01_FAOSTAT_Prices_Clean_Long.csv')
-df_clean.to_csv(output_1, index=False)
-print(f"✓ {output_1}")
-print(f"  Registros: {len(df_clean):,}")
+def slice_price_tensor(tensor, areas=None, items=None, years=None):
+    """
+    Porción (áreas × productos × años) del tensor abierto con
+    load_price_tensor(). areas/items: código, nombre o lista de ellos (None:
+    todos); years: un año o (desde, hasta), ambos incluidos. Solo se leen
+    del disco las áreas y años pedidos; el resultado conserva los tres ejes.
+    """
+    year_axis = slice(None)
+    if years is not None:
+        first, last = (years, years) if np.isscalar(years) else years
+        offset = int(tensor['years'][0]) if len(tensor['years']) else 0
+        year_axis = slice(max(int(first) - offset, 0), max(int(last) - offset + 1, 0))
 
-# 2. Métricas a nivel de país
-output_2 = os.path.join(OUTPUT_FOLDER, '02_Country_Metrics.csv')
-country_metrics.to_csv(output_2, index=False)
-print(f"✓ {output_2}")
-print(f"  Registros: {len(country_metrics):,}")
+    result = tensor['prices'][:, :, year_axis]
+    area_axis = _tensor_positions(tensor['area_index'], areas)
+    if area_axis != slice(None):
+        result = result[area_axis]
+    item_axis = _tensor_positions(tensor['item_index'], items)
+    if item_axis != slice(None):
+        result = result[:, item_axis]
+    return np.asarray(result)
 
-# 3. Métricas a nivel de producto
-output_3 = os.path.join(OUTPUT_FOLDER, '03_Product_Metrics.csv')
-product_metrics.to_csv(output_3, index=False)
-print(f"✓ {output_3}")
-print(f"  Registros: {len(product_metrics):,}")
 
-# 4. Agregados regionales
-output_4 = os.path.join(OUTPUT_FOLDER, '04_Regional_Aggregates.csv')
-regional_aggregates.to_csv(output_4, index=False)
-print(f"✓ {output_4}")
-print(f"  Registros: {len(regional_aggregates):,}")
+def price_series(tensor, area, item):
+    # Serie anual de un área y un producto (código o nombre), indexada por año
+    prices = tensor['prices'][tensor['area_index'][area], tensor['item_index'][item]]
+    return pd.Series(np.asarray(prices), index=tensor['years'], name='Price')
+
+
+def tensor_axes(df):
+    """
+    Ejes del tensor a partir de las filas long de un elemento: áreas y
+    productos (con el nombre de su primera fila) ordenados por nombre y
+    código, y años de year_min a year_max.
+    """
+    areas = (df[['Area Code', 'Area', 'Region']].drop_duplicates('Area Code')
+             .sort_values(['Area', 'Area Code']).astype({'Area': str, 'Region': str}).reset_index(drop=True))
+    items = (df[['Item Code', 'Item', 'Product_Category']].drop_duplicates('Item Code')
+             .sort_values(['Item', 'Item Code']).astype({'Item': str, 'Product_Category': str}).reset_index(drop=True))
+    years = np.arange(df['Year'].min(), df['Year'].max() + 1) if len(df) else np.array([], dtype='int64')
+    return areas, items, years
 
-# 5. Métricas país-categoría
-output_5 = os.path.join(OUTPUT_FOLDER, '05_Country_Category_Metrics.csv')
-country_category_metrics.to_csv(output_5, index=False)
-print(f"✓ {output_5}")
-print(f"  Registros: {len(country_category_metrics):,}")
 
 # =============================================================================
-# RESUMEN FINAL
+# CUBO DE AGREGADOS (ROLLUP)
 # =============================================================================
+# OUTPUT_FOLDER/07_Rollup_Cube.csv (por elemento): una fila por celda
+# Region × Product_Category × Area × Year con estadísticos combinables
+# (conteo, suma, suma de cuadrados, mínimo y máximo). Cualquier agrupación
+# más gruesa (Region × Year, Area × Year × categoría, total mundial...) se
+# obtiene combinando celdas con query_rollup_cube(), sin volver al 01.
 
-print("\n" + "=" * 60)
-print("PROCESO COMPLETADO")
-print("=" * 60)
-print(f"""
-Archivos generados en '{OUTPUT_FOLDER}/':
+CUBE_DIMENSIONS = ['Region', 'Product_Category', 'Area', 'Year']
+CUBE_STATS = {'Count': 'sum', 'Sum': 'sum', 'Sum_Sq': 'sum', 'Min': 'min', 'Max': 'max'}
 
-1. 01_FAOSTAT_Prices_Clean_Long.csv
-   - Dataset principal en formato tidy
-   - Columnas: Area, Item, Element, Year, Price, Region, Product_Category, YoY_Change
-   - Uso: Base para todas las visualizaciones
 
-2. 02_Country_Metrics.csv
-   - Métricas agregadas por país
-   - Columnas: Area, Region, Avg_Price, Volatility, Trend_2010_2023, etc.
-   - Uso: Mapa coroplético, ranking de países
+def build_rollup_cube(df):
+    # Celdas (Element Code + CUBE_DIMENSIONS) con los estadísticos de Price,
+    # ordenadas por clave como el resto de tablas
+    prices = df['Price'].to_numpy(dtype='float64')
+    cells = pd.DataFrame({col: df[col].to_numpy() for col in ['Element Code'] + CUBE_DIMENSIONS})
+    cells['Price'] = prices
+    cells['Price_Sq'] = prices * prices
+    return cells.groupby(['Element Code'] + CUBE_DIMENSIONS, sort=True, observed=True).agg(
+        Count=('Price', 'count'), Sum=('Price', 'sum'), Sum_Sq=('Price_Sq', 'sum'),
+        Min=('Price', 'min'), Max=('Price', 'max'),
+    ).reset_index()
+
+
+def write_rollup_cube(cube, element_codes):
+    paths = []
+    for code, part in split_by_element(cube, element_codes):
+        folder = element_output_folder(code)
+        os.makedirs(folder, exist_ok=True)
+        output = os.path.join(folder, CUBE_ARTIFACT + '.csv')
+        part.drop(columns='Element Code').to_csv(output, index=False)
+        print(f"✓ {output}")
+        print(f"  Celdas: {len(part):,} ({int(part['Count'].sum()):,} precios)")
+        paths.append(output)
+    return paths
+
+
+def load_rollup_cube(path=os.path.join(OUTPUT_FOLDER, CUBE_ARTIFACT + '.csv')):
+    # Dimensiones de texto como categóricas (agrupar por códigos es más rápido)
+    return pd.read_csv(path, dtype={'Region': 'category', 'Product_Category': 'category', 'Area': 'category'})
+
+
+def query_rollup_cube(cube, by=(), where=None):
+    """
+    Agregado de cualquier agrupación de CUBE_DIMENSIONS combinando las
+    celdas del cubo: by es la lista de dimensiones del resultado (vacía para
+    el total) y where, un filtro {dimensión: valor o lista de valores}.
+
+    Devuelve by + Count, Avg_Price, Std_Price (muestral, como pandas),
+    Min_Price y Max_Price. La desviación sale de la suma de cuadrados, así
+    que puede diferir del cálculo en dos pasadas en los últimos dígitos.
+    """
+    cells = cube
+    for dim, value in (where or {}).items():
+        values = value if isinstance(value, (list, tuple, set)) else [value]
+        cells = cells[cells[dim].isin(values)]
+
+    by = list(by)
+    if by:
+        merged = cells.groupby(by, sort=True, observed=True).agg(CUBE_STATS).reset_index()
+    else:
+        merged = pd.DataFrame({stat: [cells[stat].agg(how)] for stat, how in CUBE_STATS.items()})
+
+    count = merged['Count']
+    variance = (merged['Sum_Sq'] - merged['Sum'] ** 2 / count) / (count - 1)
+    result = merged[by].copy()
+    result['Count'] = count
+    result['Avg_Price'] = merged['Sum'] / count
+    result['Std_Price'] = np.sqrt(variance.clip(lower=0)).where(count > 1)
+    result['Min_Price'] = merged['Min']
+    result['Max_Price'] = merged['Max']
+    return result
+
+
+# =============================================================================
+# DATOS DEL DASHBOARD
+# =============================================================================
+# OUTPUT_FOLDER/08_Dashboard/ alimenta 'visualizacion final.html' (PPI):
+#   index.js             window.DASHBOARD_DATA: años, diccionarios de
+#                        regiones y categorías, métricas de todos los países
+#                        y productos, series regionales por categoría y
+#                        presets del gráfico de países
+#   countries/chunk_NNN.js  series anuales de DASHBOARD_CHUNK_SIZE países
+# Columnar: los textos se guardan una vez (diccionarios) y las columnas de
+# texto como índices; las numéricas, como float32 little-endian en base64
+# (NaN = sin dato) que la página lee con un Float32Array. Son scripts y no
+# JSON para que la página funcione también abierta desde disco (file://).
+
+DASHBOARD_EXCLUDED_REGION = 'Other'
+DASHBOARD_EXCLUDED_CATEGORY = 'Aggregates'
+DASHBOARD_PRESET_SIZE = 5
+
+
+def encode_float32(values):
+    return base64.b64encode(np.asarray(values, dtype='<f4').tobytes()).decode('ascii')
+
+
+def write_dashboard_script(path, variable, payload):
+    text = f"{variable} = {json.dumps(payload, ensure_ascii=False, separators=(',', ':'))};\n"
+    data = text.encode('utf-8')
+    with open(path, 'wb') as f:
+        f.write(data)
+    if DASHBOARD_GZIP:
+        # mtime=0: el .gz solo cambia si cambian los datos
+        with open(path + '.gz', 'wb') as f:
+            f.write(gzip.compress(data, mtime=0))
+    return len(data)
+
+
+def build_dashboard_payload(country_metrics, product_metrics, regional, cube):
+    """
+    Índice del dashboard y matriz País × Año de precios medios a partir de
+    los artefactos 02, 03, 04 y 07 del PPI. Se dejan fuera las áreas de la
+    región 'Other' (agregados como 'World') y, en la serie de cada país, la
+    categoría 'Aggregates' (ya resume los demás productos).
+    """
+    countries = country_metrics[country_metrics['Region'] != DASHBOARD_EXCLUDED_REGION]
+    countries = countries.sort_values('Area', kind='stable').reset_index(drop=True)
+    regional = regional[regional['Region'] != DASHBOARD_EXCLUDED_REGION]
+    regions = sorted(regional['Region'].unique())
+    categories = sorted(product_metrics['Product_Category'].unique())
+    years = sorted(int(year) for year in cube['Year'].unique())
+
+    series = query_rollup_cube(
+        cube, ['Area', 'Year'],
+        where={'Product_Category': [c for c in categories if c != DASHBOARD_EXCLUDED_CATEGORY]})
+    matrix = series.pivot(index='Area', columns='Year', values='Avg_Price')
+    matrix = matrix.reindex(index=countries['Area'], columns=years).to_numpy(dtype='float32')
+
+    region_index = {region: i for i, region in enumerate(regions)}
+    category_index = {category: i for i, category in enumerate(categories)}
+    regional_series = {}
+    for category, part in regional.groupby('Product_Category', sort=True):
+        table = part.pivot(index='Region', columns='Year', values='Avg_Price').reindex(index=regions, columns=years)
+        regional_series[category] = [encode_float32(row) for row in table.to_numpy()]
+
+    # Presets del gráfico de países (posiciones en 'countries'): los de mayor
+    # tendencia, los menos volátiles y el país con más datos de cada región
+    trend = countries[trend_column(*TREND_WINDOWS[0])]
+    volatility = countries['Volatility']
+    most_data = countries.sort_values('Data_Points', ascending=False, kind='stable').drop_duplicates('Region')
+    presets = {
+        'top': trend.dropna().sort_values(ascending=False, kind='stable').index[:DASHBOARD_PRESET_SIZE].tolist(),
+        'stable': volatility.dropna().sort_values(kind='stable').index[:DASHBOARD_PRESET_SIZE].tolist(),
+        'diverse': most_data.sort_values('Region').index[:DASHBOARD_PRESET_SIZE].tolist(),
+    }
+
+    n_chunks = -(-len(countries) // DASHBOARD_CHUNK_SIZE)
+    products = product_metrics.sort_values('Item', kind='stable')
+    index = {
+        'element': ELEMENT_CODE_PPI,
+        'years': years,
+        'regions': regions,
+        'categories': categories,
+        'countries': {
+            'name': [fix_encoding(area) for area in countries['Area']],
+            'region': [region_index[region] for region in countries['Region']],
+            'avg': encode_float32(countries['Avg_Price']),
+            'volatility': encode_float32(volatility),
+            'trend': encode_float32(trend),
+            'data_points': countries['Data_Points'].fillna(0).astype('int64').tolist(),
+            'chunk': (np.arange(len(countries)) // DASHBOARD_CHUNK_SIZE).tolist(),
+        },
+        'products': {
+            'name': [fix_encoding(item) for item in products['Item']],
+            'category': [category_index[category] for category in products['Product_Category']],
+            'avg': encode_float32(products['Avg_Price']),
+            'volatility': encode_float32(products['Volatility']),
+            'trend': encode_float32(products[trend_column(*TREND_WINDOWS[0])]),
+        },
+        'regional': regional_series,
+        'presets': presets,
+        'chunks': [f'countries/chunk_{i:03d}.js' for i in range(n_chunks)],
+    }
+    return index, matrix
+
+
+def write_dashboard(folder, index, matrix):
+    chunk_folder = os.path.join(folder, 'countries')
+    if os.path.isdir(chunk_folder):
+        shutil.rmtree(chunk_folder)
+    os.makedirs(chunk_folder)
+
+    total = write_dashboard_script(os.path.join(folder, 'index.js'), 'window.DASHBOARD_DATA', index)
+    for i, name in enumerate(index['chunks']):
+        start = i * DASHBOARD_CHUNK_SIZE
+        rows = matrix[start:start + DASHBOARD_CHUNK_SIZE]
+        chunk = {'countries': list(range(start, start + len(rows))), 'series': encode_float32(rows.ravel())}
+        total += write_dashboard_script(os.path.join(folder, name),
+                                        f'(window.DASHBOARD_CHUNKS = window.DASHBOARD_CHUNKS || {{}})[{i}]', chunk)
+    print(f"✓ {folder}/")
+    print(f"  {len(index['countries']['name'])} países en {len(index['chunks'])} bloques, "
+          f"{len(index['years'])} años: {total / 1024:.0f} KB")
+
+
+# =============================================================================
+# VENTANAS DE TENDENCIA
+# =============================================================================
+# OUTPUT_FOLDER/09_Trend_Windows/ (por elemento), para cada nivel de
+# TREND_LEVELS (país y producto):
+#   <nivel>_groups.csv   posición -> claves del grupo (en el orden de 02/03)
+#   <nivel>_trends.npy   float32 grupos × años × años: [g, i, j] es la
+#                        tendencia % de years[i] a years[j] (NaN si i >= j o
+#                        falta alguno de los dos precios); años de year_min a
+#                        year_max
+#   <nivel>_rolling.csv  tendencia y volatilidad de cada ventana móvil de
+#                        ROLLING_WINDOWS años, por grupo y año final
+#   meta.json            años, ventanas móviles y claves de cada nivel
+# Todo sale de una tabla por celda (grupo, año) con el primer precio y las
+# sumas de los cambios % consecutivos: cualquier par de años es una búsqueda
+# en la matriz y cada ventana móvil, una resta de sumas acumuladas por año.
+
+# Nivel: (claves del grupo, columna que ordena las filas de un mismo año
+# como en df_sorted)
+TREND_LEVELS = {
+    'country': (['Area', 'Region'], 'Item'),
+    'product': (['Item', 'Product_Category'], 'Area'),
+}
+
+
+def normalize_trend_windows(trend_windows=None):
+    # TREND_WINDOWS más las ventanas pedidas, sin repetir y comprobadas
+    windows = []
+    for start, end in list(TREND_WINDOWS) + list(trend_windows or []):
+        start, end = int(start), int(end)
+        if start >= end:
+            raise ValueError(f"Ventana de tendencia no válida: {start}-{end} (el inicio debe ser anterior al fin)")
+        if (start, end) not in windows:
+            windows.append((start, end))
+    return windows
+
+
+def normalize_rolling_windows(rolling_windows=None):
+    windows = sorted({int(n) for n in (rolling_windows or ROLLING_WINDOWS)})
+    if windows[0] < 1:
+        raise ValueError(f"Ventana móvil no válida: {windows[0]} (debe ser de al menos 1 año)")
+    return windows
+
+
+def _order_codes(column):
+    # Enteros con el orden en que sort_values() ordena la columna
+    if isinstance(column.dtype, pd.CategoricalDtype):
+        return column.cat.codes.to_numpy()
+    return pd.factorize(column, sort=True)[0]
+
+
+def group_year_stats(df, keys, tie):
+    """
+    Una fila por celda (grupo de keys, Year), ordenadas por grupo y año, con
+    el primer precio del año (las filas de un año en el orden de df_sorted:
+    por tie y por posición), el número de filas y la suma, la suma de
+    cuadrados y el número de cambios % entre filas consecutivas del grupo
+    (precio anterior > 0, como Volatility) que terminan en la celda. Edge_*
+    es el cambio que llega desde el año anterior del grupo, si lo hay.
+    """
+    group_ids = df.groupby(keys, sort=True, observed=True).ngroup().to_numpy()
+    years = df['Year'].to_numpy().astype('int64')
+    prices = df['Price'].to_numpy(dtype='float64')
+    order = np.lexsort((_order_codes(df[tie]), years, group_ids))
+    group_ids, years, prices = group_ids[order], years[order], prices[order]
+
+    new_cell = np.ones(len(years), dtype=bool)
+    new_cell[1:] = (group_ids[1:] != group_ids[:-1]) | (years[1:] != years[:-1])
+    starts = np.flatnonzero(new_cell)
+    n_cells = len(starts)
+    cell_of_row = np.cumsum(new_cell) - 1
+
+    prev, curr = prices[:-1], prices[1:]
+    valid = (group_ids[1:] == group_ids[:-1]) & (prev > 0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        pct = ((curr - prev) / prev) * 100
+    pct_cells = cell_of_row[1:]
+
+    cells = df[keys].iloc[order[starts]].reset_index(drop=True)
+    cells['Year'] = years[starts]
+    cells['First_Price'] = prices[starts]
+    cells['Rows'] = np.diff(np.r_[starts, len(years)])
+    for prefix, mask in (('Pct', valid), ('Edge', valid & new_cell[1:])):
+        cells[prefix + '_Sum'] = np.bincount(pct_cells[mask], pct[mask], minlength=n_cells)
+        cells[prefix + '_Sq'] = np.bincount(pct_cells[mask], pct[mask] ** 2, minlength=n_cells)
+        cells[prefix + '_Count'] = np.bincount(pct_cells[mask], minlength=n_cells)
+    return cells
+
+
+def trend_window_tables(cells, keys, rolling_windows=ROLLING_WINDOWS):
+    """
+    A partir de las celdas de group_year_stats() de un elemento devuelve
+    (grupos, años, matriz, móviles): la matriz float32 grupos × años × años
+    de tendencias de todos los pares de años y la tabla de ventanas móviles
+    (keys, Window, Year final, Trend, Volatility). Una ventana de n años que
+    termina en Y cubre los años Y-n..Y: Trend es la tendencia de Y-n a Y y
+    Volatility, la de Volatility sobre las filas de esos años (con al menos
+    5 filas y 3 cambios). Se calcula con sumas, así que puede diferir de la
+    de dos pasadas en los últimos dígitos.
+    """
+    group_pos = cells.groupby(keys, sort=True, observed=True).ngroup().to_numpy()
+    groups = cells[keys].iloc[np.unique(group_pos, return_index=True)[1]].astype(str).reset_index(drop=True)
+    years = (np.arange(cells['Year'].min(), cells['Year'].max() + 1) if len(cells)
+             else np.array([], dtype='int64'))
+    year_pos = cells['Year'].to_numpy().astype('int64') - (years[0] if len(years) else 0)
+    n_groups, n_years = len(groups), len(years)
+
+    def grid(col, fill):
+        # Columna de las celdas como matriz grupo × año; con fill=0 lleva
+        # una columna extra de ceros para los índices de 'sin año'
+        matrix = np.full((n_groups, n_years + (fill == 0)), fill, dtype='float64')
+        matrix[group_pos, year_pos] = cells[col].to_numpy()
+        return matrix
+
+    prices = grid('First_Price', np.nan)
+    start, end = prices[:, :, None], prices[:, None, :]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        trends = np.where(start > 0, ((end - start) / start) * 100, np.nan)
+    trends[:, ~np.triu(np.ones((n_years, n_years), dtype=bool), k=1)] = np.nan
+
+    # Sumas acumuladas por año (columna k = años anteriores a k) y, para
+    # cada año, el primer año presente del grupo desde él: su Edge_* es el
+    # único cambio de la ventana que viene de un año anterior a su inicio
+    def cumulative(col):
+        return np.concatenate([np.zeros((n_groups, 1)), np.cumsum(grid(col, 0)[:, :n_years], axis=1)], axis=1)
+
+    rows, pct_sum, pct_sq, pct_count = (cumulative(col) for col in ['Rows', 'Pct_Sum', 'Pct_Sq', 'Pct_Count'])
+    edge_sum, edge_sq, edge_count = (grid(col, 0) for col in ['Edge_Sum', 'Edge_Sq', 'Edge_Count'])
+    present = np.where(grid('Rows', 0)[:, :n_years] > 0, np.arange(n_years), n_years)
+    next_present = np.minimum.accumulate(present[:, ::-1], axis=1)[:, ::-1]
+
+    parts = []
+    for n in rolling_windows:
+        last = np.arange(n, n_years)
+        first = last - n
+        if len(last) == 0:
+            continue
+        entering = next_present[:, first]
+        entering = np.where(entering <= last, entering, n_years)
+        edge = np.arange(n_groups)[:, None], entering
+
+        count = pct_count[:, last + 1] - pct_count[:, first] - edge_count[edge]
+        total = pct_sum[:, last + 1] - pct_sum[:, first] - edge_sum[edge]
+        squares = pct_sq[:, last + 1] - pct_sq[:, first] - edge_sq[edge]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mean = total / count
+            variance = np.clip(squares / count - mean * mean, 0, None)
+        eligible = (rows[:, last + 1] - rows[:, first] >= 5) & (count >= 3)
+        volatility = np.where(eligible, np.sqrt(variance), np.nan)
+
+        table = groups.iloc[np.repeat(np.arange(n_groups), len(last))].reset_index(drop=True)
+        table['Window'] = n
+        table['Year'] = np.tile(years[last], n_groups)
+        table['Trend'] = trends[:, first, last].ravel()
+        table['Volatility'] = volatility.ravel()
+        parts.append(table[table['Trend'].notna() | table['Volatility'].notna()])
+
+    rolling = (pd.concat(parts, ignore_index=True) if parts
+               else pd.DataFrame(columns=keys + ['Window', 'Year', 'Trend', 'Volatility']))
+    for col in ['Trend', 'Volatility']:
+        rolling[col] = rolling[col].astype('float64').round(2)
+    return groups, years, trends.astype(TRENDS_DTYPE), rolling
+
+
+def write_trend_windows(levels, element_codes, rolling_windows=ROLLING_WINDOWS):
+    # levels: {nivel: celdas de group_year_stats() con Element Code}
+    by_element = {level: split_by_element(cells, element_codes) for level, cells in levels.items()}
+    paths = []
+    for i, code in enumerate(code for code, _ in by_element['country']):
+        folder = os.path.join(element_output_folder(code), TRENDS_ARTIFACT)
+        os.makedirs(folder, exist_ok=True)
+        meta = {'dtype': TRENDS_DTYPE, 'rolling_windows': rolling_windows, 'levels': {}}
+        summary = []
+        for level, (keys, _) in TREND_LEVELS.items():
+            cells = by_element[level][i][1].drop(columns='Element Code')
+            groups, years, trends, rolling = trend_window_tables(cells, keys, rolling_windows)
+            groups.to_csv(os.path.join(folder, f'{level}_groups.csv'), index=False)
+            np.save(os.path.join(folder, f'{level}_trends.npy'), trends)
+            rolling.to_csv(os.path.join(folder, f'{level}_rolling.csv'), index=False)
+            meta['levels'][level] = keys
+            meta['year_min'] = int(years[0]) if len(years) else None
+            meta['year_max'] = int(years[-1]) if len(years) else None
+            summary.append(f"{level}: {len(groups)} grupos, {len(rolling):,} filas móviles")
+        with open(os.path.join(folder, 'meta.json'), 'w', encoding='utf-8') as f:
+            json.dump(meta, f, indent=2)
+        print(f"✓ {folder}/")
+        print(f"  Años {meta['year_min']}-{meta['year_max']}, ventanas móviles de "
+              f"{', '.join(map(str, rolling_windows))} años | {' | '.join(summary)}")
+        paths.append(folder)
+    return paths
+
+
+def load_trend_windows(folder=os.path.join(OUTPUT_FOLDER, TRENDS_ARTIFACT)):
+    """
+    Abre una carpeta escrita por write_trend_windows(). Devuelve un dict con
+    years, meta y, por nivel ('country', 'product'), groups (posición ->
+    claves), trends (memmap de solo lectura grupos × años × años) y rolling.
+    """
+    with open(os.path.join(folder, 'meta.json'), encoding='utf-8') as f:
+        meta = json.load(f)
+    years = (np.arange(meta['year_min'], meta['year_max'] + 1) if meta['year_min'] is not None
+             else np.array([], dtype='int64'))
+    windows = {'years': years, 'meta': meta}
+    for level in meta['levels']:
+        windows[level] = {
+            'groups': pd.read_csv(os.path.join(folder, f'{level}_groups.csv'), keep_default_na=False),
+            'trends': np.load(os.path.join(folder, f'{level}_trends.npy'), mmap_mode='r'),
+            'rolling': pd.read_csv(os.path.join(folder, f'{level}_rolling.csv'), keep_default_na=False,
+                                   na_values=['']),
+        }
+    return windows
+
+
+def trend_between(windows, start, end, level='country'):
+    """
+    Tendencia % de cada grupo de level entre start y end (años de la
+    matriz, start < end) abierta con load_trend_windows(): una columna
+    Trend_<inicio>_<fin> como las de 02/03, leída de la matriz float32 sin
+    recalcular nada (lo que necesita un selector de rango de años).
+    """
+    years = windows['years']
+    if not (len(years) and years[0] <= start < end <= years[-1]):
+        raise ValueError(f"Ventana fuera de la matriz de tendencias: {start}-{end}")
+    result = windows[level]['groups'].copy()
+    trends = windows[level]['trends'][:, start - years[0], end - years[0]]
+    result[trend_column(start, end)] = np.asarray(trends, dtype='float64').round(2)
+    return result
+
+
+# =============================================================================
+# PRECIOS ANÓMALOS
+# =============================================================================
+# OUTPUT_FOLDER/10_Price_Anomalies.csv (por elemento, como el cubo): los
+# precios que se apartan de la mediana móvil de su serie más de
+# ANOMALY_THRESHOLD MAD escaladas (ver ANOMALY_WINDOW), con la flag Y####F
+# de ese precio en el archivo original. Se calcula sobre todas las filas
+# clasificadas, así que es completo también en modo incremental.
+
+ANOMALY_OUTPUT_COLUMNS = ['Area', 'Item', 'Element', 'Year', 'Price', 'Rolling_Median', 'Rolling_MAD', 'Z_Score',
+                          'Flag', 'Region', 'Product_Category']
+
+
+def _row_medians(window, valid):
+    # Mediana de cada fila de window ignorando los NaN (np.sort los deja al
+    # final); valid es el número de valores de cada fila (al menos uno)
+    flat = np.sort(window, axis=1).ravel()
+    base = np.arange(0, flat.size, window.shape[1])
+    return (flat[base + (valid - 1) // 2] + flat[base + valid // 2]) / 2
+
 
-3. 03_Product_Metrics.csv
-   - Métricas agregadas por producto
-   - Columnas: Item, Product_Category, Avg_Price, Volatility, Trend_2010_2023, etc.
-   - Uso: Scatter plot volatilidad vs tendencia
+def rolling_median_mad(series_ids, prices, window=ANOMALY_WINDOW, chunk_rows=ANOMALY_CHUNK_ROWS):
+    """
+    Mediana y MAD de la ventana centrada de window observaciones de cada
+    fila dentro de su serie (entrada ordenada por serie y año; la ventana se
+    recorta en los extremos de la serie) y el número de precios de la
+    ventana. Sin bucles por grupo: las ventanas son una vista deslizante
+    (filas × window, sin copia) de los precios, se anulan las posiciones de
+    otras series y cada bloque de chunk_rows filas se ordena por filas.
+    """
+    n = len(prices)
+    if n == 0:
+        return np.empty(0), np.empty(0), np.empty(0, dtype='int64')
+    offsets = np.arange(window) - window // 2
+    padded = np.concatenate([np.full(-offsets[0], np.nan), prices, np.full(offsets[-1], np.nan)])
+    windows = np.lib.stride_tricks.sliding_window_view(padded, window)
+
+    # Desplazamientos [lo, hi] de la ventana de cada fila que caen en su serie
+    starts = np.flatnonzero(np.r_[True, series_ids[1:] != series_ids[:-1]])
+    lengths = np.diff(np.r_[starts, n])
+    position = np.arange(n) - np.repeat(starts, lengths)
+    lo = np.maximum(-position, offsets[0])
+    hi = np.minimum(np.repeat(lengths, lengths) - 1 - position, offsets[-1])
+    count = hi - lo + 1
+
+    median, mad = np.empty(n), np.empty(n)
+    for start in range(0, n, chunk_rows):
+        rows = slice(start, min(start + chunk_rows, n))
+        inside = (offsets >= lo[rows, None]) & (offsets <= hi[rows, None])
+        values = np.where(inside, windows[rows], np.nan)
+        median[rows] = _row_medians(values, count[rows])
+        mad[rows] = _row_medians(np.abs(values - median[rows, None]), count[rows])
+    return median, mad, count
+
+
+def robust_zscores(prices, median, mad):
+    # z robusta con la MAD acotada por abajo (ver ANOMALY_MIN_MAD_SHARE)
+    scale = np.maximum(mad, ANOMALY_MIN_MAD_SHARE * np.abs(median))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(scale > 0, ANOMALY_Z_SCALE * (prices - median) / scale, 0.0)
+
+
+def _anomaly_task(arrays):
+    arrays['median'][:], arrays['mad'][:], arrays['count'][:] = rolling_median_mad(arrays['series'], arrays['price'])
+
+
+def detect_anomalies(df, pool=None, workers=1):
+    """
+    Precios anómalos de df (filas en cualquier orden). Cada serie (Element
+    Code, Area, Item) se recorre por año y, dentro de un año, en el orden de
+    df, como en df_sorted. Devuelve las filas marcadas de df (con su índice)
+    en orden de serie y año, con Rolling_Median, Rolling_MAD, Z_Score y Flag
+    (NO_FLAG si el precio no tiene flag). Con pool, las series se reparten
+    por Area entre workers procesos.
+    """
+    series_codes = [df['Element Code'].to_numpy(), _order_codes(df['Area']), _order_codes(df['Item'])]
+    order = np.lexsort([df['Year'].to_numpy()] + series_codes[::-1])
+    series_start = np.zeros(len(order), dtype=bool)
+    series_start[:1] = True
+    for codes in series_codes:
+        codes = codes[order]
+        series_start[1:] |= codes[1:] != codes[:-1]
+    series_ids = np.cumsum(series_start)
+    prices = df['Price'].to_numpy(dtype='float64')[order]
+
+    if pool is None or len(df) == 0:
+        median, mad, count = rolling_median_mad(series_ids, prices)
+    else:
+        _, stats = run_sharded(pool, _anomaly_task, {'series': series_ids, 'price': prices},
+                               series_codes[1][order], workers, outputs=('median', 'mad', 'count'))
+        median, mad, count = stats['median'], stats['mad'], stats['count']
+
+    z_scores = robust_zscores(prices, median, mad)
+    flagged = np.flatnonzero((np.abs(z_scores) > ANOMALY_THRESHOLD) & (count >= ANOMALY_MIN_OBSERVATIONS))
+    anomalies = df.iloc[order[flagged]].copy()
+    anomalies['Rolling_Median'] = median[flagged].round(2)
+    anomalies['Rolling_MAD'] = mad[flagged].round(2)
+    anomalies['Z_Score'] = z_scores[flagged].round(2)
+    flags = anomalies['Flag'].astype(object)
+    anomalies['Flag'] = flags.where(flags.notna(), NO_FLAG)
+    return anomalies
+
+
+def print_anomalies(anomalies, total_rows):
+    share = len(anomalies) / total_rows if total_rows else 0
+    n_series = len(anomalies.drop_duplicates(['Element Code', 'Area', 'Item']))
+    print(f"Precios anómalos (|z| > {ANOMALY_THRESHOLD}, ventanas de {ANOMALY_WINDOW} observaciones): "
+          f"{len(anomalies):,} de {total_rows:,} ({share:.2%}) en {n_series:,} series")
+    for flag, count in anomalies['Flag'].value_counts().items():
+        print(f"  - Flag {flag}: {count:,}")
+
+
+def write_anomalies(anomalies, element_codes):
+    paths = []
+    for code, part in split_by_element(anomalies, element_codes):
+        folder = element_output_folder(code)
+        os.makedirs(folder, exist_ok=True)
+        output = os.path.join(folder, ANOMALIES_ARTIFACT + '.csv')
+        part[ANOMALY_OUTPUT_COLUMNS].to_csv(output, index=False)
+        print(f"✓ {output}")
+        print(f"  Precios anómalos: {len(part):,}")
+        paths.append(output)
+    return paths
+
+
+# =============================================================================
+# ETAPAS DEL PIPELINE
+# =============================================================================
+# Cada etapa recibe sus entradas como argumentos y devuelve sus salidas (una
+# tupla si hay varias); PIPELINE_STAGES declara los nombres de ambas.
+
+# --- PASO 1: Cargar datos ---
+
+def stage_load_main(main_file, element_codes):
+    # Dataset principal (lectura por bloques, filtrando los elementos al leer)
+    if USE_CACHE:
+        df_main, main_stats, cache_hit = load_main_dataset_cached(main_file, element_codes)
+        print(f"Caché '{CACHE_FOLDER}/': {'válida, se omite el parseo del CSV' if cache_hit else 'regenerada'}")
+    else:
+        df_main, main_stats = load_main_dataset(main_file, element_codes)
+    print(f"Dataset principal leído: {main_stats['rows_total']:,} filas")
+    print(f"  - Conservadas tras filtro de elemento: {len(df_main):,} filas, {len(df_main.columns)} columnas")
+    return df_main, main_stats
+
+
+def stage_load_aux():
+    # Datasets auxiliares, con los nombres de columna sin espacios
+    aux_tables = {
+        'areas': pd.read_csv('Prices_E_AreaCodes.csv', encoding='latin-1'),
+        'items': pd.read_csv('Prices_E_ItemCodes.csv', encoding='latin-1'),
+        'elements': pd.read_csv('Prices_E_Elements.csv', encoding='latin-1'),
+        'flags': pd.read_csv('Prices_E_Flags.csv', encoding='latin-1'),
+    }
+    for table in aux_tables.values():
+        table.columns = table.columns.str.strip()
+
+    print(f"AreaCodes cargado: {len(aux_tables['areas'])} registros")
+    print(f"ItemCodes cargado: {len(aux_tables['items'])} registros")
+    print(f"Elements cargado: {len(aux_tables['elements'])} registros")
+    print(f"Flags cargado: {len(aux_tables['flags'])} registros")
+    return aux_tables
+
+
+# --- PASO 2: Validación estructural ---
+
+def stage_validate(main_stats, aux_tables):
+    # Informe de calidad a partir del perfil que acumuló la lectura por
+    # bloques del PASO 1 (no se vuelve a recorrer el dataset)
+    report = build_quality_report(main_stats, aux_tables)
+    write_quality_report(QUALITY_REPORT_FILE, report)
+
+    for key, label in (('area_codes', 'Area Codes'), ('item_codes', 'Item Codes'),
+                       ('element_codes', 'Element Codes')):
+        check = report['integrity'][key]
+        print(f"Validación {label}: {'OK' if check['ok'] else 'MISMATCH'}")
+        print(f"  - Códigos en main: {check['codes_in_main']}")
+        print(f"  - Códigos en auxiliar: {check['codes_in_auxiliary']}")
+        if not check['ok']:
+            print(f"  - Sin correspondencia: {len(check['missing_codes'])} códigos, "
+                  f"{check['rows_with_missing_codes']:,} filas")
+
+    print(f"Merge de validación con AreaCodes: {report['m49_rows']:,} / {report['rows_total']:,} registros validados")
+
+    # Mostrar elementos disponibles
+    print("\nElementos disponibles en el dataset:")
+    for element in report['rows_per_element']:
+        print(f"  - {element['element_code']}: {element['element']} ({element['rows']:,} registros)")
+
+    # Flags de calidad: cuota de cada flag sobre las celdas con valor o flag
+    flag_check = report['integrity']['flags']
+    print(f"\nFlags de calidad en el dataset: {'OK' if flag_check['ok'] else 'MISMATCH'}")
+    for flag in report['flag_totals']:
+        description = flag['description'] or ('Valor sin flag' if flag['flag'] == NO_FLAG else 'no está en Prices_E_Flags.csv')
+        print(f"  - {flag['flag']}: {description} ({flag['cells']:,} celdas, {flag['share']:.1%})")
+    print(f"Informe de calidad (Flag x Year x Element): {QUALITY_REPORT_FILE}")
+
+    return report
+
+
+# --- PASO 3: Filtrado ---
+
+def stage_filter(df_main, main_stats, validation):
+    # Filtrar los elementos pedidos (por defecto solo Producer Price Index,
+    # 5539, para comparabilidad internacional). El filtro ya se aplicó
+    # durante la lectura por bloques del PASO 1.
+    df_filtered = df_main
+
+    element_rows = df_filtered.groupby(['Element Code', 'Element'], observed=True).size()
+    print(f"Filtrado por Element Code: {', '.join(str(code) for code, _ in element_rows.index)}")
+    for (code, name), count in element_rows.items():
+        print(f"  - {code}: {name} ({count:,} registros)")
+    print(f"  - Registros antes: {main_stats['rows_total']:,}")
+    print(f"  - Registros después: {len(df_filtered):,}")
+    print(f"  - Países únicos: {df_filtered['Area'].nunique()}")
+    print(f"  - Productos únicos: {df_filtered['Item'].nunique()}")
+    return df_filtered
+
+
+# --- PASO 4: Reshape a formato long ---
+
+def stage_reshape(df_filtered, main_stats):
+    # Identificar columnas de años (valores) y columnas de flags
+    year_value_cols = [col for col in df_filtered.columns if is_year_value_column(col)]
+    year_flag_cols = main_stats['year_flag_cols']
+
+    print(f"Columnas de valores identificadas: {len(year_value_cols)} (Y1991 a Y2024)")
+    print(f"Columnas de flags identificadas: {len(year_flag_cols)} (perfiladas en el PASO 2; la de cada precio "
+          f"pasa a la columna Flag)")
+
+    # Pivotear a formato long conservando solo los precios observados
+    df_long, total_cells = reshape_to_long(df_filtered, year_value_cols)
+
+    print(f"Transformación completada:")
+    print(f"  - Celdas serie × año: {total_cells:,}")
+    print(f"  - Registros en formato long (solo valores observados): {len(df_long):,}")
+    print(f"  - Estructura: {list(df_long.columns)}")
+    return df_long, total_cells
+
+
+# --- PASO 5: Limpieza de datos ---
+
+def stage_clean(df_long, total_cells):
+    # Contar valores faltantes antes
+    total_before = total_cells
+    missing_before = total_before - len(df_long)
+
+    print(f"Valores faltantes antes de limpieza: {missing_before:,} / {total_before:,} ({missing_before/total_before*100:.1f}%)")
+
+    # Las filas con Price nulo nunca llegan a crearse en el PASO 4 (NO interpolamos)
+    df_clean = df_long
+
+    total_after = len(df_clean)
+
+    print(f"Registros después de eliminar nulos: {total_after:,}")
+    print(f"Registros eliminados: {total_before - total_after:,}")
+
+    # Verificar rango de años con datos
+    year_coverage = df_clean.groupby('Year').size()
+    print(f"Cobertura temporal: {df_clean['Year'].min()} - {df_clean['Year'].max()}")
+    print(f"Años con datos: {len(year_coverage)}")
+    print(f"Memoria del dataset long: {df_clean.memory_usage(deep=True).sum() / 1024**2:,.1f} MB")
+    return df_clean
+
+
+# --- PASO 6: Clasificación (6.1-6.2) ---
+
+def stage_classify_regions(df_clean, aux_tables):
+    # --- 6.1: Asignación de regiones geográficas ---
+    # Añade Region a df_clean (sin copiarlo)
+    print("\n6.1 Asignando regiones geográficas...")
+
+    region_name_index = build_name_index(REGION_MAPPING)
+    region_code_index = build_code_index(aux_tables['areas'], 'Area Code', 'Area', region_name_index)
+
+    df_clean['Region'], unmapped_areas = classify_by_code(
+        df_clean['Area Code'], df_clean['Area'], region_code_index, region_name_index
+    )
+
+    region_distribution = df_clean.groupby('Region', observed=True)['Area'].nunique()
+    print("Distribución por región:")
+    for region, count in region_distribution.items():
+        print(f"  - {region}: {count} países")
+    print_unmapped(unmapped_areas, 'área')
+    return df_clean
+
+
+def stage_classify_products(df_regions, aux_tables):
+    # --- 6.2: Categorización de productos ---
+    # Añade Product_Category a df_regions (sin copiarlo)
+    print("\n6.2 Categorizando productos...")
+
+    category_name_index = build_name_index(PRODUCT_CATEGORIES)
+    category_code_index = build_code_index(aux_tables['items'], 'Item Code', 'Item', category_name_index)
+
+    df_regions['Product_Category'], unmapped_items = classify_by_code(
+        df_regions['Item Code'], df_regions['Item'], category_code_index, category_name_index
+    )
+
+    category_distribution = df_regions['Product_Category'].value_counts()
+    print("Distribución por categoría de producto:")
+    for category, count in category_distribution.head(15).items():
+        print(f"  - {category}: {count:,} registros")
+    print_unmapped(unmapped_items, 'producto')
+    return df_regions
+
+
+def stage_incremental(df_classified, incremental, trend_windows, exclude_anomalies):
+    """
+    Filas sobre las que se calculan 6.3-6.7. En el modo incremental son solo
+    las necesarias para los grupos afectados por series cambiadas; devuelve
+    (df_trabajo, tabla_de_series, plan), con plan None si se recalcula todo.
+    """
+    if not incremental:
+        return df_classified, None, None
+
+    print("\nModo incremental: comparando series con la ejecución anterior...")
+    series_table, names_unique = build_series_table(df_classified)
+    plan = plan_incremental_update(df_classified, series_table, names_unique, trend_windows, exclude_anomalies)
+    if plan is None:
+        return df_classified, series_table, None
+
+    print(f"  Series: {len(series_table):,} | modificadas: {plan['n_changed']:,}"
+          f" | nuevas: {plan['n_added']:,} | eliminadas: {plan['n_removed']:,}")
+    df_work = df_classified[plan['row_mask']]
+    print(f"  Filas necesarias para recalcular los grupos afectados: {len(df_work):,}")
+    return df_work, series_table, plan
+
+
+def stage_sort(df_work):
+    # Orden (Element Code, Area, Item, Year) que comparten la YoY, el 01 y
+    # las métricas; cada elemento queda en un tramo contiguo
+    return df_work.sort_values(['Element Code', 'Area', 'Item', 'Year'])
+
+
+def stage_anomalies(df_classified, pool, workers):
+    # Precios anómalos de todas las series, sobre todas las filas
+    # clasificadas (completos también en modo incremental, como el tensor)
+    print("\nDetectando precios anómalos (mediana y MAD móviles por serie)...")
+    anomalies = detect_anomalies(df_classified, pool=pool, workers=workers)
+    print_anomalies(anomalies, len(df_classified))
+    return anomalies, anomalies.index
+
+
+def stage_metric_rows(df_sorted):
+    # Filas de 6.4-6.7 sin --exclude-anomalies: las mismas de df_sorted
+    return df_sorted
+
+
+def stage_screen_anomalies(df_sorted, anomaly_keys):
+    # Filas de 6.4-6.7 con --exclude-anomalies: df_sorted sin los precios
+    # anómalos (por índice: df_sorted conserva el de df_classified)
+    df_metrics = df_sorted[~df_sorted.index.isin(anomaly_keys)]
+    print(f"Excluidos de las métricas 6.4-6.7: {len(df_sorted) - len(df_metrics):,} precios anómalos")
+    return df_metrics
+
+
+# --- PASO 6: Métricas (6.3-6.7) ---
+
+def stage_yoy(df_sorted, pool, workers):
+    # --- 6.3: Variación interanual (Year-over-Year) ---
+    # Devuelve df_sorted con YoY_Change (copia superficial: las columnas se
+    # comparten y df_sorted no cambia mientras 6.4-6.7 lo leen)
+    print("\n6.3 Calculando variación interanual...")
+
+    element_codes = df_sorted['Element Code'].to_numpy()
+    area_codes = df_sorted['Area'].cat.codes.to_numpy()
+    item_codes = df_sorted['Item'].cat.codes.to_numpy()
+    series_start = np.ones(len(df_sorted), dtype=bool)
+    series_start[1:] = ((element_codes[1:] != element_codes[:-1]) | (area_codes[1:] != area_codes[:-1])
+                        | (item_codes[1:] != item_codes[:-1]))
+    series_ids = np.cumsum(series_start)
+    prices = df_sorted['Price'].to_numpy()
+    df_yoy = df_sorted.copy(deep=False)
+    if pool is None:
+        df_yoy['YoY_Change'] = yoy_change(series_ids, prices)
+    else:
+        _, yoy_arrays = run_sharded(pool, _yoy_task, {'series': series_ids, 'price': prices},
+                                    area_codes, workers, outputs=('yoy',))
+        df_yoy['YoY_Change'] = yoy_arrays['yoy'].astype(prices.dtype)
+
+    yoy_valid = df_yoy['YoY_Change'].notna().sum()
+    print(f"Variaciones YoY calculadas: {yoy_valid:,} registros con valor válido")
+    return df_yoy
+
+
+def stage_country_metrics(df_metrics, trend_windows, pool, workers):
+    # --- 6.4: Métricas a nivel de país ---
+    print("\n6.4 Calculando métricas a nivel de país...")
+
+    country_metrics = calculate_group_metrics(df_metrics, ['Element Code', 'Area', 'Region'], trend_windows,
+                                              pool=pool, workers=workers, shard_by='Area')
+
+    round_metrics(country_metrics, trend_windows)
+
+    print(f"Métricas calculadas para {country_metrics['Area'].nunique()} países")
+    return country_metrics
+
+
+def stage_product_metrics(df_metrics, trend_windows, pool, workers):
+    # --- 6.5: Métricas a nivel de producto ---
+    print("\n6.5 Calculando métricas a nivel de producto...")
+
+    product_metrics = calculate_group_metrics(df_metrics, ['Element Code', 'Item', 'Product_Category'], trend_windows,
+                                              pool=pool, workers=workers, shard_by='Item')
+
+    round_metrics(product_metrics, trend_windows)
+
+    print(f"Métricas calculadas para {product_metrics['Item'].nunique()} productos")
+    return product_metrics
+
+
+def stage_regional_aggregates(df_metrics, pool, workers):
+    # --- 6.6: Agregados regionales ---
+    print("\n6.6 Calculando agregados regionales...")
+
+    regional_aggregates = calculate_regional_aggregates(df_metrics, pool=pool, workers=workers)
+
+    round_metrics(regional_aggregates)
+
+    print(f"Agregados regionales: {len(regional_aggregates):,} registros")
+    return regional_aggregates
+
+
+def stage_country_category_metrics(df_metrics, trend_windows, pool, workers):
+    # --- 6.7: Métricas por país y categoría de producto ---
+    print("\n6.7 Calculando métricas por país y categoría...")
+
+    country_category_metrics = calculate_group_metrics(
+        df_metrics, ['Element Code', 'Area', 'Region', 'Product_Category'], trend_windows,
+        pool=pool, workers=workers, shard_by='Area')
+
+    round_metrics(country_category_metrics, trend_windows)
+
+    print(f"Métricas país-categoría: {len(country_category_metrics):,} combinaciones")
+    return country_category_metrics
+
+
+# --- PASO 7: Exportar archivos CSV ---
+
+def normalize_export_formats(export_formats=None):
+    """
+    {artefacto: [formatos]} para los artefactos 01-05 a partir de un dict
+    parcial (los que faltan usan DEFAULT_EXPORT_FORMATS). Comprueba que los
+    formatos existen y que sus dependencias opcionales están instaladas.
+    """
+    formats = {name: list(DEFAULT_EXPORT_FORMATS) for name in ARTIFACT_TABLES}
+    for name, chosen in (export_formats or {}).items():
+        if name not in formats:
+            raise ValueError(f"Artefacto sin formatos de exportación: {name}")
+        chosen = [chosen] if isinstance(chosen, str) else list(dict.fromkeys(chosen))
+        for fmt in chosen:
+            if fmt not in EXPORT_FORMATS:
+                raise ValueError(f"Formato desconocido: {fmt} (disponibles: {', '.join(EXPORT_FORMATS)})")
+            if fmt in ('parquet', 'feather') and pa is None:
+                raise ValueError(f"El formato {fmt} necesita el paquete pyarrow (pip install pyarrow)")
+            if fmt == 'csv.zst' and zstandard is None:
+                raise ValueError("El formato csv.zst necesita el paquete zstandard (pip install zstandard)")
+        if not chosen:
+            raise ValueError(f"Sin formatos de exportación para {name}")
+        formats[name] = chosen
+    return formats
+
+
+def export_path(folder, name, fmt):
+    # 01_...csv, 01_...csv.gz, 01_...parquet (carpeta si está particionado)...
+    return os.path.join(folder, f'{name}.{fmt}')
+
+
+def _open_csv_writer(path, name, compression=None):
+    if compression == 'gzip':
+        raw = gzip.GzipFile(path, 'wb', compresslevel=EXPORT_GZIP_LEVEL, mtime=0)
+    elif compression == 'zstd':
+        raw = zstandard.ZstdCompressor(level=EXPORT_ZSTD_LEVEL).stream_writer(open(path, 'wb'))
+    else:
+        raw = open(path, 'wb')
+    f = io.TextIOWrapper(raw, encoding='utf-8', newline='')
+    state = {'header': True}
+
+    def write(df):
+        # pandas formatea y escribe por bloques de EXPORT_CSV_CHUNK_ROWS filas
+        df.to_csv(f, index=False, header=state['header'], chunksize=EXPORT_CSV_CHUNK_ROWS)
+        state['header'] = False
+    return write, f.close
+
+
+def _open_parquet_writer(path, name):
+    # Las categóricas se guardan como diccionarios de Arrow (y vuelven como
+    # categóricas al leer); el resto de columnas de texto, con la codificación
+    # por diccionario de Parquet. Con PARQUET_PARTITION_COLUMNS el artefacto
+    # es una carpeta con un archivo por valor (partición Hive), cada uno con
+    # las filas en el orden del CSV.
+    partition = PARQUET_PARTITION_COLUMNS.get(name)
+    if partition is not None:
+        shutil.rmtree(path, ignore_errors=True)
+        os.makedirs(path)
+    writers = {}
+    state = {'empty': None}
+
+    def write_table(key, target, table):
+        if key not in writers:
+            writers[key] = pq.ParquetWriter(target, table.schema)
+        writer = writers[key]
+        if not table.schema.equals(writer.schema, check_metadata=False):
+            table = table.cast(writer.schema)
+        writer.write_table(table, row_group_size=PARQUET_ROW_GROUP_ROWS)
+
+    def write(df):
+        if partition is None:
+            write_table(None, path, pa.Table.from_pandas(df, preserve_index=False))
+            return
+        if df.empty:
+            state['empty'] = df
+            return
+        for value, part in df.groupby(partition, sort=False, observed=True):
+            folder = os.path.join(path, f'{partition}={quote(str(value), safe="")}')
+            os.makedirs(folder, exist_ok=True)
+            table = pa.Table.from_pandas(part.drop(columns=partition), preserve_index=False)
+            write_table(value, os.path.join(folder, 'part-0.parquet'), table)
+
+    def close():
+        if partition is not None and not writers and state['empty'] is not None:
+            # Sin filas: un archivo vacío con el esquema completo
+            write_table(None, os.path.join(path, 'part-0.parquet'),
+                        pa.Table.from_pandas(state['empty'], preserve_index=False))
+        for writer in writers.values():
+            writer.close()
+    return write, close
+
+
+def _open_feather_writer(path, name):
+    state = {}
+
+    def write(df):
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        if 'writer' not in state:
+            options = pa.ipc.IpcWriteOptions(compression=FEATHER_COMPRESSION)
+            state['schema'] = table.schema
+            state['writer'] = pa.ipc.new_file(path, table.schema, options=options)
+        elif not table.schema.equals(state['schema'], check_metadata=False):
+            table = table.cast(state['schema'])
+        state['writer'].write_table(table)
+
+    def close():
+        if 'writer' in state:
+            state['writer'].close()
+    return write, close
+
+
+# Cada formato abre un escritor (write, close): write(df) añade filas (se
+# llama una vez por elemento en pandas y una vez por bloque en DuckDB) y
+# close() termina el archivo
+EXPORT_WRITERS = {
+    'csv': _open_csv_writer,
+    'csv.gz': functools.partial(_open_csv_writer, compression='gzip'),
+    'csv.zst': functools.partial(_open_csv_writer, compression='zstd'),
+    'parquet': _open_parquet_writer,
+    'feather': _open_feather_writer,
+}
+
+
+def write_export(path, fmt, name, df):
+    write, close = EXPORT_WRITERS[fmt](path, name)
+    try:
+        write(df)
+    finally:
+        close()
+
+
+def read_artifact(path):
+    """
+    Lee un artefacto exportado en cualquiera de EXPORT_FORMATS (según la
+    extensión; parquet admite la carpeta particionada del 01).
+    """
+    if path.endswith('.parquet'):
+        return pd.read_parquet(path)
+    if path.endswith('.feather'):
+        return pd.read_feather(path)
+    return pd.read_csv(path)
+
+
+def export_size(path):
+    if os.path.isdir(path):
+        return sum(os.path.getsize(os.path.join(root, f)) for root, _, files in os.walk(path) for f in files)
+    return os.path.getsize(path)
+
+
+def print_export(path, rows):
+    print(f"✓ {path}")
+    print(f"  Registros: {rows:,} ({export_size(path) / 1024 ** 2:,.1f} MB)")
+
+
+def write_artifact_parts(name, parts, export_formats, export_pool):
+    """
+    Escribe cada tramo [(código de elemento, tabla)] en los formatos de
+    export_formats[name], todos a la vez en export_pool. Devuelve las rutas
+    en orden de elemento y formato.
+    """
+    jobs = []
+    for code, part in parts:
+        folder = element_output_folder(code)
+        os.makedirs(folder, exist_ok=True)
+        for fmt in export_formats[name]:
+            path = export_path(folder, name, fmt)
+            jobs.append((path, len(part), export_pool.submit(write_export, path, fmt, name, part)))
+    for path, rows, future in jobs:
+        future.result()
+        print_export(path, rows)
+    return [path for path, _, _ in jobs]
+
+
+def _plan_is_noop(plan):
+    return plan is not None and len(plan['changed_keys']) == 0 and plan['n_removed'] == 0
+
+
+def element_output_folder(element_code):
+    # Las salidas del PPI se mantienen en OUTPUT_FOLDER; las de otros
+    # elementos van a su propia subcarpeta
+    if int(element_code) == ELEMENT_CODE_PPI:
+        return OUTPUT_FOLDER
+    return os.path.join(OUTPUT_FOLDER, f'element_{int(element_code)}')
+
+
+def split_by_element(df, element_codes):
+    """
+    [(código, tramo)] de df (ordenado por Element Code) para cada elemento
+    pedido; con ALL_ELEMENTS, para cada elemento presente. Los tramos son
+    vistas contiguas, sin copiar filas.
+    """
+    codes = df['Element Code'].to_numpy()
+    present = np.unique(codes)
+    starts = np.searchsorted(codes, present, side='left')
+    ends = np.searchsorted(codes, present, side='right')
+    slices = {int(code): df.iloc[start:end] for code, start, end in zip(present, starts, ends)}
+    wanted = sorted(slices) if element_codes == ALL_ELEMENTS else element_codes
+    return [(code, slices.get(code, df.iloc[0:0])) for code in wanted]
+
+
+def stage_export_long(df_yoy, series_table, incremental_plan, element_codes, export_formats, export_pool):
+    """
+    Escribe (o parchea, en el modo incremental) el 01 de cada elemento.
+    Devuelve (rutas, offsets) donde offsets = (tabla_de_series, inicios,
+    longitudes) de cada serie en el 01 del PPI, o None si no se puede
+    guardar el estado incremental (solo se guarda con los elementos y los
+    formatos por defecto).
+    """
+    output_1 = os.path.join(OUTPUT_FOLDER, LONG_ARTIFACT + '.csv')
+
+    if incremental_plan is None:
+        # 1. Dataset limpio en formato long
+        parts = [(code, part[LONG_OUTPUT_COLUMNS]) for code, part in split_by_element(df_yoy, element_codes)]
+        paths = write_artifact_parts(LONG_ARTIFACT, parts, export_formats, export_pool)
+        if element_codes != DEFAULT_ELEMENT_CODES:
+            return paths, None
+        if export_formats != normalize_export_formats():
+            print("  (estado incremental no guardado: el modo incremental solo parchea archivos csv)")
+            return paths, None
+
+        if series_table is None:
+            series_table, names_unique = build_series_table(df_yoy)
+        else:
+            names_unique = not series_table.duplicated(['area_pos', 'item_pos']).any()
+        offsets = long_file_offsets(output_1, series_table) if names_unique else None
+        if offsets is None:
+            print("  (estado incremental no guardado: series con nombres duplicados)")
+            return paths, None
+        return paths, (series_table,) + offsets
+
+    if _plan_is_noop(incremental_plan):
+        print("Sin cambios en los datos: las salidas ya están actualizadas")
+        return [output_1], None
+
+    # 1. Solo se reescriben las series cambiadas; el resto se copia tal cual
+    changed_rows = np.isin(series_key(df_yoy['Area Code'], df_yoy['Item Code']),
+                           incremental_plan['changed_keys'])
+    offsets = patch_long_output(output_1, series_table, incremental_plan, df_yoy[changed_rows])
+    print(f"✓ {output_1} (parcheado)")
+    print(f"  Registros reescritos: {int(changed_rows.sum()):,} de {int(series_table['rows'].sum()):,}")
+    return [output_1], (series_table,) + offsets
+
+
+def stage_export_metrics(name, table, incremental_plan, element_codes, export_formats, export_pool):
+    # 2-5. Métricas por país, producto, región y país-categoría, un archivo
+    # por elemento (en el modo incremental, que solo admite los elementos
+    # por defecto, se sustituyen solo los grupos afectados)
+    if incremental_plan is not None:
+        output = os.path.join(OUTPUT_FOLDER, name + '.csv')
+        if not _plan_is_noop(incremental_plan):
+            total, patched = patch_metric_output(
+                output, table.drop(columns='Element Code'), METRIC_ARTIFACT_KEYS[name],
+                incremental_plan['affected'][name])
+            print(f"✓ {output} (parcheado)")
+            print(f"  Registros: {total:,} ({patched:,} recalculados)")
+        return [output]
+
+    parts = [(code, part.drop(columns='Element Code')) for code, part in split_by_element(table, element_codes)]
+    return write_artifact_parts(name, parts, export_formats, export_pool)
+
+
+def print_tensor_export(folder, areas, items, years, observed, duplicates):
+    cells = len(areas) * len(items) * len(years)
+    print(f"✓ {folder}/")
+    print(f"  {len(areas)} áreas × {len(items)} productos × {len(years)} años: "
+          f"{observed:,} celdas observadas ({observed / cells if cells else 0:.1%})")
+    if duplicates:
+        print(f"  {duplicates:,} filas repiten celda (meses): se usa la primera del archivo")
+
+
+def stage_export_tensor(df_classified, element_codes):
+    # 6. Tensor Área × Producto × Año de cada elemento (se escribe en cuanto
+    # las filas están clasificadas, antes del modo incremental, así que
+    # siempre es completo). Se parte del orden long (año a año, fila a
+    # fila): en una celda con varias filas se queda la primera del archivo.
+    print("\nExportando tensor Área × Producto × Año...")
+    element_col = df_classified['Element Code'].to_numpy()
+    codes = np.unique(element_col).tolist() if element_codes == ALL_ELEMENTS else element_codes
+    paths = []
+    for code in codes:
+        part = df_classified[element_col == code]
+        cells = part[~part.duplicated(['Area Code', 'Item Code', 'Year'])]
+        areas, items, years = tensor_axes(part)
+        folder = os.path.join(element_output_folder(code), TENSOR_ARTIFACT)
+        observed = write_price_tensor(folder, areas, items, years, [cells])
+        print_tensor_export(folder, areas, items, years, observed, len(part) - len(cells))
+        paths.append(folder)
+    return paths
+
+
+def stage_export_cube(df_classified, element_codes):
+    # 7. Cubo de agregados, como el tensor sobre todas las filas clasificadas
+    print("\nExportando cubo de agregados (Region × Categoría × Área × Año)...")
+    return write_rollup_cube(build_rollup_cube(df_classified), element_codes)
+
+
+def stage_export_trends(df_classified, element_codes, rolling_windows):
+    # 9. Matrices de tendencia y ventanas móviles por país y por producto,
+    # como el tensor sobre todas las filas clasificadas (completas también
+    # en modo incremental)
+    print("\nExportando ventanas de tendencia (todos los pares de años y móviles)...")
+    levels = {level: group_year_stats(df_classified, ['Element Code'] + keys, tie)
+              for level, (keys, tie) in TREND_LEVELS.items()}
+    return write_trend_windows(levels, element_codes, rolling_windows)
+
+
+def stage_export_anomalies(anomalies, element_codes):
+    # 10. Precios anómalos de cada elemento
+    print("\nExportando precios anómalos...")
+    return write_anomalies(anomalies, element_codes)
+
+
+def stage_export_dashboard(element_codes, *artifacts):
+    # 8. Datos del dashboard. Se leen los archivos ya escritos (02, 03, 04
+    # en su primer formato, y 07) y no las tablas en memoria: en modo
+    # incremental esas tablas solo contienen los grupos recalculados. Depende
+    # de los artefactos (sus rutas) para ejecutarse después de exportarlos.
+    print("\nExportando datos del dashboard...")
+    paths = [next((path for path in outputs if os.path.dirname(path) == OUTPUT_FOLDER), None)
+             for outputs in artifacts]
+    if None in paths:
+        print(f"  Sin datos del elemento {ELEMENT_CODE_PPI} en esta ejecución: no se actualiza")
+        return []
+    country_metrics, product_metrics, regional = (read_artifact(path) for path in paths[:3])
+    index, matrix = build_dashboard_payload(country_metrics, product_metrics, regional, load_rollup_cube(paths[3]))
+    folder = os.path.join(OUTPUT_FOLDER, DASHBOARD_ARTIFACT)
+    write_dashboard(folder, index, matrix)
+    return [folder]
+
+
+def stage_save_state(long_offsets, trend_windows, exclude_anomalies, *artifacts):
+    # Depende de los cinco artefactos (sus rutas) porque el manifest guarda
+    # el fingerprint de cada uno: se escribe después de exportarlos
+    if long_offsets is None:
+        return False
+    save_incremental_state(*long_offsets, trend_windows, exclude_anomalies)
+    return True
+
+
+# =============================================================================
+# BACKEND DUCKDB (FUERA DE MEMORIA)
+# =============================================================================
+# python analizar.py --backend duckdb: carga, filtro, unpivot, limpieza y
+# clasificación se expresan como consultas sobre DuckDB embebido, que
+# procesa por streaming y vuelca a DUCKDB_TEMP_FOLDER lo que no cabe en
+# DUCKDB_MEMORY_LIMIT. El formato long solo se materializa dentro de DuckDB;
+# la YoY y las métricas reciben las filas ordenadas en bloques de grupos
+# completos y usan los mismos kernels NumPy que el backend pandas, con el
+# mismo orden de filas dentro de cada grupo, así que las salidas son
+# idénticas byte a byte.
+
+DUCKDB_TYPES = {'int32': 'INTEGER', 'str': 'VARCHAR', 'float64': 'DOUBLE', 'float32': 'FLOAT'}
+
+
+def duckdb_identifier(name):
+    return '"' + name.replace('"', '""') + '"'
+
+
+def duckdb_literal(text):
+    return "'" + str(text).replace("'", "''") + "'"
+
+
+def duckdb_columns(columns):
+    return ', '.join(duckdb_identifier(col) for col in columns)
+
+
+def duckdb_element_filter(element_codes):
+    # Condición WHERE para los elementos pedidos (ALL_ELEMENTS: sin filtro)
+    if element_codes == ALL_ELEMENTS:
+        return 'TRUE'
+    return f'"Element Code" IN ({", ".join(str(int(code)) for code in element_codes)})'
+
+
+def connect_duckdb(workers=1):
+    # Conexión en memoria que vuelca a disco al superar DUCKDB_MEMORY_LIMIT;
+    # preserve_insertion_order mantiene el orden del archivo en rowid
+    if duckdb is None:
+        raise ImportError("El backend duckdb necesita el paquete duckdb (pip install duckdb)")
+    os.makedirs(DUCKDB_TEMP_FOLDER, exist_ok=True)
+    con = duckdb.connect()
+    con.execute(f"SET memory_limit = {duckdb_literal(DUCKDB_MEMORY_LIMIT)}")
+    con.execute(f"SET temp_directory = {duckdb_literal(DUCKDB_TEMP_FOLDER)}")
+    con.execute("SET preserve_insertion_order = true")
+    if workers > 1:
+        con.execute(f"SET threads = {int(workers)}")
+    return con
+
+
+def duckdb_quality_stats(con, year_cols, flag_cols):
+    """
+    El mismo perfil que acumula profile_chunk() (filas por código y conteo
+    por (Element Code, Year, Flag), con NO_FLAG para los valores observados
+    sin flag), calculado con consultas agregadas sobre main_wide.
+    """
+    stats = new_quality_stats(flag_cols)
+    stats['rows_total'] = con.sql("SELECT count(*) FROM main_wide").fetchone()[0]
+    for key, col in (('area_code_counts', 'Area Code'), ('item_code_counts', 'Item Code'),
+                     ('element_code_counts', 'Element Code')):
+        counts = con.sql(f"SELECT {duckdb_identifier(col)} AS code, count(*) AS n FROM main_wide GROUP BY code").df()
+        stats[key] = pd.Series(counts['n'].to_numpy(), index=counts['code'].to_numpy())
+
+    selects = []
+    for flag_col in flag_cols:
+        flag = f"NULLIF({duckdb_identifier(flag_col)}, '')"
+        if flag_col[:-1] in year_cols:
+            flag = (f"COALESCE({flag}, CASE WHEN {duckdb_identifier(flag_col[:-1])} IS NOT NULL "
+                    f"THEN {duckdb_literal(NO_FLAG)} END)")
+        selects.append(f'SELECT "Element Code", {int(flag_col[1:-1])} AS "Year", {flag} AS "Flag" FROM main_wide')
+    if selects:
+        counts = con.sql(
+            f'SELECT "Element Code", "Year", "Flag", count(*) AS n FROM ({" UNION ALL ".join(selects)}) '
+            f'WHERE "Flag" IS NOT NULL GROUP BY "Element Code", "Year", "Flag"').df()
+        stats['flag_counts'] = counts.set_index(['Element Code', 'Year', 'Flag'])['n'].sort_index()
+    return finish_quality_stats(stats)
+
+
+def duckdb_key_values(series):
+    # Las columnas de texto llegan como categóricas (ENUM): se comparan los códigos
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        return series.cat.codes.to_numpy()
+    return series.to_numpy()
+
+
+def duckdb_batches(relation, batch_rows=DUCKDB_BATCH_ROWS):
+    # Resultado de relation como DataFrames de unas batch_rows filas
+    vectors = max(1, batch_rows // 2048)
+    while True:
+        chunk = relation.fetch_df_chunk(vectors)
+        if len(chunk) == 0:
+            return
+        yield chunk
+
+
+def duckdb_group_batches(relation, keys, batch_rows=DUCKDB_BATCH_ROWS):
+    """
+    Recorre relation (ordenada por keys) en DataFrames de unas batch_rows
+    filas que solo contienen grupos completos: las filas del último grupo
+    de cada bloque pasan al siguiente.
+    """
+    carry = None
+    for chunk in duckdb_batches(relation, batch_rows):
+        if carry is not None:
+            chunk = pd.concat([carry, chunk], ignore_index=True)
+        in_last_group = np.ones(len(chunk), dtype=bool)
+        for key in keys:
+            values = duckdb_key_values(chunk[key])
+            in_last_group &= values == values[-1]
+        tail = int(np.argmax(in_last_group))
+        if tail > 0:
+            yield chunk.iloc[:tail]
+        carry = chunk.iloc[tail:].reset_index(drop=True)
+    if carry is not None:
+        yield carry
+
+
+def duckdb_grouped(relation, keys, within, compute, columns=()):
+    """
+    compute(bloque) sobre relation ordenada por keys y, dentro de cada
+    grupo, por within: el orden relativo que esas filas tienen en df_sorted
+    del backend pandas tras el sort estable por Year de segment_metrics().
+    Solo se leen las columnas de orden, Year, Price y columns. Devuelve los
+    resultados concatenados.
+    """
+    columns = list(dict.fromkeys(keys + within + ['Year', 'Price'] + list(columns)))
+    ordered = relation.project(duckdb_columns(columns)).order(duckdb_columns(keys + within))
+    parts = [compute(batch) for batch in duckdb_group_batches(ordered, keys)]
+    if not parts:
+        parts = [compute(relation.limit(0).df())]
+    return pd.concat(parts, ignore_index=True)
+
+
+# --- PASO 1: Cargar datos ---
+
+def stage_duckdb_load_main(main_file, element_codes, workers):
+    # Dataset principal en la tabla main_wide de DuckDB (fuera de la memoria
+    # de Python) y perfil de calidad con consultas agregadas
+    header = pd.read_csv(main_file, encoding='latin-1', nrows=0).columns
+    year_cols = [col for col in header if is_year_value_column(col)]
+    flag_cols = [col for col in header if is_year_flag_column(col)]
+    types = {col: DUCKDB_TYPES[dtype] for col, dtype in ID_DTYPES.items()}
+    types.update({col: DUCKDB_TYPES[PRICE_DTYPE] for col in year_cols})
+    types.update({col: 'VARCHAR' for col in flag_cols})
+
+    con = connect_duckdb(workers)
+    con.execute(f"CREATE TABLE main_wide AS SELECT {duckdb_columns(ID_COLUMNS + year_cols + flag_cols)} "
+                f"FROM read_csv(?, encoding = 'latin-1', header = true, types = ?)", [main_file, types])
+    main_stats = duckdb_quality_stats(con, year_cols, flag_cols)
+
+    kept = con.sql(f"SELECT count(*) FROM main_wide WHERE {duckdb_element_filter(element_codes)}").fetchone()[0]
+    print(f"DuckDB {duckdb.__version__}: memoria máxima {DUCKDB_MEMORY_LIMIT}, volcado a '{DUCKDB_TEMP_FOLDER}/'")
+    print(f"Dataset principal leído: {main_stats['rows_total']:,} filas")
+    print(f"  - Conservadas tras filtro de elemento: {kept:,} filas, "
+          f"{len(ID_COLUMNS) + len(year_cols) + len(flag_cols)} columnas")
+    return con, main_stats
+
+
+# --- PASO 3: Filtrado ---
+
+def stage_duckdb_filter(con, main_stats, validation, element_codes):
+    # Relación (sin materializar) con los elementos pedidos; row_id es la
+    # fila del archivo y desempata el orden como el sort estable de pandas
+    wide_cols = [col for col in con.table('main_wide').columns if is_year_value_column(col) or is_year_flag_column(col)]
+    filtered = con.sql(f"SELECT rowid AS row_id, {duckdb_columns(ID_COLUMNS + wide_cols)} FROM main_wide "
+                       f"WHERE {duckdb_element_filter(element_codes)}")
+
+    element_rows = filtered.query(
+        'filtered', 'SELECT "Element Code", "Element", count(*) FROM filtered GROUP BY ALL ORDER BY ALL').fetchall()
+    n_rows, n_areas, n_items = filtered.query(
+        'filtered', 'SELECT count(*), count(DISTINCT "Area"), count(DISTINCT "Item") FROM filtered').fetchone()
+    print(f"Filtrado por Element Code: {', '.join(str(code) for code, _, _ in element_rows)}")
+    for code, name, count in element_rows:
+        print(f"  - {code}: {name} ({count:,} registros)")
+    print(f"  - Registros antes: {main_stats['rows_total']:,}")
+    print(f"  - Registros después: {n_rows:,}")
+    print(f"  - Países únicos: {n_areas}")
+    print(f"  - Productos únicos: {n_items}")
+    return filtered
+
+
+# --- PASO 4: Reshape a formato long ---
+
+def stage_duckdb_reshape(df_filtered, main_stats):
+    # UNPIVOT de pares (Y####, Y####F) como structs; se descartan las celdas
+    # sin precio
+    year_value_cols = [col for col in df_filtered.columns if is_year_value_column(col)]
+    year_flag_cols = main_stats['year_flag_cols']
+
+    print(f"Columnas de valores identificadas: {len(year_value_cols)} (Y1991 a Y2024)")
+    print(f"Columnas de flags identificadas: {len(year_flag_cols)} (perfiladas en el PASO 2; la de cada precio "
+          f"pasa a la columna Flag)")
+
+    cells = []
+    for col in year_value_cols:
+        flag = (f"NULLIF({duckdb_identifier(col + 'F')}, '')" if col + 'F' in df_filtered.columns
+                else 'NULL::VARCHAR')
+        cells.append(f'struct_pack("Price" := {duckdb_identifier(col)}, "Flag" := {flag}) AS {duckdb_identifier(col)}')
+    df_long = df_filtered.query('filtered', (
+        f'SELECT * EXCLUDE (year_col, cell), CAST(substr(year_col, 2) AS SMALLINT) AS "Year", '
+        f'cell."Price" AS "Price", cell."Flag" AS "Flag" '
+        f'FROM (UNPIVOT (SELECT row_id, {duckdb_columns(ID_COLUMNS)}, {", ".join(cells)} FROM filtered) '
+        f'ON {duckdb_columns(year_value_cols)} INTO NAME year_col VALUE cell) WHERE cell."Price" IS NOT NULL'))
+    total_cells = df_filtered.query('filtered', 'SELECT count(*) FROM filtered').fetchone()[0] * len(year_value_cols)
+
+    print(f"Transformación completada:")
+    print(f"  - Celdas serie × año: {total_cells:,}")
+    print(f"  - Registros en formato long (solo valores observados): "
+          f"{df_long.query('long_rows', 'SELECT count(*) FROM long_rows').fetchone()[0]:,}")
+    print(f"  - Estructura: {[col for col in df_long.columns if col != 'row_id']}")
+    return df_long, total_cells
+
+
+# --- PASO 5: Limpieza de datos ---
+
+def stage_duckdb_clean(df_long, total_cells):
+    # Los nulos no llegan a crearse en el UNPIVOT (NO interpolamos)
+    total_after, year_min, year_max, n_years = df_long.query(
+        'long_rows', 'SELECT count(*), min("Year"), max("Year"), count(DISTINCT "Year") FROM long_rows').fetchone()
+    missing_before = total_cells - total_after
+
+    print(f"Valores faltantes antes de limpieza: {missing_before:,} / {total_cells:,} ({missing_before/total_cells*100:.1f}%)")
+    print(f"Registros después de eliminar nulos: {total_after:,}")
+    print(f"Registros eliminados: {total_cells - total_after:,}")
+    print(f"Cobertura temporal: {year_min} - {year_max}")
+    print(f"Años con datos: {n_years}")
+    return df_long
+
+
+# --- PASO 6: Clasificación (6.1-6.2) ---
+
+def duckdb_classify(df_clean, code_col, name_col, code_index, name_index, label):
+    """
+    classify_by_code() sobre los códigos distintos de df_clean, con el
+    nombre de su primera fila en el orden long del backend pandas (Year y
+    fila del archivo). Devuelve (DataFrame código -> etiqueta, sin clasificar).
+    """
+    codes = df_clean.query('long_rows', (
+        f'SELECT {duckdb_identifier(code_col)} AS code, arg_min({duckdb_identifier(name_col)}, ("Year", row_id)) AS name '
+        f'FROM long_rows GROUP BY code ORDER BY min(("Year", row_id))')).df()
+    labels, unmapped = classify_by_code(codes['code'], codes['name'], code_index, name_index)
+    mapping = pd.DataFrame({code_col: codes['code'].to_numpy(), label: np.asarray(labels, dtype=object)})
+    return mapping, unmapped
+
+
+def stage_duckdb_classify_regions(df_clean, aux_tables):
+    # --- 6.1: Asignación de regiones geográficas ---
+    print("\n6.1 Asignando regiones geográficas...")
+
+    region_name_index = build_name_index(REGION_MAPPING)
+    region_code_index = build_code_index(aux_tables['areas'], 'Area Code', 'Area', region_name_index)
+    region_map, unmapped_areas = duckdb_classify(
+        df_clean, 'Area Code', 'Area', region_code_index, region_name_index, 'Region')
+
+    area_names = df_clean.query('long_rows', 'SELECT DISTINCT "Area Code", "Area" FROM long_rows').df()
+    region_distribution = area_names.merge(region_map, on='Area Code').groupby('Region')['Area'].nunique()
+    print("Distribución por región:")
+    for region, count in region_distribution.items():
+        print(f"  - {region}: {count} países")
+    print_unmapped(unmapped_areas, 'área')
+    return region_map
+
+
+def stage_duckdb_classify_products(con, df_clean, region_map, aux_tables):
+    # --- 6.2: Categorización de productos ---
+    # Materializa main_long (única copia del formato long, dentro de DuckDB)
+    print("\n6.2 Categorizando productos...")
+
+    category_name_index = build_name_index(PRODUCT_CATEGORIES)
+    category_code_index = build_code_index(aux_tables['items'], 'Item Code', 'Item', category_name_index)
+    category_map, unmapped_items = duckdb_classify(
+        df_clean, 'Item Code', 'Item', category_code_index, category_name_index, 'Product_Category')
+
+    con.register('region_map', region_map)
+    con.register('category_map', category_map)
+    df_clean.query('long_rows', (
+        'SELECT long_rows.*, "Region", "Product_Category" FROM long_rows '
+        'JOIN region_map USING ("Area Code") JOIN category_map USING ("Item Code")')).create('main_long')
+    con.execute("DROP TABLE main_wide")
+
+    # Columnas de texto como ENUM con los valores ordenados: se ordenan por
+    # código como las categóricas de pandas y llegan a pandas como categóricas
+    for i, col in enumerate(['Area', 'Item', 'Element', 'Region', 'Product_Category']):
+        con.execute(f"CREATE TYPE text_enum_{i} AS ENUM "
+                    f"(SELECT DISTINCT {duckdb_identifier(col)} FROM main_long ORDER BY 1)")
+        con.execute(f"ALTER TABLE main_long ALTER {duckdb_identifier(col)} TYPE text_enum_{i}")
+    df_classified = con.table('main_long')
+
+    category_distribution = df_classified.query(
+        'classified', 'SELECT "Product_Category", count(*) AS n FROM classified GROUP BY ALL ORDER BY n DESC, "Product_Category"').fetchall()
+    print("Distribución por categoría de producto:")
+    for category, count in category_distribution[:15]:
+        print(f"  - {category}: {count:,} registros")
+    print_unmapped(unmapped_items, 'producto')
+    return df_classified
+
+
+# --- PASO 6: Anomalías y métricas (6.4-6.7) ---
+
+def stage_duckdb_anomalies(df_classified):
+    # Series completas en bloques, con las filas de cada año en el orden de
+    # df_sorted (row_id) como en el backend pandas
+    print("\nDetectando precios anómalos (mediana y MAD móviles por serie)...")
+    anomalies = duckdb_grouped(df_classified, ['Element Code', 'Area', 'Item'], ['Year', 'row_id'], detect_anomalies,
+                               columns=['Element', 'Region', 'Product_Category', 'Flag'])
+    total_rows = df_classified.query('classified', 'SELECT count(*) FROM classified').fetchone()[0]
+    print_anomalies(anomalies, total_rows)
+    return anomalies, pd.MultiIndex.from_frame(anomalies[['row_id', 'Year']])
+
+
+def stage_duckdb_screen_anomalies(con, df_classified, anomaly_keys):
+    # Relación de 6.4-6.7 con --exclude-anomalies: sin las celdas (row_id,
+    # Year) anómalas
+    con.register('anomaly_cells', anomaly_keys.to_frame(index=False))
+    df_metrics = df_classified.query(
+        'classified', 'SELECT * FROM classified ANTI JOIN anomaly_cells USING (row_id, "Year")')
+    print(f"Excluidos de las métricas 6.4-6.7: {len(anomaly_keys):,} precios anómalos")
+    return df_metrics
+
+
+def stage_duckdb_country_metrics(df_metrics, trend_windows):
+    print("\n6.4 Calculando métricas a nivel de país...")
+    keys = ['Element Code', 'Area', 'Region']
+    country_metrics = duckdb_grouped(df_metrics, keys, ['Year', 'Item', 'row_id'],
+                                     lambda batch: calculate_group_metrics(batch, keys, trend_windows))
+
+    round_metrics(country_metrics, trend_windows)
+
+    print(f"Métricas calculadas para {country_metrics['Area'].nunique()} países")
+    return country_metrics
+
+
+def stage_duckdb_product_metrics(df_metrics, trend_windows):
+    print("\n6.5 Calculando métricas a nivel de producto...")
+    keys = ['Element Code', 'Item', 'Product_Category']
+    product_metrics = duckdb_grouped(df_metrics, keys, ['Year', 'Area', 'row_id'],
+                                     lambda batch: calculate_group_metrics(batch, keys, trend_windows))
+
+    round_metrics(product_metrics, trend_windows)
+
+    print(f"Métricas calculadas para {product_metrics['Item'].nunique()} productos")
+    return product_metrics
+
+
+def stage_duckdb_regional_aggregates(df_metrics):
+    print("\n6.6 Calculando agregados regionales...")
+    regional_aggregates = duckdb_grouped(
+        df_metrics, ['Element Code', 'Region', 'Year', 'Product_Category'], ['Area', 'Item', 'row_id'],
+        calculate_regional_aggregates)
+
+    round_metrics(regional_aggregates)
+
+    print(f"Agregados regionales: {len(regional_aggregates):,} registros")
+    return regional_aggregates
+
+
+def stage_duckdb_country_category_metrics(df_metrics, trend_windows):
+    print("\n6.7 Calculando métricas por país y categoría...")
+    keys = ['Element Code', 'Area', 'Region', 'Product_Category']
+    country_category_metrics = duckdb_grouped(df_metrics, keys, ['Year', 'Item', 'row_id'],
+                                              lambda batch: calculate_group_metrics(batch, keys, trend_windows))
+
+    round_metrics(country_category_metrics, trend_windows)
+
+    print(f"Métricas país-categoría: {len(country_category_metrics):,} combinaciones")
+    return country_category_metrics
+
+
+# --- PASO 7: Exportar archivos CSV ---
+
+def stage_duckdb_export_long(df_classified, element_codes, export_formats, export_pool):
+    """
+    6.3 y 01: recorre las series en el orden de df_sorted por bloques de
+    series completas, calcula la YoY de cada bloque con yoy_change() y lo
+    añade al 01 de su elemento en cada formato. Las escrituras de un bloque
+    van a export_pool mientras se calcula el siguiente (cada archivo recibe
+    sus bloques en orden). Devuelve las rutas escritas.
+    """
+    print("6.3 Calculando variación interanual (por bloques)...")
+    series_keys = ['Element Code', 'Area', 'Item']
+    columns = ['Element Code', 'row_id'] + LONG_OUTPUT_COLUMNS[:-1]
+    ordered = df_classified.project(duckdb_columns(columns)).order(duckdb_columns(series_keys + ['Year', 'row_id']))
+
+    written = {}
+    writers = {}
+    pending = {}
+
+    def append(code, part):
+        if code not in written:
+            folder = element_output_folder(code)
+            os.makedirs(folder, exist_ok=True)
+            for fmt in export_formats[LONG_ARTIFACT]:
+                path = export_path(folder, LONG_ARTIFACT, fmt)
+                writers[path] = EXPORT_WRITERS[fmt](path, LONG_ARTIFACT)
+            written[code] = 0
+        for fmt in export_formats[LONG_ARTIFACT]:
+            path = export_path(element_output_folder(code), LONG_ARTIFACT, fmt)
+            if path in pending:
+                pending[path].result()
+            pending[path] = export_pool.submit(writers[path][0], part)
+        written[code] += len(part)
+
+    yoy_valid = 0
+    try:
+        for batch in duckdb_group_batches(ordered, series_keys):
+            series_start = np.zeros(len(batch), dtype=bool)
+            series_start[:1] = True
+            for key in series_keys:
+                values = duckdb_key_values(batch[key])
+                series_start[1:] |= values[1:] != values[:-1]
+            batch['YoY_Change'] = yoy_change(np.cumsum(series_start), batch['Price'].to_numpy())
+            yoy_valid += int(batch['YoY_Change'].notna().sum())
+
+            for code, part in split_by_element(batch, ALL_ELEMENTS):
+                append(code, part[LONG_OUTPUT_COLUMNS])
+        print(f"Variaciones YoY calculadas: {yoy_valid:,} registros con valor válido\n")
+
+        # Elementos pedidos sin datos: archivo solo con cabecera, como en pandas
+        for code in ([] if element_codes == ALL_ELEMENTS else element_codes):
+            if code not in written:
+                append(code, pd.DataFrame(columns=LONG_OUTPUT_COLUMNS))
+        for future in pending.values():
+            future.result()
+    finally:
+        for future in pending.values():
+            future.exception()  # esperar a las escrituras en curso antes de cerrar
+        for _, close in writers.values():
+            close()
+
+    paths = []
+    for code in sorted(written):
+        for fmt in export_formats[LONG_ARTIFACT]:
+            path = export_path(element_output_folder(code), LONG_ARTIFACT, fmt)
+            print_export(path, written[code])
+            paths.append(path)
+    return paths
+
+
+def stage_duckdb_export_tensor(df_classified, element_codes):
+    # 6. Tensor de cada elemento: ejes y celdas (la primera fila del archivo
+    # de cada celda, arg_min por row_id) agregados en DuckDB
+    print("\nExportando tensor Área × Producto × Año...")
+    if element_codes == ALL_ELEMENTS:
+        codes = [code for (code,) in df_classified.query(
+            'classified', 'SELECT DISTINCT "Element Code" FROM classified ORDER BY 1').fetchall()]
+    else:
+        codes = element_codes
+    paths = []
+    for code in codes:
+        rows = df_classified.filter(f'"Element Code" = {int(code)}')
+        areas = rows.query('element_rows', (
+            'SELECT "Area Code", arg_min("Area", ("Year", row_id)) AS "Area", arg_min("Region", ("Year", row_id)) '
+            'AS "Region" FROM element_rows GROUP BY "Area Code" ORDER BY "Area", "Area Code"')).df()
+        items = rows.query('element_rows', (
+            'SELECT "Item Code", arg_min("Item", ("Year", row_id)) AS "Item", arg_min("Product_Category", '
+            '("Year", row_id)) AS "Product_Category" FROM element_rows GROUP BY "Item Code" ORDER BY "Item", "Item Code"')).df()
+        n_rows, year_min, year_max = rows.query(
+            'element_rows', 'SELECT count(*), min("Year"), max("Year") FROM element_rows').fetchone()
+        years = np.arange(year_min, year_max + 1) if n_rows else np.array([], dtype='int64')
+        areas = areas.astype({'Area': str, 'Region': str})
+        items = items.astype({'Item': str, 'Product_Category': str})
+
+        cells = rows.query('element_rows', (
+            'SELECT "Area Code", "Item Code", "Year", arg_min("Price", row_id) AS "Price" '
+            'FROM element_rows GROUP BY ALL'))
+        folder = os.path.join(element_output_folder(code), TENSOR_ARTIFACT)
+        observed = write_price_tensor(folder, areas, items, years, duckdb_batches(cells))
+        print_tensor_export(folder, areas, items, years, observed, n_rows - observed)
+        paths.append(folder)
+    return paths
+
+
+def stage_duckdb_export_cube(df_classified, element_codes):
+    # 7. Cubo de agregados: celdas completas en bloques, con las filas de
+    # cada celda en el orden del archivo como en pandas
+    print("\nExportando cubo de agregados (Region × Categoría × Área × Año)...")
+    cube = duckdb_grouped(df_classified, ['Element Code'] + CUBE_DIMENSIONS, ['row_id'], build_rollup_cube)
+    return write_rollup_cube(cube, element_codes)
+
+
+def stage_duckdb_export_trends(df_classified, element_codes, rolling_windows):
+    # 9. Celdas (grupo, año) en bloques de grupos completos, con las filas de
+    # cada año en el orden de df_sorted como en las métricas 6.4 y 6.5
+    print("\nExportando ventanas de tendencia (todos los pares de años y móviles)...")
+    levels = {}
+    for level, (keys, tie) in TREND_LEVELS.items():
+        group_keys = ['Element Code'] + keys
+        levels[level] = duckdb_grouped(df_classified, group_keys, ['Year', tie, 'row_id'],
+                                       lambda batch: group_year_stats(batch, group_keys, tie))
+    return write_trend_windows(levels, element_codes, rolling_windows)
+
+
+def stage_duckdb_export_metrics(name, table, element_codes, export_formats, export_pool):
+    # Las tablas de métricas ya son pequeñas: se exportan como en pandas
+    return stage_export_metrics(name, table, None, element_codes, export_formats, export_pool)
+
+
+# =============================================================================
+# ORQUESTACIÓN
+# =============================================================================
+
+# (nombre, título del PASO, función, entradas, salidas). Las entradas que
+# ninguna etapa produce (main_file, element_codes, incremental, pool,
+# workers, export_formats, export_pool, trend_windows, rolling_windows,
+# exclude_anomalies) son opciones de la ejecución.
+PIPELINE_STAGES = [
+    ('load_main', 'PASO 1: CARGANDO DATOS', stage_load_main,
+     ['main_file', 'element_codes'], ['df_main', 'main_stats']),
+    ('load_aux', 'PASO 1: CARGANDO DATOS', stage_load_aux,
+     [], ['aux_tables']),
+    ('validate', 'PASO 2: VALIDACIÓN ESTRUCTURAL', stage_validate,
+     ['main_stats', 'aux_tables'], ['validation']),
+    ('filter', 'PASO 3: FILTRADO POR ELEMENTO COMPARABLE', stage_filter,
+     ['df_main', 'main_stats', 'validation'], ['df_filtered']),
+    ('reshape', 'PASO 4: TRANSFORMACIÓN A FORMATO LONG', stage_reshape,
+     ['df_filtered', 'main_stats'], ['df_long', 'total_cells']),
+    ('clean', 'PASO 5: LIMPIEZA DE DATOS', stage_clean,
+     ['df_long', 'total_cells'], ['df_clean']),
+    ('classify_regions', 'PASO 6: CÁLCULO DE MÉTRICAS', stage_classify_regions,
+     ['df_clean', 'aux_tables'], ['df_regions']),
+    ('classify_products', 'PASO 6: CÁLCULO DE MÉTRICAS', stage_classify_products,
+     ['df_regions', 'aux_tables'], ['df_classified']),
+    ('export_' + TENSOR_ARTIFACT, 'PASO 6: CÁLCULO DE MÉTRICAS', stage_export_tensor,
+     ['df_classified', 'element_codes'], [TENSOR_ARTIFACT]),
+    ('export_' + CUBE_ARTIFACT, 'PASO 6: CÁLCULO DE MÉTRICAS', stage_export_cube,
+     ['df_classified', 'element_codes'], [CUBE_ARTIFACT]),
+    ('export_' + TRENDS_ARTIFACT, 'PASO 6: CÁLCULO DE MÉTRICAS', stage_export_trends,
+     ['df_classified', 'element_codes', 'rolling_windows'], [TRENDS_ARTIFACT]),
+    ('anomalies', 'PASO 6: CÁLCULO DE MÉTRICAS', stage_anomalies,
+     ['df_classified', 'pool', 'workers'], ['anomalies', 'anomaly_keys']),
+    ('incremental', 'PASO 6: CÁLCULO DE MÉTRICAS', stage_incremental,
+     ['df_classified', 'incremental', 'trend_windows', 'exclude_anomalies'],
+     ['df_work', 'series_table', 'incremental_plan']),
+    ('sort', 'PASO 6: CÁLCULO DE MÉTRICAS', stage_sort,
+     ['df_work'], ['df_sorted']),
+    ('metric_rows', 'PASO 6: CÁLCULO DE MÉTRICAS', stage_metric_rows,
+     ['df_sorted'], ['df_metrics']),
+    ('yoy', 'PASO 6: CÁLCULO DE MÉTRICAS', stage_yoy,
+     ['df_sorted', 'pool', 'workers'], ['df_yoy']),
+    ('country_metrics', 'PASO 6: CÁLCULO DE MÉTRICAS', stage_country_metrics,
+     ['df_metrics', 'trend_windows', 'pool', 'workers'], ['country_metrics']),
+    ('product_metrics', 'PASO 6: CÁLCULO DE MÉTRICAS', stage_product_metrics,
+     ['df_metrics', 'trend_windows', 'pool', 'workers'], ['product_metrics']),
+    ('regional_aggregates', 'PASO 6: CÁLCULO DE MÉTRICAS', stage_regional_aggregates,
+     ['df_metrics', 'pool', 'workers'], ['regional_aggregates']),
+    ('country_category_metrics', 'PASO 6: CÁLCULO DE MÉTRICAS', stage_country_category_metrics,
+     ['df_metrics', 'trend_windows', 'pool', 'workers'], ['country_category_metrics']),
+    ('export_' + LONG_ARTIFACT, 'PASO 7: EXPORTANDO ARCHIVOS CSV', stage_export_long,
+     ['df_yoy', 'series_table', 'incremental_plan', 'element_codes', 'export_formats', 'export_pool'],
+     [LONG_ARTIFACT, 'long_offsets']),
+] + [
+    ('export_' + name, 'PASO 7: EXPORTANDO ARCHIVOS CSV', functools.partial(stage_export_metrics, name),
+     [ARTIFACT_TABLES[name], 'incremental_plan', 'element_codes', 'export_formats', 'export_pool'], [name])
+    for name in METRIC_ARTIFACT_KEYS
+] + [
+    ('export_' + ANOMALIES_ARTIFACT, 'PASO 7: EXPORTANDO ARCHIVOS CSV', stage_export_anomalies,
+     ['anomalies', 'element_codes'], [ANOMALIES_ARTIFACT]),
+    ('export_' + DASHBOARD_ARTIFACT, 'PASO 7: EXPORTANDO ARCHIVOS CSV', stage_export_dashboard,
+     ['element_codes', '02_Country_Metrics', '03_Product_Metrics', '04_Regional_Aggregates', CUBE_ARTIFACT],
+     [DASHBOARD_ARTIFACT]),
+    ('save_state', 'PASO 7: EXPORTANDO ARCHIVOS CSV', stage_save_state,
+     ['long_offsets', 'trend_windows', 'exclude_anomalies'] + list(ARTIFACT_TABLES), ['incremental_state']),
+]
+
+# Backend duckdb: mismas salidas y mismos PASOS; 'duckdb' es la conexión y
+# las tablas intermedias son relaciones DuckDB (consultas sin materializar,
+# salvo main_long). Con --workers N DuckDB usa N hilos.
+DUCKDB_PIPELINE_STAGES = [
+    ('duckdb_load_main', 'PASO 1: CARGANDO DATOS', stage_duckdb_load_main,
+     ['main_file', 'element_codes', 'workers'], ['duckdb', 'main_stats']),
+    ('load_aux', 'PASO 1: CARGANDO DATOS', stage_load_aux,
+     [], ['aux_tables']),
+    ('validate', 'PASO 2: VALIDACIÓN ESTRUCTURAL', stage_validate,
+     ['main_stats', 'aux_tables'], ['validation']),
+    ('duckdb_filter', 'PASO 3: FILTRADO POR ELEMENTO COMPARABLE', stage_duckdb_filter,
+     ['duckdb', 'main_stats', 'validation', 'element_codes'], ['df_filtered']),
+    ('duckdb_reshape', 'PASO 4: TRANSFORMACIÓN A FORMATO LONG', stage_duckdb_reshape,
+     ['df_filtered', 'main_stats'], ['df_long', 'total_cells']),
+    ('duckdb_clean', 'PASO 5: LIMPIEZA DE DATOS', stage_duckdb_clean,
+     ['df_long', 'total_cells'], ['df_clean']),
+    ('duckdb_classify_regions', 'PASO 6: CÁLCULO DE MÉTRICAS', stage_duckdb_classify_regions,
+     ['df_clean', 'aux_tables'], ['region_map']),
+    ('duckdb_classify_products', 'PASO 6: CÁLCULO DE MÉTRICAS', stage_duckdb_classify_products,
+     ['duckdb', 'df_clean', 'region_map', 'aux_tables'], ['df_classified']),
+    ('export_' + TENSOR_ARTIFACT, 'PASO 6: CÁLCULO DE MÉTRICAS', stage_duckdb_export_tensor,
+     ['df_classified', 'element_codes'], [TENSOR_ARTIFACT]),
+    ('export_' + CUBE_ARTIFACT, 'PASO 6: CÁLCULO DE MÉTRICAS', stage_duckdb_export_cube,
+     ['df_classified', 'element_codes'], [CUBE_ARTIFACT]),
+    ('export_' + TRENDS_ARTIFACT, 'PASO 6: CÁLCULO DE MÉTRICAS', stage_duckdb_export_trends,
+     ['df_classified', 'element_codes', 'rolling_windows'], [TRENDS_ARTIFACT]),
+    ('duckdb_anomalies', 'PASO 6: CÁLCULO DE MÉTRICAS', stage_duckdb_anomalies,
+     ['df_classified'], ['anomalies', 'anomaly_keys']),
+    ('duckdb_metric_rows', 'PASO 6: CÁLCULO DE MÉTRICAS', stage_metric_rows,
+     ['df_classified'], ['df_metrics']),
+    ('duckdb_country_metrics', 'PASO 6: CÁLCULO DE MÉTRICAS', stage_duckdb_country_metrics,
+     ['df_metrics', 'trend_windows'], ['country_metrics']),
+    ('duckdb_product_metrics', 'PASO 6: CÁLCULO DE MÉTRICAS', stage_duckdb_product_metrics,
+     ['df_metrics', 'trend_windows'], ['product_metrics']),
+    ('duckdb_regional_aggregates', 'PASO 6: CÁLCULO DE MÉTRICAS', stage_duckdb_regional_aggregates,
+     ['df_metrics'], ['regional_aggregates']),
+    ('duckdb_country_category_metrics', 'PASO 6: CÁLCULO DE MÉTRICAS', stage_duckdb_country_category_metrics,
+     ['df_metrics', 'trend_windows'], ['country_category_metrics']),
+    ('export_' + LONG_ARTIFACT, 'PASO 7: EXPORTANDO ARCHIVOS CSV', stage_duckdb_export_long,
+     ['df_classified', 'element_codes', 'export_formats', 'export_pool'], [LONG_ARTIFACT]),
+] + [
+    ('export_' + name, 'PASO 7: EXPORTANDO ARCHIVOS CSV', functools.partial(stage_duckdb_export_metrics, name),
+     [ARTIFACT_TABLES[name], 'element_codes', 'export_formats', 'export_pool'], [name])
+    for name in METRIC_ARTIFACT_KEYS
+] + [
+    ('export_' + ANOMALIES_ARTIFACT, 'PASO 7: EXPORTANDO ARCHIVOS CSV', stage_export_anomalies,
+     ['anomalies', 'element_codes'], [ANOMALIES_ARTIFACT]),
+    ('export_' + DASHBOARD_ARTIFACT, 'PASO 7: EXPORTANDO ARCHIVOS CSV', stage_export_dashboard,
+     ['element_codes', '02_Country_Metrics', '03_Product_Metrics', '04_Regional_Aggregates', CUBE_ARTIFACT],
+     [DASHBOARD_ARTIFACT]),
+]
+
+PIPELINE_BACKENDS = {'pandas': PIPELINE_STAGES, 'duckdb': DUCKDB_PIPELINE_STAGES}
+
+# Con --exclude-anomalies, la etapa que produce df_metrics en cada backend
+# (en lugar de metric_rows): solo entonces 6.4-6.7 esperan a la detección
+ANOMALY_SCREEN_STAGES = {
+    'pandas': ('screen_anomalies', 'PASO 6: CÁLCULO DE MÉTRICAS', stage_screen_anomalies,
+               ['df_sorted', 'anomaly_keys'], ['df_metrics']),
+    'duckdb': ('duckdb_screen_anomalies', 'PASO 6: CÁLCULO DE MÉTRICAS', stage_duckdb_screen_anomalies,
+               ['duckdb', 'df_classified', 'anomaly_keys'], ['df_metrics']),
+}
+
+
+def backend_pipeline(backend, exclude_anomalies=False):
+    # Etapas del backend con la variante de df_metrics de las opciones
+    pipeline = PIPELINE_BACKENDS[backend]
+    if not exclude_anomalies:
+        return pipeline
+    screen = ANOMALY_SCREEN_STAGES[backend]
+    return [screen if stage[4] == screen[4] else stage for stage in pipeline]
+
+# Etapas que usan el pool de procesos de --workers
+POOL_STAGES = {'anomalies', 'yoy', 'country_metrics', 'product_metrics', 'regional_aggregates', 'country_category_metrics'}
+
+
+def resolve_stages(targets, pipeline=PIPELINE_STAGES):
+    """
+    Etapas de pipeline necesarias para producir targets (nombres de salida:
+    artefactos como '04_Regional_Aggregates' o tablas como
+    'regional_aggregates'), en el orden de pipeline.
+    """
+    producer = {output: i for i, (_, _, _, _, outputs) in enumerate(pipeline) for output in outputs}
+    unknown = [target for target in targets if target not in producer]
+    if unknown:
+        raise ValueError(f"Salidas desconocidas: {', '.join(unknown)}")
+
+    needed = set()
+    pending = list(targets)
+    while pending:
+        i = producer.get(pending.pop())
+        if i is None or i in needed:
+            continue
+        needed.add(i)
+        pending.extend(pipeline[i][3])
+    return [pipeline[i] for i in sorted(needed)]
+
+
+def stage_dependencies(stages):
+    # Para cada etapa, las etapas de stages (índices) que producen sus
+    # entradas; las opciones de la ejecución no tienen productor
+    producer = {output: i for i, (_, _, _, _, outputs) in enumerate(stages) for output in outputs}
+    return [sorted({producer[name] for name in inputs if name in producer})
+            for _, _, _, inputs, _ in stages]
+
+
+def critical_path(stages, records):
+    """
+    Cadena de dependencias con más tiempo de pared acumulado: la que acota
+    la duración de la ejecución aunque el resto de etapas vaya en paralelo.
+    records va en el orden de stages. Devuelve (índices de la cadena, segundos).
+    """
+    if not records:
+        return [], 0.0
+    finish, previous = [], []
+    for i, dependencies in enumerate(stage_dependencies(stages)):
+        before = max(dependencies, key=finish.__getitem__, default=None)
+        previous.append(before)
+        finish.append(records[i]['wall_s'] + (0.0 if before is None else finish[before]))
+    last = max(range(len(finish)), key=finish.__getitem__)
+    path, i = [], last
+    while i is not None:
+        path.append(i)
+        i = previous[i]
+    return path[::-1], round(finish[last], 3)
+
+
+class _StageOutput:
+    """
+    sys.stdout de las ejecuciones con varios hilos de etapas: lo que imprime
+    cada etapa se acumula en un búfer de su hilo y se vuelca entero al
+    terminar, para que las salidas de etapas simultáneas no se mezclen.
+    """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+
+    def write(self, text):
+        return getattr(self.local, 'buffer', self.stream).write(text)
+
+    def flush(self):
+        self.stream.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
+
+    def capture(self, func, *args):
+        # Ejecuta func(*args) en el hilo actual: devuelve (resultado, texto
+        # impreso). Si falla, el texto se vuelca antes de propagar el error.
+        buffer = self.local.buffer = io.StringIO()
+        try:
+            result = func(*args)
+        except BaseException:
+            self.stream.write(buffer.getvalue())
+            raise
+        finally:
+            del self.local.buffer
+        return result, buffer.getvalue()
+
+
+# Pico de RSS por etapa (--stage-peak, solo Linux; lo usa benchmark.py):
+# VmHWM de /proc/self/status se reinicia al empezar cada etapa escribiendo 5
+# en /proc/self/clear_refs, así que el pico leído al terminar es el de la
+# etapa. ru_maxrss no sirve para eso: es el máximo de todo el proceso (y en
+# Linux hereda el del proceso que lo lanzó). El reinicio afecta también al
+# maxrss que ven el proceso padre o /usr/bin/time, por eso no se hace en una
+# ejecución normal; con --stage-peak el pico de la ejecución es el total
+# del informe
+PROC_STATUS_FILE = '/proc/self/status'
+PROC_CLEAR_REFS_FILE = '/proc/self/clear_refs'
+_rss_peak_seen_mb = 0.0
+
+
+def _proc_status_mb(*fields):
+    # Campos de memoria (kB) de /proc/self/status en MB; None si no se pueden leer
+    try:
+        with open(PROC_STATUS_FILE, encoding='ascii') as f:
+            values = {key: int(value.split()[0]) / 1024
+                      for key, value in (line.split(':', 1) for line in f) if key in fields}
+    except OSError:
+        return None
+    return values if len(values) == len(fields) else None
+
+
+def start_stage_rss():
+    """
+    Reinicia el pico de RSS del proceso para medir el de una etapa y
+    devuelve el RSS actual en MB (None si el sistema no lo permite). El pico
+    anterior se guarda para que peak_rss_mb() siga siendo el de toda la
+    ejecución.
+    """
+    global _rss_peak_seen_mb
+    status = _proc_status_mb('VmRSS', 'VmHWM')
+    if status is None:
+        return None
+    try:
+        with open(PROC_CLEAR_REFS_FILE, 'w', encoding='ascii') as f:
+            f.write('5')
+    except OSError:
+        return None
+    _rss_peak_seen_mb = max(_rss_peak_seen_mb, status['VmHWM'])
+    return status['VmRSS']
+
+
+def stage_rss_peak_mb(rss_start):
+    # Pico de RSS desde start_stage_rss() por encima del RSS de entonces
+    status = _proc_status_mb('VmHWM')
+    return None if status is None else max(status['VmHWM'] - rss_start, 0.0)
+
+
+def peak_rss_mb():
+    # Pico de memoria residente del proceso hasta ahora (None si no se puede medir)
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max(peak / 1024**2 if sys.platform == 'darwin' else peak / 1024, _rss_peak_seen_mb)
+
+
+def count_rows(values):
+    # Filas de cada DataFrame entre los valores de una etapa
+    return {name: len(value) for name, value in values.items() if isinstance(value, pd.DataFrame)}
+
+
+def run_instrumented(func, args, trace_memory=False, profile_path=None, stage_peak=False):
+    """
+    Ejecuta func(*args) midiendo tiempo de pared, CPU del proceso principal
+    (no incluye los workers), pico de RSS y, con trace_memory, el pico de
+    memoria asignada según tracemalloc (que debe estar activo). Con
+    stage_peak (sin otras etapas en paralelo) mide además el pico de RSS de
+    la propia etapa sobre el RSS con que empieza (stage_rss_peak_mb). Con
+    profile_path guarda un volcado de cProfile. Devuelve (resultado, métricas).
+    """
+    rss_start = start_stage_rss() if stage_peak else None
+    rss_before = peak_rss_mb()
+    if trace_memory:
+        tracemalloc.reset_peak()
+        traced_before = tracemalloc.get_traced_memory()[0]
+    profiler = cProfile.Profile() if profile_path else None
+
+    wall_start, cpu_start = time.perf_counter(), time.process_time()
+    if profiler is not None:
+        profiler.enable()
+    try:
+        result = func(*args)
+    finally:
+        if profiler is not None:
+            profiler.disable()
+    metrics = {
+        'wall_s': round(time.perf_counter() - wall_start, 3),
+        'cpu_s': round(time.process_time() - cpu_start, 3),
+    }
+
+    rss_after = peak_rss_mb()
+    if rss_after is not None:
+        metrics['peak_rss_mb'] = round(rss_after, 1)
+        metrics['peak_rss_growth_mb'] = round(rss_after - rss_before, 1)
+    stage_rss = None if rss_start is None else stage_rss_peak_mb(rss_start)
+    if stage_rss is not None:
+        metrics['stage_rss_peak_mb'] = round(stage_rss, 1)
+    if trace_memory:
+        current, peak = tracemalloc.get_traced_memory()
+        metrics['traced_peak_mb'] = round((peak - traced_before) / 1024**2, 1)
+        metrics['traced_delta_mb'] = round((current - traced_before) / 1024**2, 1)
+    if profiler is not None:
+        os.makedirs(os.path.dirname(profile_path) or '.', exist_ok=True)
+        profiler.dump_stats(profile_path)
+        metrics['profile'] = profile_path
+    return result, metrics
+
+
+def write_run_report(path, report):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+
+
+def print_stage_timings(records):
+    print("\n" + "=" * 60)
+    print("TIEMPOS POR ETAPA")
+    print("=" * 60)
+    for record in records:
+        rows_in = sum(record['rows_in'].values())
+        rows_out = sum(record['rows_out'].values())
+        rss = f"  RSS {record['peak_rss_mb']:,.0f} MB" if 'peak_rss_mb' in record else ''
+        print(f"  {record['stage']:<36} {record['wall_s']:>7.2f} s  CPU {record['cpu_s']:>7.2f} s"
+              f"{rss}  filas {rows_in:,} -> {rows_out:,}")
+
+
+def print_critical_path(records, path, path_s, total_s):
+    print("\n" + "=" * 60)
+    print("RUTA CRÍTICA")
+    print("=" * 60)
+    for i in path:
+        print(f"  {records[i]['stage']:<36} {records[i]['wall_s']:>7.2f} s")
+    print(f"  Ruta crítica: {path_s:.2f} s | suma de etapas: {sum(record['wall_s'] for record in records):.2f} s"
+          f" | ejecución: {total_s:.2f} s")
+
+
+def create_metrics_pool(workers):
+    # Las funciones de los workers son de nivel de módulo, así que el pool
+    # funciona con cualquier método de arranque (fork o spawn)
+    if workers <= 1:
+        return None
+    return ProcessPoolExecutor(max_workers=workers)
+
+
+def run_pipeline(targets=None, main_file=MAIN_DATA_FILE, element_codes=DEFAULT_ELEMENT_CODES,
+                 incremental=False, workers=1, report_path=RUN_REPORT_FILE, trace_memory=False,
+                 profile_stage=None, backend='pandas', export_formats=None, trend_windows=None,
+                 rolling_windows=None, stage_threads=STAGE_THREADS, exclude_anomalies=EXCLUDE_ANOMALIES,
+                 stage_peak=False):
+    """
+    Ejecuta solo las etapas de las que dependen targets (por defecto, los
+    artefactos de OUTPUT_ARTIFACTS y el estado incremental) y devuelve un dict con las
+    salidas pedidas. Las tablas intermedias se liberan en cuanto ninguna
+    etapa pendiente las necesita.
+
+    element_codes es una lista de códigos o ALL_ELEMENTS: todos se leen y
+    transforman juntos y las salidas se reparten por elemento. backend
+    elige entre las etapas pandas (PIPELINE_STAGES) y las de DuckDB
+    (DUCKDB_PIPELINE_STAGES), que no admiten el modo incremental.
+
+    export_formats elige los formatos de cada artefacto 01-05 ({artefacto:
+    [formatos]}, ver EXPORT_FORMATS; por defecto csv); las escrituras se
+    reparten entre EXPORT_THREADS hilos.
+
+    trend_windows añade ventanas (inicio, fin) a TREND_WINDOWS: una columna
+    Trend_<inicio>_<fin> más en 02, 03 y 05. rolling_windows sustituye a
+    ROLLING_WINDOWS (años de las ventanas móviles de 09_Trend_Windows).
+    exclude_anomalies quita de las métricas 6.4-6.7 los precios de
+    10_Price_Anomalies.
+
+    stage_threads > 1 ejecuta a la vez, en ese número de hilos, las etapas
+    cuyas entradas ya están calculadas (solo backend pandas); la salida de
+    cada etapa se imprime completa al terminar. Con 1 se ejecutan en el
+    orden del pipeline. En ambos casos se imprime la ruta crítica (la
+    cadena de dependencias más larga), que acota el tiempo total.
+
+    Cada etapa se mide con run_instrumented(); al terminar se escribe el
+    informe JSON en report_path (None para no escribirlo). stage_peak añade
+    el pico de RSS de cada etapa (reinicia el pico del proceso, ver
+    start_stage_rss). profile_stage guarda un volcado de cProfile de esa
+    etapa en REPORT_FOLDER.
+    """
+    if backend not in PIPELINE_BACKENDS:
+        raise ValueError(f"Backend desconocido: {backend} (disponibles: {', '.join(BACKENDS)})")
+    if incremental and backend != 'pandas':
+        raise ValueError("El modo incremental solo está disponible en el backend pandas")
+    full_build = not targets
+    if full_build:
+        targets = OUTPUT_ARTIFACTS + (['incremental_state'] if backend == 'pandas' else [])
+    else:
+        targets = list(targets)
+    if incremental and not full_build:
+        raise ValueError("El modo incremental parchea los cinco artefactos: no admite targets")
+    element_codes = normalize_element_codes(element_codes)
+    if incremental and element_codes != DEFAULT_ELEMENT_CODES:
+        raise ValueError("El modo incremental solo admite los elementos por defecto")
+    export_formats = normalize_export_formats(export_formats)
+    if incremental and export_formats != normalize_export_formats():
+        raise ValueError("El modo incremental solo parchea archivos csv: no admite otros formatos")
+    trend_windows = normalize_trend_windows(trend_windows)
+    rolling_windows = normalize_rolling_windows(rolling_windows)
+    stage_threads = max(1, stage_threads)
+    if stage_threads > 1 and backend != 'pandas':
+        raise ValueError("Las etapas DuckDB comparten una conexión: no admiten varios hilos de etapas "
+                         "(DuckDB ya paraleliza cada consulta con --workers)")
+    if stage_threads > 1 and trace_memory:
+        raise ValueError("trace_memory mide picos de todo el proceso: no admite varios hilos de etapas")
+    if stage_threads > 1 and stage_peak:
+        raise ValueError("stage_peak reinicia el pico de todo el proceso: no admite varios hilos de etapas")
+    stages = resolve_stages(targets, backend_pipeline(backend, exclude_anomalies))
+    if profile_stage is not None and profile_stage not in [stage[0] for stage in stages]:
+        raise ValueError(f"La etapa '{profile_stage}' no se ejecuta para estos artefactos")
+
+    # Dependencias entre etapas y consumidores pendientes de cada valor
+    dependencies = stage_dependencies(stages)
+    waiting = [len(before) for before in dependencies]
+    dependents = [[] for _ in stages]
+    for i, before in enumerate(dependencies):
+        for j in before:
+            dependents[j].append(i)
+    pending_uses = {}
+    for _, _, _, inputs, _ in stages:
+        for name in inputs:
+            pending_uses[name] = pending_uses.get(name, 0) + 1
+
+    workers = max(1, workers)
+    started = datetime.now()
+    run_wall, run_cpu = time.perf_counter(), time.process_time()
+    started_tracing = trace_memory and not tracemalloc.is_tracing()
+    if started_tracing:
+        tracemalloc.start()
+
+    pool = create_metrics_pool(workers) if any(stage[0] in POOL_STAGES for stage in stages) else None
+    export_pool = ThreadPoolExecutor(max_workers=EXPORT_THREADS) if any(
+        'export_pool' in stage[3] for stage in stages) else None
+    values = {'main_file': main_file, 'element_codes': element_codes, 'incremental': incremental,
+              'pool': pool, 'workers': workers, 'export_formats': export_formats, 'export_pool': export_pool,
+              'trend_windows': trend_windows, 'rolling_windows': rolling_windows,
+              'exclude_anomalies': exclude_anomalies}
+    records = [None] * len(stages)
+    announced = {'steps': [], 'pool': False}
+
+    def announce(i):
+        # Cabecera del PASO (y aviso del pool) antes de la salida de la etapa
+        # i; con varios hilos las etapas terminan en otro orden y cada PASO
+        # se anuncia solo la primera vez
+        name, step = stages[i][:2]
+        if step not in announced['steps']:
+            print(("\n" if announced['steps'] else "") + "=" * 60)
+            print(step)
+            print("=" * 60)
+            announced['steps'].append(step)
+        if pool is not None and name in POOL_STAGES and not announced['pool']:
+            print(f"\nEjecución paralela: {workers} procesos")
+            announced['pool'] = True
+
+    def execute(i, args):
+        name, _, func, inputs, _ = stages[i]
+        profile_path = os.path.join(REPORT_FOLDER, f'profile_{name}.prof') if name == profile_stage else None
+        start = time.perf_counter()
+        result, metrics = run_instrumented(func, args, trace_memory, profile_path, stage_peak=stage_peak)
+        metrics['start_s'] = round(start - run_wall, 3)
+        metrics['end_s'] = round(time.perf_counter() - run_wall, 3)
+        return result, metrics, count_rows(dict(zip(inputs, args)))
+
+    def finish(i, result, metrics, rows_in):
+        # Publica las salidas de la etapa i, libera las entradas que ya no
+        # necesita ninguna etapa pendiente y devuelve las etapas que quedan listas
+        name, step, _, inputs, outputs = stages[i]
+        values.update(zip(outputs, result if len(outputs) > 1 else (result,)))
+        records[i] = dict({'stage': name, 'step': step}, **metrics, rows_in=rows_in,
+                          rows_out=count_rows({output: values[output] for output in outputs}))
+        for input_name in inputs:
+            pending_uses[input_name] -= 1
+            if pending_uses[input_name] == 0 and input_name not in targets:
+                values.pop(input_name, None)
+        for j in dependents[i]:
+            waiting[j] -= 1
+            if waiting[j] == 0:
+                heapq.heappush(ready, j)
+
+    # Etapas listas, por su posición en el pipeline: con un hilo se
+    # ejecutan exactamente en el orden de PIPELINE_STAGES
+    ready = [i for i, count in enumerate(waiting) if count == 0]
+    heapq.heapify(ready)
+    output = _StageOutput(sys.stdout) if stage_threads > 1 else None
+    try:
+        if output is None:
+            while ready:
+                i = heapq.heappop(ready)
+                announce(i)
+                finish(i, *execute(i, [values[name] for name in stages[i][3]]))
+        else:
+            if pool is not None:
+                # Con fork, los procesos del pool se crean antes de lanzar hilos
+                pool.submit(int).result()
+            print(f"Planificador de etapas: {stage_threads} hilos")
+            sys.stdout = output
+            with ThreadPoolExecutor(max_workers=stage_threads) as stage_pool:
+                running = {}
+                try:
+                    while ready or running:
+                        while ready and len(running) < stage_threads:
+                            i = heapq.heappop(ready)
+                            args = [values[name] for name in stages[i][3]]
+                            running[stage_pool.submit(output.capture, execute, i, args)] = i
+                            del args
+                        done, _ = wait(running, return_when=FIRST_COMPLETED)
+                        for future in sorted(done, key=running.get):
+                            i = running.pop(future)
+                            (result, metrics, rows_in), text = future.result()
+                            announce(i)
+                            output.stream.write(text)
+                            finish(i, result, metrics, rows_in)
+                            del result
+                finally:
+                    stage_pool.shutdown(cancel_futures=True)
+    finally:
+        if output is not None:
+            sys.stdout = output.stream
+        if pool is not None:
+            pool.shutdown()
+        if export_pool is not None:
+            export_pool.shutdown()
+        if started_tracing:
+            tracemalloc.stop()
+
+    total_s = round(time.perf_counter() - run_wall, 3)
+    path, path_s = critical_path(stages, records)
+    print_stage_timings(records)
+    print_critical_path(records, path, path_s, total_s)
+    if report_path is not None:
+        write_run_report(report_path, {
+            'started': started.isoformat(timespec='seconds'),
+            'targets': targets,
+            'options': {'backend': backend, 'main_file': main_file, 'element_codes': element_codes,
+                        'incremental': incremental, 'workers': workers, 'export_formats': export_formats,
+                        'trend_windows': trend_windows, 'rolling_windows': rolling_windows,
+                        'exclude_anomalies': exclude_anomalies, 'stage_threads': stage_threads, 'trace_memory': trace_memory,
+                        'stage_peak': stage_peak, 'profile_stage': profile_stage},
+            'environment': {'python': platform.python_version(), 'pandas': pd.__version__,
+                            'numpy': np.__version__, 'platform': platform.platform(),
+                            'duckdb': None if duckdb is None else duckdb.__version__},
+            'total': {'wall_s': total_s,
+                      'cpu_s': round(time.process_time() - run_cpu, 3),
+                      'peak_rss_mb': None if peak_rss_mb() is None else round(peak_rss_mb(), 1)},
+            'critical_path': {'stages': [records[i]['stage'] for i in path], 'wall_s': path_s},
+            'stages': records,
+        })
+        print(f"Informe de ejecución: {report_path}")
+
+    return {target: values[target] for target in targets}
+
+
+ARTIFACT_DESCRIPTIONS = {
+    LONG_ARTIFACT: """   - Dataset principal en formato tidy
+   - Columnas: Area, Item, Element, Year, Price, Region, Product_Category, YoY_Change
+   - Uso: Base para todas las visualizaciones""",
+    '02_Country_Metrics': """   - Métricas agregadas por país
+   - Columnas: Area, Region, Avg_Price, Median_Price (y P10-P90), Volatility, Trend_2010_2023, etc.
+   - Uso: Mapa coroplético, ranking de países""",
+    '03_Product_Metrics': """   - Métricas agregadas por producto
+   - Columnas: Item, Product_Category, Avg_Price, Median_Price (y P10-P90), Volatility, Trend_2010_2023, etc.
+   - Uso: Scatter plot volatilidad vs tendencia""",
+    '04_Regional_Aggregates': """   - Promedios y percentiles (P10, P25, mediana, P75, P90) por región, año y categoría de producto
+   - Uso: Area charts, comparaciones regionales""",
+    '05_Country_Category_Metrics': """   - Métricas detalladas por país y categoría de producto
+   - Uso: Análisis granular, drill-down""",
+    TENSOR_ARTIFACT: """   - Precios en un array float32 Área × Producto × Año (memory-mapped, NaN = sin dato)
+   - Archivos: prices.npy, areas.csv, items.csv, meta.json
+   - Uso: analizar.load_price_tensor() + slice_price_tensor() / price_series()""",
+    CUBE_ARTIFACT: """   - Conteo, suma, suma de cuadrados, mínimo y máximo por región, categoría, país y año
+   - Uso: analizar.query_rollup_cube() para cualquier agrupación (drill-down, totales)""",
+    DASHBOARD_ARTIFACT: """   - Datos de 'visualizacion final.html' (PPI): index.js + countries/chunk_NNN.js (+ .gz)
+   - Uso: la página carga el índice y solo los bloques de los países que muestra""",
+    TRENDS_ARTIFACT: """   - Tendencia de todos los pares de años (float32 grupos × años × años) y ventanas móviles
+   - Archivos: country_/product_ groups.csv, trends.npy, rolling.csv y meta.json
+   - Uso: analizar.load_trend_windows() + trend_between() (selector de rango de años)""",
+    ANOMALIES_ARTIFACT: """   - Precios anómalos por serie (z robusta con mediana y MAD móviles) y su flag Y####F
+   - Columnas: Area, Item, Element, Year, Price, Rolling_Median, Rolling_MAD, Z_Score, Flag, Region, Product_Category
+   - Uso: revisión de posibles errores de datos; --exclude-anomalies los quita de 02-05""",
+}
+
+
+def print_summary(artifacts, element_codes=DEFAULT_ELEMENT_CODES, export_formats=None):
+    print("\n" + "=" * 60)
+    print("PROCESO COMPLETADO")
+    print("=" * 60)
+    print(f"\nArchivos generados en '{OUTPUT_FOLDER}/':\n")
+    if normalize_element_codes(element_codes) != DEFAULT_ELEMENT_CODES:
+        print(f"(elemento {ELEMENT_CODE_PPI}; el resto de elementos, en '{OUTPUT_FOLDER}/element_<código>/')\n")
+    export_formats = normalize_export_formats(export_formats)
+    for name in artifacts:
+        position = OUTPUT_ARTIFACTS.index(name) + 1
+        if name in FOLDER_ARTIFACTS:
+            print(f"{position}. {name}/")
+        else:
+            print(f"{position}. {', '.join(f'{name}.{fmt}' for fmt in export_formats.get(name, ['csv']))}")
+        print(ARTIFACT_DESCRIPTIONS[name])
+        print()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='FAOSTAT Food Prices - preparación de datos')
+    parser.add_argument('--only', action='append', choices=OUTPUT_ARTIFACTS, metavar='ARTEFACTO',
+                        help='generar solo este artefacto y las etapas de las que depende '
+                             '(se puede repetir): ' + ', '.join(OUTPUT_ARTIFACTS))
+    parser.add_argument('--elements', nargs='+', default=[str(code) for code in DEFAULT_ELEMENT_CODES],
+                        metavar='CÓDIGO',
+                        help=f"códigos de elemento a procesar en una sola ejecución, o '{ALL_ELEMENTS}' "
+                             f"(por defecto {ELEMENT_CODE_PPI})")
+    parser.add_argument('--backend', choices=BACKENDS, default='pandas',
+                        help='motor de ejecución: pandas (en memoria) o duckdb (fuera de memoria, '
+                             'requiere pip install duckdb)')
+    parser.add_argument('--format', action='append', dest='formats', metavar='[ARTEFACTO=]FORMATO[,FORMATO]',
+                        help='formatos de exportación de los artefactos 01-05 (se puede repetir; sin '
+                             f"ARTEFACTO=, para todos): {', '.join(EXPORT_FORMATS)} (por defecto csv)")
+    parser.add_argument('--trend', action='append', dest='trends', metavar='INICIO-FIN',
+                        help='ventana de tendencia adicional, columna Trend_INICIO_FIN de 02, 03 y 05 '
+                             '(se puede repetir; siempre se calcula ' +
+                             ', '.join(f'{start}-{end}' for start, end in TREND_WINDOWS) + ')')
+    parser.add_argument('--rolling', action='append', type=int, metavar='AÑOS',
+                        help='años de las ventanas móviles de tendencia y volatilidad de '
+                             f"{TRENDS_ARTIFACT}/ (se puede repetir; por defecto "
+                             f"{', '.join(map(str, ROLLING_WINDOWS))})")
+    parser.add_argument('--exclude-anomalies', action='store_true',
+                        help=f'no usar en las métricas 02-05 los precios marcados en {ANOMALIES_ARTIFACT}')
+    parser.add_argument('--incremental', action='store_true',
+                        help='recalcular solo las series que cambiaron desde la última ejecución')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='procesos para el cálculo de métricas del PASO 6 (por defecto 1)')
+    parser.add_argument('--stage-threads', type=int, default=STAGE_THREADS, metavar='N',
+                        help='ejecutar a la vez, en N hilos, las etapas independientes (solo backend pandas; '
+                             f'por defecto {STAGE_THREADS}: una tras otra)')
+    parser.add_argument('--report', default=RUN_REPORT_FILE, metavar='RUTA',
+                        help=f'informe JSON de tiempos y memoria por etapa (por defecto {RUN_REPORT_FILE})')
+    parser.add_argument('--trace-memory', action='store_true',
+                        help='medir con tracemalloc el pico de memoria asignada por etapa (más lento)')
+    parser.add_argument('--stage-peak', action='store_true',
+                        help='medir el pico de RSS de cada etapa (Linux; reinicia el pico del proceso, '
+                             'que ya no verán /usr/bin/time ni el proceso padre)')
+    stage_names = [stage[0] for stages in PIPELINE_BACKENDS.values() for stage in stages]
+    stage_names += [stage[0] for stage in ANOMALY_SCREEN_STAGES.values()]
+    parser.add_argument('--profile', choices=list(dict.fromkeys(stage_names)), metavar='ETAPA',
+                        help=f'guardar un volcado de cProfile de esa etapa en {REPORT_FOLDER}/')
+    args = parser.parse_args(argv)
+    if args.incremental and args.only:
+        parser.error('--incremental parchea los cinco artefactos y no se combina con --only')
+    if args.elements == [ALL_ELEMENTS]:
+        element_codes = ALL_ELEMENTS
+    elif all(code.isdigit() for code in args.elements):
+        element_codes = normalize_element_codes(args.elements)
+    else:
+        parser.error(f"--elements admite códigos numéricos o '{ALL_ELEMENTS}'")
+    if args.incremental and element_codes != DEFAULT_ELEMENT_CODES:
+        parser.error('--incremental solo admite los elementos por defecto')
+    if args.backend == 'duckdb' and duckdb is None:
+        parser.error('--backend duckdb necesita el paquete duckdb (pip install duckdb)')
+    if args.backend == 'duckdb' and args.incremental:
+        parser.error('--incremental solo está disponible en el backend pandas')
+    if args.stage_threads < 1:
+        parser.error('--stage-threads debe ser al menos 1')
+    if args.stage_threads > 1 and args.backend == 'duckdb':
+        parser.error('--stage-threads solo está disponible en el backend pandas')
+    if args.stage_threads > 1 and args.trace_memory:
+        parser.error('--trace-memory mide picos de todo el proceso y no se combina con --stage-threads')
+    if args.stage_threads > 1 and args.stage_peak:
+        parser.error('--stage-peak reinicia el pico de todo el proceso y no se combina con --stage-threads')
+    export_formats = {}
+    for spec in args.formats or []:
+        name, _, chosen = spec.rpartition('=')
+        for target in ([name] if name else ARTIFACT_TABLES):
+            export_formats[target] = chosen.split(',')
+    try:
+        export_formats = normalize_export_formats(export_formats)
+    except ValueError as error:
+        parser.error(str(error))
+    if args.incremental and export_formats != normalize_export_formats():
+        parser.error('--incremental solo parchea archivos csv y no se combina con --format')
+    trend_windows = []
+    for spec in args.trends or []:
+        start, _, end = spec.partition('-')
+        if not (start.isdigit() and end.isdigit()):
+            parser.error(f"--trend espera INICIO-FIN (por ejemplo 2000-2020): {spec}")
+        trend_windows.append((int(start), int(end)))
+    try:
+        normalize_trend_windows(trend_windows)
+        rolling_windows = normalize_rolling_windows(args.rolling)
+    except ValueError as error:
+        parser.error(str(error))
 
-4. 04_Regional_Aggregates.csv
-   - Promedios por región, año y categoría de producto
-   - Uso: Area charts, comparaciones regionales
+    targets = list(dict.fromkeys(args.only)) if args.only else None
+    run_pipeline(targets, element_codes=element_codes, incremental=args.incremental, workers=args.workers,
+                 report_path=args.report, trace_memory=args.trace_memory, profile_stage=args.profile,
+                 backend=args.backend, export_formats=export_formats, trend_windows=trend_windows,
+                 rolling_windows=rolling_windows, stage_threads=args.stage_threads,
+                 exclude_anomalies=args.exclude_anomalies, stage_peak=args.stage_peak)
+    print_summary(targets or OUTPUT_ARTIFACTS, element_codes, export_formats)
 
-5. 05_Country_Category_Metrics.csv
-   - Métricas detalladas por país y categoría de producto
-   - Uso: Análisis granular, drill-down
 
-""")
\ No newline at end of file
+if __name__ == '__main__':
+    main()
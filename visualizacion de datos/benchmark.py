@@ -0,0 +1,408 @@
+
+"""
+FAOSTAT Food Prices - Benchmark del pipeline con datos sintéticos
+Autor: Abdallah Tegguer
+
+Genera archivos con el mismo formato wide que Prices_E_All_Data.csv a 1x,
+10x y 100x el tamaño real, ejecuta analizar.py sobre cada uno y compara los
+tiempos y la memoria de cada etapa (del informe JSON de la ejecución) con
+una línea base guardada:
+
+    python benchmark.py generate --scales 1 10
+    python benchmark.py run --scales 1 10 --save-baseline
+    python benchmark.py run --scales 1 10
+"""
+
+import pandas as pd
+import numpy as np
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+from datetime import datetime
+
+# =============================================================================
+# CONFIGURACIÓN
+# =============================================================================
+
+SCRIPT_FOLDER = os.path.dirname(os.path.abspath(__file__))
+ANALIZAR_SCRIPT = os.path.join(SCRIPT_FOLDER, 'analizar.py')
+
+BENCHMARK_FOLDER = os.path.join(SCRIPT_FOLDER, 'benchmarks')
+DATA_FOLDER = os.path.join(BENCHMARK_FOLDER, 'data')
+RESULTS_FOLDER = os.path.join(BENCHMARK_FOLDER, 'results')
+BASELINE_FILE = os.path.join(BENCHMARK_FOLDER, 'baseline.json')
+
+AUX_FILES = ['Prices_E_AreaCodes.csv', 'Prices_E_ItemCodes.csv',
+             'Prices_E_Elements.csv', 'Prices_E_Flags.csv']
+
+# Filas del Prices_E_All_Data.csv real (escala 1x)
+REAL_ROWS = 1_600_000
+DEFAULT_SCALES = [1, 10, 100]
+
+# Filas generadas por bloque (el archivo se escribe por partes)
+GENERATION_CHUNK = 100_000
+
+YEARS = list(range(1991, 2025))
+
+# Elementos de precio: valor anual y mensual; el índice (PPI) solo es anual
+ELEMENT_CODE_PPI = 5539
+ELEMENT_UNITS = {5530: 'LCU', 5531: 'SLC', 5532: 'USD', 5539: ''}
+ANNUAL_MONTHS = (7021, 'Annual value')
+MONTHS = [(7001 + i, name) for i, name in enumerate([
+    'January', 'February', 'March', 'April', 'May', 'June', 'July',
+    'August', 'September', 'October', 'November', 'December'])]
+
+# Densidad de datos: cada serie empieza en un año aleatorio (las mensuales
+# desde 2010), termina en 2023 o 2024 y tiene huecos sueltos
+FIRST_MONTHLY_YEAR = 2010
+LAST_YEAR_2024_SHARE = 0.4
+GAP_SHARE = 0.04
+
+# Proporción de cada flag entre los valores observados (en el orden de
+# Prices_E_Flags.csv: A, F, I, X); los valores nulos no llevan flag
+FLAG_WEIGHTS = [0.78, 0.02, 0.12, 0.08]
+
+# Umbrales para marcar una etapa como regresión/mejora frente a la línea base
+TOLERANCE = 0.20
+MIN_SECONDS = 0.05
+MIN_MEMORY_MB = 50
+
+# Memoria atribuible a cada etapa, por preferencia: pico de tracemalloc sobre
+# lo asignado al empezarla (--trace-memory), pico de RSS de la etapa sobre el
+# RSS con que empieza (--stage-peak de analizar.py: Linux, sin
+# --stage-threads) o, si no hay ninguno, crecimiento del pico de RSS del
+# proceso durante la etapa. El peak_rss_mb del informe es el máximo del
+# proceso hasta esa etapa (incluye las anteriores) y no sirve para compararlas
+STAGE_MEMORY_METRICS = {'traced_peak_mb': 'tracemalloc', 'stage_rss_peak_mb': 'RSS etapa',
+                        'peak_rss_growth_mb': 'Δ RSS'}
+
+# =============================================================================
+# GENERADOR DE DATOS SINTÉTICOS
+# =============================================================================
+
+def read_aux(filename):
+    # Los auxiliares están en UTF-8; se leen así para copiar los nombres tal cual
+    df = pd.read_csv(os.path.join(SCRIPT_FOLDER, filename), encoding='utf-8', dtype=str)
+    df.columns = df.columns.str.strip()
+    return df
+
+
+def build_catalog():
+    """
+    Todas las combinaciones posibles de filas del archivo real: países (sin
+    los agregados regionales de FAO, códigos >= 5000) x productos x
+    (elemento, mes), en el orden del archivo original.
+    """
+    areas = read_aux('Prices_E_AreaCodes.csv')
+    areas = areas[areas['Area Code'].astype(int) < 5000].reset_index(drop=True)
+    items = read_aux('Prices_E_ItemCodes.csv')
+    elements = read_aux('Prices_E_Elements.csv')
+
+    element_months = []
+    for code, name in zip(elements['Element Code'].astype(int), elements['Element']):
+        months = [ANNUAL_MONTHS] if code == ELEMENT_CODE_PPI else [ANNUAL_MONTHS] + MONTHS
+        element_months += [(code, name, month_code, month) for month_code, month in months]
+    element_months = pd.DataFrame(element_months, columns=['Element Code', 'Element', 'Months Code', 'Months'])
+
+    area_idx, item_idx, em_idx = np.meshgrid(
+        np.arange(len(areas)), np.arange(len(items)), np.arange(len(element_months)), indexing='ij')
+    return {
+        'areas': areas,
+        'items': items,
+        'element_months': element_months,
+        'area_idx': area_idx.ravel(),
+        'item_idx': item_idx.ravel(),
+        'em_idx': em_idx.ravel(),
+    }
+
+
+def generate_values(rng, is_ppi, is_monthly, flags):
+    """
+    Matriz (filas x años) de precios con huecos: paseo aleatorio en
+    logaritmos sobre un nivel base por serie; el PPI se normaliza a ~100 en
+    2014-2016. Devuelve (valores, flags).
+    """
+    n, n_years = len(is_ppi), len(YEARS)
+    level = np.exp(np.cumsum(rng.normal(0.03, 0.12, (n, n_years)), axis=1))
+    base_years = [YEARS.index(year) for year in (2014, 2015, 2016)]
+    level_ppi = 100 * level / level[:, base_years].mean(axis=1, keepdims=True)
+    values = np.where(is_ppi[:, None], level_ppi, rng.lognormal(6, 1.5, n)[:, None] * level)
+    values = np.round(values, 2)
+
+    first = np.where(is_monthly,
+                     rng.integers(YEARS.index(FIRST_MONTHLY_YEAR), YEARS.index(2020), n),
+                     rng.integers(0, YEARS.index(2015), n))
+    last = np.where(rng.random(n) < LAST_YEAR_2024_SHARE, n_years - 1, n_years - 2)
+    columns = np.arange(n_years)
+    observed = ((columns >= first[:, None]) & (columns <= last[:, None])
+                & (rng.random((n, n_years)) >= GAP_SHARE))
+    values[~observed] = np.nan
+
+    weights = FLAG_WEIGHTS if len(FLAG_WEIGHTS) == len(flags) else None
+    flag_values = rng.choice(flags, size=(n, n_years), p=weights).astype(object)
+    flag_values[~observed] = ''
+    return values, flag_values
+
+
+def generate_dataset(path, n_rows, seed=0, chunk_size=GENERATION_CHUNK):
+    """
+    Escribe un Prices_E_All_Data.csv sintético de n_rows filas. Hasta el
+    tamaño del catálogo cada fila es una combinación distinta; por encima,
+    las combinaciones se repiten (el catálogo de códigos es finito).
+    """
+    rng = np.random.default_rng(seed)
+    catalog = build_catalog()
+    n_catalog = len(catalog['area_idx'])
+    rows = np.sort(rng.choice(n_catalog, size=n_rows, replace=n_rows > n_catalog))
+
+    areas, items, em = catalog['areas'], catalog['items'], catalog['element_months']
+    flags = read_aux('Prices_E_Flags.csv')['Flag'].to_numpy()
+    with open(path, 'w', encoding='utf-8', newline='') as f:
+        for start in range(0, n_rows, chunk_size):
+            chunk = rows[start:start + chunk_size]
+            a = areas.iloc[catalog['area_idx'][chunk]].reset_index(drop=True)
+            i = items.iloc[catalog['item_idx'][chunk]].reset_index(drop=True)
+            e = em.iloc[catalog['em_idx'][chunk]].reset_index(drop=True)
+
+            data = {
+                'Area Code': a['Area Code'],
+                'Area Code (M49)': a['M49 Code'],
+                'Area': a['Area'],
+                'Item Code': i['Item Code'],
+                'Item Code (CPC)': i['CPC Code'],
+                'Item': i['Item'],
+                'Element Code': e['Element Code'],
+                'Element': e['Element'],
+                'Months Code': e['Months Code'],
+                'Months': e['Months'],
+                'Unit': e['Element Code'].map(ELEMENT_UNITS),
+            }
+            is_ppi = (e['Element Code'] == ELEMENT_CODE_PPI).to_numpy()
+            is_monthly = (e['Months Code'] != ANNUAL_MONTHS[0]).to_numpy()
+            values, flag_values = generate_values(rng, is_ppi, is_monthly, flags)
+            for j, year in enumerate(YEARS):
+                data[f'Y{year}'] = values[:, j]
+                data[f'Y{year}F'] = flag_values[:, j]
+
+            pd.DataFrame(data).to_csv(f, index=False, header=(start == 0))
+
+
+def scale_folder(scale):
+    return os.path.join(DATA_FOLDER, f'{scale}x')
+
+
+def ensure_dataset(scale, base_rows, seed=0, force=False):
+    """
+    Carpeta con el dataset sintético de la escala y copias de los auxiliares
+    (analizar.py lee todo del directorio de trabajo). Se regenera solo si
+    cambian los parámetros o con force.
+    """
+    folder = scale_folder(scale)
+    info_path = os.path.join(folder, 'generation.json')
+    info = {'scale': scale, 'base_rows': base_rows, 'rows': base_rows * scale, 'seed': seed}
+    if not force and os.path.exists(info_path):
+        with open(info_path, encoding='utf-8') as f:
+            if json.load(f) == info:
+                return folder, info
+
+    os.makedirs(folder, exist_ok=True)
+    print(f"Generando escala {scale}x: {info['rows']:,} filas en {folder}")
+    for filename in AUX_FILES:
+        shutil.copy(os.path.join(SCRIPT_FOLDER, filename), folder)
+    generate_dataset(os.path.join(folder, 'Prices_E_All_Data.csv'), info['rows'], seed)
+    size_mb = os.path.getsize(os.path.join(folder, 'Prices_E_All_Data.csv')) / 1024**2
+    print(f"  - {size_mb:,.0f} MB")
+    with open(info_path, 'w', encoding='utf-8') as f:
+        json.dump(info, f)
+    return folder, info
+
+# =============================================================================
+# EJECUCIÓN Y COMPARACIÓN
+# =============================================================================
+
+def run_scale(folder, workers=1, trace_memory=False, warm=False, stage_threads=1):
+    """
+    Ejecuta analizar.py en un proceso aparte (el pico de RSS es por proceso)
+    sobre la carpeta de la escala y devuelve su informe de ejecución. Sin
+    warm se borra antes la caché para medir también el parseo del CSV.
+    """
+    if not warm:
+        shutil.rmtree(os.path.join(folder, 'cache'), ignore_errors=True)
+    report_path = os.path.join(folder, 'reports', 'run_report.json')
+    command = [sys.executable, ANALIZAR_SCRIPT, '--workers', str(workers), '--stage-threads', str(stage_threads),
+               '--report', report_path]
+    if trace_memory:
+        command.append('--trace-memory')
+    if stage_threads == 1:
+        command.append('--stage-peak')
+
+    with open(os.path.join(folder, 'analizar.log'), 'w', encoding='utf-8') as log:
+        completed = subprocess.run(command, cwd=folder, stdout=log, stderr=subprocess.STDOUT)
+    if completed.returncode != 0:
+        raise RuntimeError(f"analizar.py terminó con código {completed.returncode} (ver {folder}/analizar.log)")
+    with open(report_path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def best_of(reports):
+    """
+    Combina varias ejecuciones de la misma escala: por etapa se queda con el
+    menor tiempo (el menos afectado por ruido) y la mayor memoria.
+    """
+    best = json.loads(json.dumps(reports[0]))
+    for report in reports[1:]:
+        best['total']['wall_s'] = min(best['total']['wall_s'], report['total']['wall_s'])
+        for stage, other in zip(best['stages'], report['stages']):
+            stage['wall_s'] = min(stage['wall_s'], other['wall_s'])
+            stage['cpu_s'] = min(stage['cpu_s'], other['cpu_s'])
+            for key in ['peak_rss_mb'] + list(STAGE_MEMORY_METRICS):
+                if key in stage:
+                    stage[key] = max(stage[key], other[key])
+    best['repeats'] = len(reports)
+    return best
+
+
+def stage_memory(stage):
+    # (métrica, MB) de la memoria atribuible a la etapa (ver
+    # STAGE_MEMORY_METRICS); (None, None) si el informe no la tiene
+    for key in STAGE_MEMORY_METRICS:
+        if stage.get(key) is not None:
+            return key, stage[key]
+    return None, None
+
+
+def compare_stage(current, baseline):
+    # Estado de una etapa frente a la línea base: 'regresión', 'mejora' o ''.
+    # La memoria solo se compara si las dos se midieron igual
+    wall, base_wall = current['wall_s'], baseline['wall_s']
+    (metric, memory), (base_metric, base_memory) = stage_memory(current), stage_memory(baseline)
+    slower = wall > base_wall * (1 + TOLERANCE) and wall - base_wall > MIN_SECONDS
+    bigger = (metric is not None and metric == base_metric
+              and memory > base_memory * (1 + TOLERANCE) and memory - base_memory > MIN_MEMORY_MB)
+    if slower or bigger:
+        return 'regresión'
+    if wall < base_wall * (1 - TOLERANCE) and base_wall - wall > MIN_SECONDS:
+        return 'mejora'
+    return ''
+
+
+def print_comparison(scale, result, baseline):
+    """
+    Tabla por etapa de la escala (tiempo, memoria de la etapa y, si hay
+    línea base comparable, su tiempo y el ratio). Devuelve el número de
+    regresiones.
+    """
+    total = result['report']['total']
+    peak = f", pico de RSS {total['peak_rss_mb']:,.0f} MB" if total.get('peak_rss_mb') is not None else ''
+    print(f"\nEscala {scale}x ({result['rows']:,} filas, total {total['wall_s']:.2f} s{peak})")
+    comparable = baseline is not None and baseline['base_rows'] == result['base_rows']
+    if baseline is not None and not comparable:
+        print("  (la línea base se generó con otro --base-rows: no se compara)")
+    base_stages = {stage['stage']: stage for stage in baseline['report']['stages']} if comparable else {}
+
+    regressions = 0
+    metrics = {stage_memory(stage)[0] for stage in result['report']['stages']} - {None}
+    label = STAGE_MEMORY_METRICS[metrics.pop()] if len(metrics) == 1 else 'memoria'
+    print(f"  {'etapa':<36} {'tiempo':>9} {label:>11} {'base':>9} {'ratio':>6}")
+    for stage in result['report']['stages']:
+        memory = stage_memory(stage)[1]
+        memory = f"{memory:,.0f} MB" if memory is not None else '-'
+        line = f"  {stage['stage']:<36} {stage['wall_s']:>7.2f} s {memory:>11}"
+        base = base_stages.get(stage['stage'])
+        if base is not None:
+            ratio = f"{stage['wall_s'] / base['wall_s']:.2f}" if base['wall_s'] > 0 else '-'
+            status = compare_stage(stage, base)
+            regressions += status == 'regresión'
+            line += f" {base['wall_s']:>7.2f} s {ratio:>6}  {status}"
+        print(line)
+    return regressions
+
+
+def run_benchmark(scales, base_rows, seed=0, workers=1, trace_memory=False, warm=False,
+                  repeat=1, baseline_path=BASELINE_FILE, save_baseline=False, stage_threads=1):
+    baseline = None
+    if os.path.exists(baseline_path) and not save_baseline:
+        with open(baseline_path, encoding='utf-8') as f:
+            baseline = json.load(f)
+
+    results = {}
+    for scale in scales:
+        folder, info = ensure_dataset(scale, base_rows, seed)
+        print(f"Ejecutando analizar.py sobre la escala {scale}x...")
+        reports = [run_scale(folder, workers, trace_memory, warm, stage_threads) for _ in range(max(1, repeat))]
+        results[str(scale)] = dict(info, report=best_of(reports))
+
+    run = {
+        'created': datetime.now().isoformat(timespec='seconds'),
+        'options': {'workers': workers, 'stage_threads': stage_threads, 'trace_memory': trace_memory,
+                    'warm': warm, 'repeat': repeat},
+        'scales': results,
+    }
+    os.makedirs(RESULTS_FOLDER, exist_ok=True)
+    stamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+    for filename in (f'benchmark_{stamp}.json', 'latest.json'):
+        with open(os.path.join(RESULTS_FOLDER, filename), 'w', encoding='utf-8') as f:
+            json.dump(run, f, indent=2, ensure_ascii=False)
+
+    regressions = 0
+    for scale, result in results.items():
+        base = (baseline or {}).get('scales', {}).get(scale)
+        regressions += print_comparison(scale, result, base)
+
+    if save_baseline:
+        os.makedirs(os.path.dirname(baseline_path) or '.', exist_ok=True)
+        with open(baseline_path, 'w', encoding='utf-8') as f:
+            json.dump(run, f, indent=2, ensure_ascii=False)
+        print(f"\nLínea base guardada en {baseline_path}")
+    elif baseline is None:
+        print(f"\nSin línea base ({baseline_path}): usa --save-baseline para crearla")
+    elif regressions:
+        print(f"\n{regressions} etapas más lentas o con más memoria que la línea base")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark de analizar.py con datos FAOSTAT sintéticos')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('--scales', type=int, nargs='+', default=DEFAULT_SCALES,
+                        help='múltiplos del tamaño real a usar (por defecto 1 10 100)')
+    common.add_argument('--base-rows', type=int, default=REAL_ROWS,
+                        help=f'filas de la escala 1x (por defecto {REAL_ROWS:,}, el tamaño real)')
+    common.add_argument('--seed', type=int, default=0)
+
+    generate = subparsers.add_parser('generate', parents=[common], help='generar los datasets sintéticos')
+    generate.add_argument('--force', action='store_true', help='regenerar aunque ya existan')
+
+    run = subparsers.add_parser('run', parents=[common], help='medir el pipeline en cada escala')
+    run.add_argument('--workers', type=int, default=1)
+    run.add_argument('--stage-threads', type=int, default=1,
+                     help='hilos del planificador de etapas de analizar.py')
+    run.add_argument('--trace-memory', action='store_true',
+                     help='medir también con tracemalloc (más lento)')
+    run.add_argument('--warm', action='store_true',
+                     help='reutilizar la caché del dataset (no mide el parseo del CSV)')
+    run.add_argument('--repeat', type=int, default=1,
+                     help='ejecuciones por escala; se toma el mejor tiempo de cada etapa')
+    run.add_argument('--baseline', default=BASELINE_FILE, metavar='RUTA')
+    run.add_argument('--save-baseline', action='store_true',
+                     help='guardar esta ejecución como línea base')
+
+    args = parser.parse_args(argv)
+    if args.command == 'generate':
+        for scale in args.scales:
+            ensure_dataset(scale, args.base_rows, args.seed, force=args.force)
+        return 0
+
+    regressions = run_benchmark(args.scales, args.base_rows, args.seed, args.workers,
+                                args.trace_memory, args.warm, args.repeat, args.baseline, args.save_baseline,
+                                args.stage_threads)
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,421 @@
+"""
+FAOSTAT Food Prices - Servicio local de consultas sobre las salidas
+Autor: Abdallah Tegguer
+
+Carga una sola vez en memoria los artefactos 01-05 que genera analizar.py
+(en cualquiera de sus formatos de exportación), construye índices por Area,
+Item, Region, Product_Category y Year y responde consultas JSON por HTTP en
+localhost, con una caché LRU de las respuestas recientes:
+
+    python consultas.py                                  (http://127.0.0.1:8765)
+    curl 'http://127.0.0.1:8765/series?area=Spain&item=Wheat'
+    curl 'http://127.0.0.1:8765/top/country?by=Trend_2010_2023&n=15&not_region=Other'
+
+Consultas (GET; los filtros area, item, region, category y year se pueden
+repetir para pedir varios valores, not_<filtro> excluye valores y
+year_from/year_to acotan los años):
+    /health                estado, tablas cargadas y aciertos de la caché
+    /rows                  filas del 01 (limit, por defecto MAX_ROWS)
+    /series                serie anual del 01: Count, Avg, Median, Min, Max
+    /metrics/<tabla>       filas de country (02), product (03), regional (04)
+                           o country_category (05)
+    /top/<tabla>           ranking por una columna: by, n, order=desc|asc
+"""
+
+import pandas as pd
+import numpy as np
+import argparse
+import functools
+import json
+import os
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+
+import analizar
+
+# =============================================================================
+# CONFIGURACIÓN
+# =============================================================================
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8765
+
+# Respuestas recientes que se guardan ya serializadas (consulta -> JSON)
+QUERY_CACHE_SIZE = 1024
+
+# Filas máximas de /rows y por defecto de /top
+MAX_ROWS = 10_000
+DEFAULT_TOP = 15
+
+# Formatos en que se busca cada artefacto, del más rápido de cargar al más
+# lento. Se sirve el más reciente (el de otro --format anterior puede estar
+# desactualizado); con la misma fecha, el primero de esta lista
+LOAD_FORMATS = ('feather', 'parquet', 'csv', 'csv.gz', 'csv.zst')
+
+# Tablas del servicio: nombre en la URL -> artefacto
+TABLES = {
+    'long': analizar.LONG_ARTIFACT,
+    'country': '02_Country_Metrics',
+    'product': '03_Product_Metrics',
+    'regional': '04_Regional_Aggregates',
+    'country_category': '05_Country_Category_Metrics',
+}
+
+# Filtros de la URL -> columna indexada (en las tablas que la tienen)
+FILTER_PARAMS = {
+    'area': 'Area',
+    'item': 'Item',
+    'region': 'Region',
+    'category': 'Product_Category',
+    'year': 'Year',
+}
+RANGE_PARAMS = ('year_from', 'year_to')
+
+
+class QueryError(Exception):
+    # Consulta no válida: se responde con status y {"error": mensaje}
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+# =============================================================================
+# CARGA E ÍNDICES
+# =============================================================================
+
+def artifact_mtime(path):
+    # Última escritura de un artefacto (en la carpeta particionada del 01,
+    # la de su archivo más reciente)
+    if not os.path.isdir(path):
+        return os.stat(path).st_mtime_ns
+    return max((os.stat(os.path.join(root, f)).st_mtime_ns for root, _, files in os.walk(path) for f in files),
+               default=os.stat(path).st_mtime_ns)
+
+
+def find_artifact(folder, name):
+    # El formato escrito más recientemente (ver LOAD_FORMATS)
+    paths = [analizar.export_path(folder, name, fmt) for fmt in LOAD_FORMATS]
+    paths = [path for path in paths if os.path.exists(path)]
+    if not paths:
+        raise FileNotFoundError(f"No se encuentra {name} en '{folder}/' (ejecuta antes python analizar.py)")
+    return max(paths, key=artifact_mtime)
+
+
+def build_index(column):
+    """
+    {valor en minúsculas: posiciones ascendentes de sus filas} con un solo
+    factorize y un argsort estable (las posiciones de cada valor son un tramo
+    contiguo del orden, sin copiar la tabla).
+    """
+    codes, uniques = pd.factorize(column, sort=True)
+    order = np.argsort(codes, kind='stable')
+    bounds = np.r_[0, np.cumsum(np.bincount(codes[codes >= 0], minlength=len(uniques)))] + (codes < 0).sum()
+    return {str(value).casefold(): order[bounds[i]:bounds[i + 1]] for i, value in enumerate(uniques)}
+
+
+def build_rankings(df):
+    """
+    {(columna, descendente): posiciones de las filas ordenadas por esa
+    columna (sort estable, NaN fuera)} para cada columna numérica. Se
+    calculan al cargar: los hilos del servidor solo los leen.
+    """
+    rankings = {}
+    for col in df.columns:
+        if pd.api.types.is_numeric_dtype(df[col]):
+            values = df[col].dropna()
+            for descending in (True, False):
+                rankings[col, descending] = values.sort_values(ascending=not descending,
+                                                               kind='stable').index.to_numpy()
+    return rankings
+
+
+def load_table(folder, name, rankings=False):
+    # rankings: órdenes de /top (solo en las tablas de métricas)
+    path = find_artifact(folder, name)
+    df = analizar.read_artifact(path)
+    # Textos como categóricas: menos memoria y factorize por códigos
+    for col in df.columns:
+        if df[col].dtype == object or pd.api.types.is_string_dtype(df[col]):
+            df[col] = df[col].astype('category')
+    df = df.reset_index(drop=True)
+    return {
+        'name': name,
+        'path': path,
+        'df': df,
+        'indexes': {col: build_index(df[col]) for col in FILTER_PARAMS.values() if col in df.columns},
+        'sorted': build_rankings(df) if rankings else {},
+    }
+
+
+def load_query_data(folder=analizar.OUTPUT_FOLDER):
+    # Tablas del servicio con sus índices, cargadas una sola vez
+    tables = {}
+    for key, name in TABLES.items():
+        start = time.perf_counter()
+        tables[key] = load_table(folder, name, rankings=key != 'long')
+        print(f"✓ {tables[key]['path']}: {len(tables[key]['df']):,} filas, "
+              f"{len(tables[key]['indexes'])} índices ({time.perf_counter() - start:.2f} s)")
+    return {'folder': folder, 'tables': tables}
+
+
+# =============================================================================
+# CONSULTAS
+# =============================================================================
+
+def _single(params, name, default=None):
+    values = params.get(name)
+    if values is None:
+        return default
+    if len(values) != 1:
+        raise QueryError(400, f"'{name}' admite un solo valor")
+    return values[0]
+
+
+def _integer(params, name, default, minimum, maximum):
+    value = _single(params, name)
+    if value is None:
+        return default
+    try:
+        value = int(value)
+    except ValueError:
+        raise QueryError(400, f"'{name}' debe ser un entero: {value}") from None
+    if not minimum <= value <= maximum:
+        raise QueryError(400, f"'{name}' debe estar entre {minimum} y {maximum}")
+    return value
+
+
+def _lookup(index, values):
+    # Unión de las posiciones de varios valores
+    found = [index.get(value.casefold()) for value in values]
+    found = [rows for rows in found if rows is not None]
+    if not found:
+        return np.array([], dtype='int64')
+    return found[0] if len(found) == 1 else np.sort(np.concatenate(found))
+
+
+def select_rows(table, params):
+    """
+    Posiciones ascendentes de las filas de table que cumplen los filtros:
+    cada filtro de FILTER_PARAMS se resuelve con su índice y se intersecan
+    empezando por el más selectivo; not_<filtro> quita valores y
+    year_from/year_to acotan Year. Sin filtros, todas las filas.
+    """
+    include, exclude = [], []
+    for param, column in FILTER_PARAMS.items():
+        for name, target in ((param, include), ('not_' + param, exclude)):
+            if name not in params:
+                continue
+            if column not in table['indexes']:
+                raise QueryError(400, f"'{name}' no se aplica a {table['name']}")
+            target.append(_lookup(table['indexes'][column], params[name]))
+
+    if include:
+        include.sort(key=len)
+        rows = include[0]
+        for other in include[1:]:
+            rows = np.intersect1d(rows, other, assume_unique=True)
+    else:
+        rows = np.arange(len(table['df']))
+    for other in exclude:
+        rows = rows[~np.isin(rows, other, assume_unique=True)]
+
+    year_from = _integer(params, 'year_from', None, 0, 9999)
+    year_to = _integer(params, 'year_to', None, 0, 9999)
+    if year_from is not None or year_to is not None:
+        if 'Year' not in table['df'].columns:
+            raise QueryError(400, f"year_from/year_to no se aplican a {table['name']}")
+        years = table['df']['Year'].to_numpy()[rows]
+        rows = rows[(years >= (year_from or 0)) & (years <= (year_to or 9999))]
+    return rows
+
+
+def _check_params(params, allowed):
+    unknown = sorted(set(params) - set(allowed))
+    if unknown:
+        raise QueryError(400, f"Parámetros desconocidos: {', '.join(unknown)}")
+
+
+def _filter_names():
+    return list(FILTER_PARAMS) + ['not_' + param for param in FILTER_PARAMS] + list(RANGE_PARAMS)
+
+
+def _records(df):
+    # NaN -> null; textos sin escapar
+    return df.to_json(orient='records', force_ascii=False)
+
+
+def _metric_table(data, name):
+    if name not in TABLES or name == 'long':
+        raise QueryError(404, f"Tabla desconocida: {name} (disponibles: {', '.join(list(TABLES)[1:])})")
+    return data['tables'][name]
+
+
+def query_rows(data, params):
+    _check_params(params, _filter_names() + ['limit'])
+    table = data['tables']['long']
+    limit = _integer(params, 'limit', MAX_ROWS, 1, MAX_ROWS)
+    rows = select_rows(table, params)
+    return {'total': len(rows), 'rows': min(len(rows), limit)}, table['df'].iloc[rows[:limit]]
+
+
+def query_series(data, params):
+    # Agregado por año de las filas del 01 que cumplen los filtros (con un
+    # área y un producto es la serie de precios tal cual)
+    _check_params(params, _filter_names())
+    table = data['tables']['long']
+    rows = select_rows(table, params)
+    df = table['df']
+    prices = pd.Series(df['Price'].to_numpy()[rows])
+    stats = prices.groupby(df['Year'].to_numpy()[rows], sort=True).agg(['count', 'mean', 'median', 'min', 'max'])
+    series = pd.DataFrame({
+        'Year': stats.index.to_numpy(),
+        'Count': stats['count'].to_numpy(),
+        'Avg_Price': stats['mean'].round(2).to_numpy(),
+        'Median_Price': stats['median'].round(2).to_numpy(),
+        'Min_Price': stats['min'].to_numpy(),
+        'Max_Price': stats['max'].to_numpy(),
+    })
+    return {'total': len(rows), 'rows': len(series)}, series
+
+
+def query_metrics(data, name, params):
+    _check_params(params, _filter_names())
+    table = _metric_table(data, name)
+    rows = select_rows(table, params)
+    return {'table': table['name'], 'rows': len(rows)}, table['df'].iloc[rows]
+
+
+def query_top(data, name, params):
+    _check_params(params, _filter_names() + ['by', 'n', 'order'])
+    table = _metric_table(data, name)
+    df = table['df']
+    by = _single(params, 'by')
+    if by not in df.columns or not pd.api.types.is_numeric_dtype(df[by]):
+        numeric = [col for col in df.columns if pd.api.types.is_numeric_dtype(df[col])]
+        raise QueryError(400, f"'by' debe ser una columna numérica de {table['name']}: {', '.join(numeric)}")
+    order = _single(params, 'order', 'desc')
+    if order not in ('desc', 'asc'):
+        raise QueryError(400, "'order' admite desc o asc")
+    n = _integer(params, 'n', DEFAULT_TOP, 1, MAX_ROWS)
+
+    ranking = table['sorted'][by, order == 'desc']
+    if any(param in params for param in _filter_names()):
+        ranking = ranking[np.isin(ranking, select_rows(table, params))]
+    return {'table': table['name'], 'by': by, 'order': order, 'rows': min(n, len(ranking))}, df.iloc[ranking[:n]]
+
+
+def run_query(data, path, params):
+    """
+    Respuesta (status, cuerpo JSON en bytes) de una consulta: path de la URL
+    y params {parámetro: [valores]} como los devuelve parse_qs.
+    """
+    parts = [part for part in path.split('/') if part]
+    try:
+        if parts == ['health']:
+            _check_params(params, [])
+            return 200, json.dumps(health(data), ensure_ascii=False).encode('utf-8')
+        if parts == ['rows']:
+            meta, result = query_rows(data, params)
+        elif parts == ['series']:
+            meta, result = query_series(data, params)
+        elif len(parts) == 2 and parts[0] == 'metrics':
+            meta, result = query_metrics(data, parts[1], params)
+        elif len(parts) == 2 and parts[0] == 'top':
+            meta, result = query_top(data, parts[1], params)
+        else:
+            raise QueryError(404, f"Consulta desconocida: /{'/'.join(parts)} "
+                                  "(/health, /rows, /series, /metrics/<tabla>, /top/<tabla>)")
+    except QueryError as error:
+        return error.status, json.dumps({'error': str(error)}, ensure_ascii=False).encode('utf-8')
+    body = json.dumps(meta, ensure_ascii=False)[:-1] + ', "data": ' + _records(result) + '}'
+    return 200, body.encode('utf-8')
+
+
+def health(data):
+    info = data['cached_query'].cache_info() if 'cached_query' in data else None
+    return {
+        'folder': data['folder'],
+        'tables': {key: {'artifact': table['name'], 'path': table['path'], 'rows': len(table['df'])}
+                   for key, table in data['tables'].items()},
+        'cache': None if info is None else {'hits': info.hits, 'misses': info.misses,
+                                            'size': info.currsize, 'maxsize': info.maxsize},
+    }
+
+
+def cached_query(data, cache_size=QUERY_CACHE_SIZE):
+    """
+    run_query() con caché LRU de las respuestas (la clave es la consulta
+    normalizada: ruta y parámetros ordenados). /health no se guarda.
+    """
+    @functools.lru_cache(maxsize=cache_size)
+    def query(path, params):
+        return run_query(data, path, {name: list(values) for name, values in params})
+
+    def respond(path, params):
+        if path.strip('/') == 'health':
+            return run_query(data, path, params)
+        return query(path.rstrip('/') or '/', tuple(sorted((name, tuple(values)) for name, values in params.items())))
+
+    data['cached_query'] = query
+    return respond
+
+
+# =============================================================================
+# SERVIDOR HTTP
+# =============================================================================
+
+def create_server(data, host=DEFAULT_HOST, port=DEFAULT_PORT, cache_size=QUERY_CACHE_SIZE, quiet=False):
+    # ThreadingHTTPServer con las consultas de data (port=0: uno libre)
+    respond = cached_query(data, cache_size)
+
+    class QueryHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            url = urlsplit(self.path)
+            status, body = respond(url.path, parse_qs(url.query))
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            # Para consultarlo desde 'visualizacion final.html' u otra página local
+            self.send_header('Access-Control-Allow-Origin', '*')
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            if not quiet:
+                super().log_message(format, *args)
+
+    return ThreadingHTTPServer((host, port), QueryHandler)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Servicio local de consultas JSON sobre las salidas de analizar.py')
+    parser.add_argument('--folder', default=analizar.OUTPUT_FOLDER,
+                        help=f"carpeta con los artefactos 01-05 (por defecto '{analizar.OUTPUT_FOLDER}'; "
+                             f"la de otro elemento es '{analizar.OUTPUT_FOLDER}/element_<código>')")
+    parser.add_argument('--host', default=DEFAULT_HOST, help=f'interfaz de escucha (por defecto {DEFAULT_HOST})')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT,
+                        help=f'puerto (por defecto {DEFAULT_PORT}; 0 para uno libre)')
+    parser.add_argument('--cache-size', type=int, default=QUERY_CACHE_SIZE,
+                        help=f'respuestas en la caché LRU (por defecto {QUERY_CACHE_SIZE})')
+    parser.add_argument('--quiet', action='store_true', help='no imprimir una línea por consulta')
+    args = parser.parse_args(argv)
+
+    print(f"Cargando salidas de '{args.folder}/'...")
+    try:
+        data = load_query_data(args.folder)
+    except FileNotFoundError as error:
+        parser.error(str(error))
+    server = create_server(data, args.host, args.port, args.cache_size, args.quiet)
+    host, port = server.server_address[:2]
+    print(f"Sirviendo en http://{host}:{port}/ (Ctrl+C para terminar)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,5 @@
+# Los scripts (analizar.py, consultas.py) están en la carpeta padre
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,216 @@
+"""
+Pruebas de consultas.py: el servidor real (ThreadingHTTPServer en el puerto
+0 de localhost) sobre un output/ pequeño generado, comparando cada respuesta
+con el mismo filtro hecho con pandas sobre los CSV.
+"""
+
+import json
+import os
+import threading
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import analizar
+import consultas
+
+AREAS = {'Spain': 'Europe', 'France': 'Europe', 'Türkiye': 'Asia', 'Kenya': 'Africa', 'Chile': 'Americas'}
+ITEMS = {'Wheat': 'Cereals', 'Rice': 'Cereals', 'Apples': 'Fruits', 'Onions': 'Vegetables'}
+YEARS = range(2005, 2015)
+
+
+def build_outputs(folder):
+    # 01-05 con las columnas de analizar.py a partir de precios aleatorios
+    rng = np.random.default_rng(7)
+    rows = [(area, item, 'Producer Price Index (2014-2016 = 100)', year, round(rng.uniform(20, 200), 2),
+             region, category)
+            for area, region in AREAS.items() for item, category in ITEMS.items() for year in YEARS
+            if rng.random() > 0.15]
+    long = pd.DataFrame(rows, columns=analizar.LONG_OUTPUT_COLUMNS[:-1])
+    long['YoY_Change'] = (long.groupby(['Area', 'Item'])['Price'].pct_change() * 100).round(2)
+
+    def metrics(keys):
+        table = long.groupby(keys, sort=True)['Price'].agg(
+            Avg_Price='mean', Min_Price='min', Max_Price='max', Data_Points='count').reset_index()
+        table['Avg_Price'] = table['Avg_Price'].round(2)
+        # Volatility con empates y NaN para comprobar el orden de /top
+        table['Volatility'] = rng.choice([np.nan, 5.0, 12.5, 12.5, 30.0], size=len(table))
+        table['Trend_2010_2023'] = rng.uniform(-50, 150, size=len(table)).round(2)
+        return table
+
+    regional = long.groupby(['Region', 'Year', 'Product_Category'], sort=True)['Price'].agg(
+        Avg_Price='mean', Std_Price='std', Min_Price='min', Max_Price='max', Count='count').reset_index()
+    tables = {
+        analizar.LONG_ARTIFACT: long,
+        '02_Country_Metrics': metrics(['Area', 'Region']),
+        '03_Product_Metrics': metrics(['Item', 'Product_Category']),
+        '04_Regional_Aggregates': regional.round(2),
+        '05_Country_Category_Metrics': metrics(['Area', 'Region', 'Product_Category']),
+    }
+    os.makedirs(folder, exist_ok=True)
+    for name, table in tables.items():
+        table.to_csv(analizar.export_path(folder, name, 'csv'), index=False)
+
+
+@pytest.fixture(scope='module')
+def output_folder(tmp_path_factory):
+    folder = str(tmp_path_factory.mktemp('output'))
+    build_outputs(folder)
+    return folder
+
+
+@pytest.fixture(scope='module')
+def service(output_folder):
+    data = consultas.load_query_data(output_folder)
+    server = consultas.create_server(data, port=0, quiet=True)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    host, port = server.server_address[:2]
+    yield f'http://{host}:{port}', data
+    server.shutdown()
+    server.server_close()
+
+
+def get(base, path):
+    # (status, JSON) de una consulta al servidor
+    try:
+        with urllib.request.urlopen(base + path) as response:
+            return response.status, json.loads(response.read().decode('utf-8'))
+    except urllib.error.HTTPError as error:
+        return error.code, json.loads(error.read().decode('utf-8'))
+
+
+def read_output(folder, name):
+    return pd.read_csv(analizar.export_path(folder, name, 'csv'))
+
+
+def records(df):
+    # Filas como las serializa el servicio (NaN -> null)
+    return json.loads(df.to_json(orient='records', force_ascii=False))
+
+
+def test_series_matches_pandas(service, output_folder):
+    base, _ = service
+    long = read_output(output_folder, analizar.LONG_ARTIFACT)
+    status, body = get(base, '/series?area=spain&item=Wheat&year_from=2007')
+    assert status == 200
+
+    rows = long[(long['Area'] == 'Spain') & (long['Item'] == 'Wheat') & (long['Year'] >= 2007)]
+    stats = rows.groupby('Year')['Price'].agg(['count', 'mean', 'median', 'min', 'max'])
+    expected = pd.DataFrame({
+        'Year': stats.index, 'Count': stats['count'], 'Avg_Price': stats['mean'].round(2),
+        'Median_Price': stats['median'].round(2), 'Min_Price': stats['min'], 'Max_Price': stats['max'],
+    })
+    assert body['total'] == len(rows)
+    assert body['data'] == records(expected)
+
+
+def test_series_with_several_values_and_exclusions(service, output_folder):
+    base, _ = service
+    long = read_output(output_folder, analizar.LONG_ARTIFACT)
+    status, body = get(base, '/series?category=Cereals&category=Fruits&not_region=Europe&year_to=2010')
+    assert status == 200
+
+    rows = long[long['Product_Category'].isin(['Cereals', 'Fruits']) & (long['Region'] != 'Europe')
+                & (long['Year'] <= 2010)]
+    assert body['total'] == len(rows)
+    assert [row['Count'] for row in body['data']] == rows.groupby('Year').size().tolist()
+
+
+@pytest.mark.parametrize('table, query, mask', [
+    ('country', 'region=Europe', lambda df: df['Region'] == 'Europe'),
+    ('country', 'area=T%C3%BCrkiye', lambda df: df['Area'] == 'Türkiye'),
+    ('product', 'category=Cereals', lambda df: df['Product_Category'] == 'Cereals'),
+    ('regional', 'region=Asia&year=2008&year=2009',
+     lambda df: (df['Region'] == 'Asia') & df['Year'].isin([2008, 2009])),
+    ('country_category', 'not_region=Africa&category=Fruits',
+     lambda df: (df['Region'] != 'Africa') & (df['Product_Category'] == 'Fruits')),
+])
+def test_metrics_match_pandas(service, output_folder, table, query, mask):
+    base, _ = service
+    df = read_output(output_folder, consultas.TABLES[table])
+    status, body = get(base, f'/metrics/{table}?{query}')
+    assert status == 200
+    assert body['rows'] == mask(df).sum()
+    assert body['data'] == records(df[mask(df)])
+
+
+@pytest.mark.parametrize('table, query, by, ascending, n, mask', [
+    ('country', 'by=Volatility&n=3', 'Volatility', False, 3, None),
+    ('product', 'by=Volatility&order=asc&n=10', 'Volatility', True, 10, None),
+    ('country_category', 'by=Trend_2010_2023&n=5&not_region=Europe', 'Trend_2010_2023', False, 5,
+     lambda df: df['Region'] != 'Europe'),
+])
+def test_top_matches_pandas(service, output_folder, table, query, by, ascending, n, mask):
+    base, _ = service
+    df = read_output(output_folder, consultas.TABLES[table])
+    status, body = get(base, f'/top/{table}?{query}')
+    assert status == 200
+
+    if mask is not None:
+        df = df[mask(df)]
+    expected = df.dropna(subset=[by]).sort_values(by, ascending=ascending, kind='stable').head(n)
+    assert body['rows'] == len(expected)
+    assert body['data'] == records(expected)
+
+
+def test_top_rankings_are_built_at_load(service):
+    base, data = service
+    table = data['tables']['country']
+    numeric = [col for col in table['df'].columns if pd.api.types.is_numeric_dtype(table['df'][col])]
+    assert set(table['sorted']) == {(col, descending) for col in numeric for descending in (True, False)}
+
+    # Peticiones simultáneas: mismas respuestas y ningún orden nuevo
+    paths = [f'/top/country?by={col}&n={n}' for col in numeric for n in (2, 4)] * 4
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        bodies = list(pool.map(lambda path: get(base, path), paths))
+    assert all(status == 200 for status, _ in bodies)
+    assert bodies[:len(bodies) // 4] * 4 == bodies
+    assert len(table['sorted']) == 2 * len(numeric)
+
+
+def test_lru_cache_hits(service):
+    base, _ = service
+    before = get(base, '/health')[1]['cache']
+    first = get(base, '/metrics/country?region=Europe&not_area=France')
+    second = get(base, '/metrics/country?region=Europe&not_area=France')
+    # Mismos parámetros en otro orden: misma clave normalizada
+    third = get(base, '/metrics/country?not_area=France&region=Europe')
+    after = get(base, '/health')[1]['cache']
+    assert first == second == third
+    assert after['misses'] - before['misses'] == 1
+    assert after['hits'] - before['hits'] == 2
+
+
+def test_invalid_queries(service):
+    base, _ = service
+    assert get(base, '/metrics/unknown')[0] == 404
+    assert get(base, '/nothing')[0] == 404
+    status, body = get(base, '/series?colour=red')
+    assert status == 400 and 'colour' in body['error']
+    assert get(base, '/top/country?by=Area')[0] == 400
+    assert get(base, '/metrics/regional?item=Wheat')[0] == 400
+
+
+def test_find_artifact_prefers_newest_format(tmp_path):
+    pytest.importorskip('pyarrow')
+    folder = str(tmp_path)
+    name = '02_Country_Metrics'
+    csv_path = analizar.export_path(folder, name, 'csv')
+    feather_path = analizar.export_path(folder, name, 'feather')
+    pd.DataFrame({'Area': ['Stale'], 'Avg_Price': [1.0]}).to_feather(feather_path)
+    pd.DataFrame({'Area': ['Fresh'], 'Avg_Price': [2.0]}).to_csv(csv_path, index=False)
+
+    # feather de un --format anterior y csv de la última ejecución
+    os.utime(feather_path, ns=(10**18, 10**18))
+    os.utime(csv_path, ns=(2 * 10**18, 2 * 10**18))
+    assert consultas.find_artifact(folder, name) == csv_path
+    assert consultas.load_table(folder, name)['df']['Area'].tolist() == ['Fresh']
+
+    # Escritos a la vez: el formato más rápido de leer
+    os.utime(feather_path, ns=(2 * 10**18, 2 * 10**18))
+    assert consultas.find_artifact(folder, name) == feather_path